@@ -1,10 +1,17 @@
 '''
 Generalized dataverse utilities. Note that
 `import dataverse_utils` is the equivalent of
-`import dataverse_utils.dataverse_utils`
+`import dataverse_utils.dataverse_utils`, plus the
+upload functions from `dataverse_utils.upload`
 '''
 import pathlib
 import sys
+#These come first, as the star import replaces the dataverse_utils
+#attribute of the package, which they import, with the package itself
+from dataverse_utils.bundle import BUNDLE_SIZE, BUNDLE_FILES
+from dataverse_utils.upload import (DIRECT_SIZE, UploadJournal, read_report, sync_dataset,
+                                    upload_from_tsv, upload_plan, upload_summary,
+                                    write_report)
 from dataverse_utils.dataverse_utils import *
 
 VERSION = (0, 24, 0)
@@ -15,20 +22,20 @@ USERAGENT = (f'dataverse_utils/v{__version__} ({sys.platform.capitalize()}); '
 UAHEADER = {'User-agent' : USERAGENT}
 
 SCRIPT_VERSIONS={
-'dv_bagit' : (0, 1, 0),
+'dv_bagit' : (0, 2, 0),
 'dv_bulk_release' : (0, 1, 0),
-'dv_collection_info' : (0, 5, 0),
+'dv_collection_info' : (0, 11, 2),
 'dv_del' : (0, 2, 4),
 'dv_ldc_uploader' : (0, 4, 1),
 'dv_list_files' : (0, 1, 1),
-'dv_manifest_gen' : (0, 5, 1),
+'dv_manifest_gen' : (0, 7, 0),
 'dv_pg_facet_date' : (0, 1, 1),
 'dv_record_copy' : (0, 1, 2),
 'dv_release' : (0, 1, 3),
 'dv_replace_licence' : (0, 1, 1),
-'dv_readme_creator' : (0, 1, 1),
-'dv_study_migrator' : (0, 5, 0),
-'dv_upload_tsv' : (0, 5, 0)}
+'dv_readme_creator' : (0, 2, 1),
+'dv_study_migrator' : (0, 6, 1),
+'dv_upload_tsv' : (0, 12, 3)}
 
 def script_ver_stmt(name:str)->str:
     '''
@@ -1,11 +1,13 @@
 '''
 Bagit archiver class for dataverse_utils
 '''
+import contextlib
 import hashlib
 import json
 import logging
 import pathlib
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import bagit
 import bs4
@@ -13,6 +15,7 @@ import tqdm
 import requests
 
 import dataverse_utils.collections as dvc
+from dataverse_utils import throttle
 
 LOGGER = logging.Logger(__name__)
 
@@ -56,6 +59,12 @@ class Archive:
                 Contact number for Bag, in international format.
                 ie +1 604 555 5555
                    +49 30 5555 5555
+            workers : int
+                Number of files to download at once. Default 1.
+            adaptive : bool
+                Adjust the number of downloads at once, up to `workers`,
+                to what the server can handle.
+                See `dataverse_utils.throttle.Controller`.
 
         Notes
         -----
@@ -87,8 +96,13 @@ class Archive:
         self.bag = self.__bag()
         self.session = kwargs.get('session', requests.Session())
         self.session.mount('https://',
-                           requests.adapters.HTTPAdapter(max_retries=dvc.RETRY))
-        self.limiter = dvc.RateLimiter(rate_limit_on=kwargs.get('rate_limit_on', True),
+                           requests.adapters.HTTPAdapter(max_retries=dvc.RETRY,
+                                                         pool_maxsize=max(10, self.workers)))
+        if self.__adaptive:
+            throttle.controller(kwargs['url'], maximum=self.workers)
+            throttle.watch(self.session)
+        self.limiter = dvc.RateLimiter(url=kwargs.get('url', ''),
+                                      rate_limit_on=kwargs.get('rate_limit_on', True),
                                       rate_limit_min=kwargs.get('rate_limit_min',0.3),
                                       rate_limit_max=kwargs.get('rate_limit_max', 2))
 
@@ -112,6 +126,20 @@ class Archive:
             #bagit source line 1258
         return baggy
 
+    @property
+    def workers(self)->int:
+        '''
+        Number of files to download at once
+        '''
+        return max(1, int(self.kwargs.get('workers', 1) or 1))
+
+    @property
+    def __adaptive(self)->bool:
+        '''
+        Whether the number of downloads at once is adjusted to the server
+        '''
+        return bool(self.kwargs.get('adaptive')) and self.workers > 1
+
     @property
     def target_dir(self):
         '''
@@ -246,6 +274,19 @@ class Archive:
         LOGGER.info('%s match: %s', prot, calc)
         return True
 
+    @staticmethod
+    def bag_name(file:dict)->str:
+        '''
+        Name under which a file is saved in the bag
+
+        Parameters
+        ----------
+        file : dict
+            File information, as for `save_file_to_bag`
+        '''
+        return file.get('dataFile_originalFileName',
+                        file.get('label', file['dataFile_filename']))
+
     def save_file_to_bag(self, fobj:bytes, validate:bool=True, **kwargs):
         '''
         Save the file to the bag file store
@@ -267,8 +308,7 @@ class Archive:
         Files are saved to the directory called *files* inside the
         data directory in the bag.
         '''
-        fname = kwargs.get('dataFile_originalFileName',
-                           kwargs.get('label', kwargs['dataFile_filename']))
+        fname = self.bag_name(kwargs)
         files_loc = pathlib.Path(self.target_dir, 'data','files')
         if not files_loc.exists():
             files_loc.mkdir(exist_ok=True)
@@ -290,7 +330,10 @@ class Archive:
     def process_files(self):
         '''
         Iterate over files to download and write them, if necessary,
-        to physical media
+        to physical media. With more than one worker, files are
+        downloaded concurrently, except that files saved under the
+        same name (eg. one file in several versions) are downloaded
+        one after another, in order.
         '''
         # self.study['current_version']
         file_list = ([_ for _ in self.study.all_files if
@@ -298,22 +341,57 @@ class Archive:
                     if not self.kwargs['all_versions']
                     else self.study.all_files)
 
-        for file in tqdm.tqdm(file_list,
-                              desc='Download check',
-                              unit='file',
-                              leave=False,
-                              bar_format=dvc.BAR_FORMAT):
-            down = self.__should_download(file['dataFile_checksum_value'],
-                                        file.get('dataFile_checksum_type', 'md5'))
-            if down:
-                download = self.download_file(file['dataFile_id'])
-                #breakpoint()
-                if not self.verify_download(download.content,
-                                            file['dataFile_checksum_type'].lower(),
-                                            file['dataFile_checksum_value']):
-                    LOGGER.error('Validation error for file with ID %s', file['dataFile_id'])
-                    raise DigestMismatchError(f'Validation error for {file}')
-                self.save_file_to_bag(download.content, **file)
+        todo = [file for file in tqdm.tqdm(file_list,
+                                           desc='Download check',
+                                           unit='file',
+                                           leave=False,
+                                           bar_format=dvc.BAR_FORMAT)
+                if self.__should_download(file['dataFile_checksum_value'],
+                                          file.get('dataFile_checksum_type', 'md5'))]
+        #Two versions written to the same path at once could fail validation
+        groups = {}
+        for file in todo:
+            groups.setdefault(self.bag_name(file), []).append(file)
+        if self.workers == 1 or len(groups) < 2:
+            for file in todo:
+                self.__fetch(file)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(groups))) as pool:
+            #list() so that any DigestMismatchError is raised here
+            list(pool.map(self.__fetch_group, groups.values()))
+
+    def __fetch_group(self, files:list):
+        '''
+        Download files which are saved under the same name, in order
+
+        Parameters
+        ----------
+        files : list
+            File metadata from StudyMetadata.all_files
+        '''
+        for file in files:
+            self.__fetch(file)
+
+    def __fetch(self, file:dict):
+        '''
+        Download, verify and save a single file
+
+        Parameters
+        ----------
+        file : dict
+            File metadata from StudyMetadata.all_files
+        '''
+        with (throttle.controller(self.kwargs['url']).slot() if self.__adaptive
+              else contextlib.nullcontext()):
+            download = self.download_file(file['dataFile_id'])
+            content = download.content
+        #breakpoint()
+        if not self.verify_download(content,
+                                    file['dataFile_checksum_type'].lower(),
+                                    file['dataFile_checksum_value']):
+            LOGGER.error('Validation error for file with ID %s', file['dataFile_id'])
+            raise DigestMismatchError(f'Validation error for {file}')
+        self.save_file_to_bag(content, **file)
 
     def bagit_meta(self):
         '''Add applicable metadata for the Bagit bag'''
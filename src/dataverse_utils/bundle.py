@@ -0,0 +1,227 @@
+'''
+Bundling many small files into zips, which Dataverse unpacks,
+so that they upload in one request
+'''
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import zipfile
+
+import requests
+import dataverse_utils.dataverse_utils as dvu
+from dataverse_utils import streams
+LOGGER = logging.getLogger(__name__)
+
+#Default size limit in bytes for files bundled into zips by upload_from_tsv
+BUNDLE_SIZE = 2**20
+
+#Dataverse's default :ZipUploadFilesLimit
+BUNDLE_FILES = 1000
+
+def _bundleable(row) -> bool:
+    '''
+    True if Dataverse would unpack a manifest row's file from a zip
+    as it is, whatever its size.
+
+    Parameters
+    ----------
+    row : dict
+        Manifest row as produced by `_manifest_rows`
+    '''
+    if row.get('replace') or row.get('mimetype'):
+        return False
+    name = os.path.basename(row['fpath'])
+    #Dataverse would ingest these after unzipping, or unzip them again,
+    #and quietly drops hidden files
+    return (os.path.splitext(name)[1].lower() not in dvu.NOTAB + dvu.INGEST
+            and not name.startswith('.'))
+
+def bundle_rows(rows:list, order:list, **kwargs) -> tuple:
+    '''
+    Groups small files into zip bundles. Returns a tuple of
+    (list of bundles, each a list of row numbers; row numbers not bundled).
+    Files are only bundled with others which have the same tags.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`
+
+    order : list
+        Row numbers to consider, in upload order
+
+    **kwargs : dict
+        Other parameters
+
+    Other parameters
+    ----------------
+    bundle : int
+        Largest file size in bytes to bundle
+
+    bundle_files : int, optional, default=BUNDLE_FILES
+        Maximum number of files per bundle
+
+    skip : set, optional
+        Row numbers which must not be bundled
+    '''
+    groups = {}
+    single = []
+    for num in order:
+        row = rows[num]
+        if num in kwargs.get('skip', set()) or not _bundleable(row):
+            single.append(num)
+            continue
+        try:
+            if os.path.getsize(row['fpath']) > kwargs['bundle']:
+                single.append(num)
+                continue
+        except OSError:
+            single.append(num)
+            continue
+        groups.setdefault(tuple(row.get('tags', [])), []).append(num)
+    size = kwargs.get('bundle_files') or BUNDLE_FILES
+    bundles = []
+    for group in groups.values():
+        if len(group) == 1:
+            #A zip of one saves nothing
+            single.extend(group)
+            continue
+        bundles.extend(group[_:_+size] for _ in range(0, len(group), size))
+    single.sort(key=order.index)
+    return bundles, single
+
+def upload_bundle(rows:list, hdl, name:str, **kwargs) -> list:
+    '''
+    Zips a set of manifest rows and uploads them as one bundle, which
+    Dataverse unpacks. Returns a list of result dicts as from `_upload_row`,
+    one per row. The first result carries the statistics for the bundle.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`. They should share
+        the same tags.
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    name : str
+        File name for the zip
+
+    **kwargs : dict
+        Other parameters passed on to `upload_file`, plus `journal`
+    '''
+    #pylint: disable=too-many-locals
+    params = kwargs.copy()
+    journal = params.pop('journal', None)
+    params.pop('remote', None)
+    rest = params.pop('rest', False)
+    params['dv'] = params['dv'].strip('\\ /')
+    stats = {'bytes': 0, 'requests': 0}
+    results = [{'file': _['fpath'], 'pid': hdl, 'status': 'uploaded', 'fid': None,
+                'error': None, 'bundle': name} for _ in rows]
+    results[0]['stats'] = stats
+    digests = []
+    try:
+        with dvu._measure(stats, 'wall'), tempfile.TemporaryDirectory() as tmp:#pylint: disable=protected-access
+            zname = os.path.join(tmp, name)
+            with zipfile.ZipFile(zname, 'w', zipfile.ZIP_DEFLATED) as zfile:
+                for row in rows:
+                    with open(row['fpath'], 'rb') as fobj:
+                        data = fobj.read()
+                    #Hash on the way into the zip so each file is only read once
+                    digests.append(hashlib.md5(data).hexdigest())
+                    zfile.writestr('/'.join([row.get('dirlabel', '').strip('/'),
+                                             os.path.basename(row['fpath'])]).strip('/'),
+                                   data)
+            for row in rows:
+                if journal:
+                    journal.mark(hdl, row, 'started')
+            #Whatever most files share needs no correction afterwards
+            descr = [_.get('descr', '') for _ in rows]
+            params.update({'descr': max(set(descr), key=descr.count),
+                           'tags': rows[0].get('tags', []),
+                           'dirlabel': '', 'expand': True, 'rest': rest, 'md5': None,
+                           'sha256': None})
+            #Unpacked files are restricted in _finish_bundled, once checked
+            uploaded = dvu.upload_file(zname, hdl, stats=stats, **dict(params, rest=False))
+            remote = dvu._remote_index(uploaded)#pylint: disable=protected-access
+    except (dvu.DvGeneralUploadError, dvu.Md5Error, KeyError, OSError,
+            json.decoder.JSONDecodeError,
+            requests.exceptions.RequestException) as err:
+        LOGGER.error('Upload of bundle %s failed: %s', name, err)
+        for row, result in zip(rows, results):
+            result.update({'status': 'failed', 'error': str(err)})
+            if journal:
+                journal.mark(hdl, row, 'failed', error=str(err))
+        return results
+    for row, result, digest in zip(rows, results, digests):
+        try:
+            with dvu._measure(stats, 'wall'):#pylint: disable=protected-access
+                found = dvu._remote_match(row, remote)#pylint: disable=protected-access
+                _finish_bundled(row, found, digest,
+                                hdl=hdl, journal=journal, result=result,
+                                stats=stats, **params)
+        except (dvu.Md5Error, KeyError, OSError,
+                requests.exceptions.RequestException) as err:
+            LOGGER.error('Upload of %s in bundle %s failed: %s', row['fpath'], name, err)
+            result.update({'status': 'failed', 'error': str(err)})
+            if journal:
+                journal.mark(hdl, row, 'failed', fid=result['fid'], error=str(err))
+    return results
+
+def _finish_bundled(row, found:dict, digest:str, **kwargs) -> None:
+    '''
+    Checks a file unpacked from a bundle against its manifest row and
+    completes its metadata and restriction.
+
+    Parameters
+    ----------
+    row : dict
+        Manifest row as produced by `_manifest_rows`
+
+    found : dict
+        File metadata from Dataverse for the file, or None
+
+    digest : str
+        md5 of the file as it was added to the bundle
+
+    **kwargs : dict
+        'hdl', 'rest', 'journal', 'result', 'stats' and 'dv',
+        plus `upload_file` parameters
+    '''
+    if not found:
+        raise KeyError(f'{row["fpath"]} not found in unpacked bundle')
+    data_file = found['dataFile']
+    kwargs['result']['fid'] = data_file['id']
+    checksum = data_file.get('checksum', {'type': 'MD5', 'value': data_file.get('md5')})
+    prot = dvu.CHECKSUM_TYPES.get(checksum.get('type'), 'md5')
+    local = digest if prot == 'md5' else streams.file_digest(row['fpath'], prot)
+    if local != checksum.get('value') or (row.get('md5') and row['md5'] != digest):
+        LOGGER.warning('%s mismatch on %s', prot, row['fpath'])
+        raise dvu.Md5Error(f'{prot} mismatch')
+    journal = kwargs.get('journal')
+    if journal:
+        journal.mark(kwargs['hdl'], row, 'uploaded', fid=data_file['id'],
+                     md5=data_file.get('md5'))
+    meta = {'label': found['label'],
+            'directoryLabel': row.get('dirlabel', ''),
+            'description': row.get('descr', ''),
+            'categories': row.get('tags', [])}
+    if (found.get('description', '') != meta['description'] or
+            sorted(found.get('categories', [])) != sorted(meta['categories']) or
+            found.get('directoryLabel', '').strip('/') != meta['directoryLabel'].strip('/')):
+        #Only needed if Dataverse didn't apply the bundle's metadata
+        dvu.update_file_metadata(kwargs['dv'], data_file['id'], kwargs.get('apikey'), meta,
+                                 kwargs.get('session'))
+    if kwargs['rest'] and not found.get('restricted'):
+        with dvu._measure(kwargs['stats'], 'restrict'):#pylint: disable=protected-access
+            dvu.restrict_file(fid=data_file['id'], dv=kwargs['dv'],
+                              apikey=kwargs.get('apikey'), rest=True, hdl=kwargs['hdl'],
+                              lock=kwargs.get('lock'), session=kwargs.get('session'))
+    if journal:
+        journal.mark(kwargs['hdl'], row, 'complete', fid=data_file['id'],
+                     md5=data_file.get('md5'), restricted=bool(kwargs['rest']))
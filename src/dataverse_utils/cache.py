@@ -0,0 +1,281 @@
+'''
+On-disk cache of Dataverse API responses.
+
+Study metadata doesn't change between most runs of a harvest, but can be
+many megabytes for studies with thousands of files. `CachingAdapter`
+keeps GET responses in an SQLite database. Recent ones are reused without
+asking the server, and older ones are checked with a conditional request
+(If-None-Match/If-Modified-Since) where the server supplied an ETag or
+Last-Modified date, so that an unchanged response costs a 304 and no
+download.
+
+API keys never reach the cache file. Responses are stored against a
+hash of the key, so a cached response is only used for the same key.
+'''
+import argparse
+import hashlib
+import json
+import logging
+import pathlib
+import sqlite3
+import textwrap
+import threading
+import time
+import zlib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from dataverse_utils import throttle
+
+LOGGER = logging.getLogger(__name__)
+
+PATH = pathlib.Path('~/.cache/dataverse_utils/responses.sqlite')
+'''Default cache file'''
+
+TTL = 86400
+'''Default number of seconds for which a response is used without checking'''
+
+MAX_SIZE = 2**29
+'''Default maximum size of the cache in bytes (compressed)'''
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    '''
+    requests transport adapter which caches GET responses in SQLite.
+    '''
+    def __init__(self, path=PATH, ttl:float=TTL, max_size:int=MAX_SIZE, **kwargs):
+        '''
+        Parameters
+        ----------
+        path : str or pathlib.Path, optional, default=PATH
+            Cache database file. It is created if necessary.
+        ttl : float, optional, default=TTL
+            Seconds for which a cached response is used without checking
+            with the server. 0 checks every time.
+        max_size : int, optional, default=MAX_SIZE
+            Size in bytes above which the least recently used responses
+            are removed.
+
+        **kwargs : dict
+            Other parameters for requests.adapters.HTTPAdapter, such as
+            max_retries and pool_maxsize
+
+        Notes
+        -----
+        Only successful GET responses which aren't streamed are cached,
+        so file downloads pass straight through. A response is kept for
+        as long as there is room, however old; once it is older than `ttl`
+        it is revalidated if possible or downloaded again if not.
+        '''
+        super().__init__(**kwargs)
+        self.path = pathlib.Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.counters = {'hits': 0, 'revalidated': 0, 'misses': 0,
+                         'stored': 0, 'evicted': 0}
+        self.__lock = threading.Lock()
+        self.__closed = False
+        self.__db = sqlite3.connect(self.path, check_same_thread=False,
+                                    isolation_level=None, timeout=30)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS responses '
+                          '(key TEXT PRIMARY KEY, url TEXT, headers TEXT, body BLOB, '
+                          'etag TEXT, modified TEXT, stored REAL, used REAL, size INTEGER)')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS used ON responses (used)')
+
+    @staticmethod
+    def key(request:requests.PreparedRequest)->str:
+        '''
+        Cache key for a request: its full URL, including parameters, and a
+        hash of any API key or authorization header.
+
+        Parameters
+        ----------
+        request : requests.PreparedRequest
+            Request
+        '''
+        who = '\n'.join(request.headers.get(_, '')
+                        for _ in ('X-Dataverse-key', 'Authorization'))
+        return hashlib.sha256(f'{request.url}\n{who}'.encode('utf-8')).hexdigest()
+
+    def __response(self, request, row:tuple)->requests.Response:
+        '''
+        Build a response from a cache row
+
+        Parameters
+        ----------
+        request : requests.PreparedRequest
+            Request
+        row : tuple
+            (headers, body)
+        '''
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(json.loads(row[0]))
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = zlib.decompress(row[1])#pylint: disable=protected-access
+        #Otherwise iter_content tries to read the missing raw response
+        response._content_consumed = True#pylint: disable=protected-access
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def send(self, request, stream=False, **kwargs):#pylint: disable=arguments-differ
+        '''
+        Send a request, or answer it from the cache. The arguments are
+        as for requests.adapters.HTTPAdapter.send.
+        '''
+        if request.method != 'GET' or stream:
+            return super().send(request, stream, **kwargs)
+        key = self.key(request)
+        with self.__lock:
+            row = self.__db.execute('SELECT headers, body, etag, modified, stored '
+                                    'FROM responses WHERE key = ?', (key,)).fetchone()
+        if row and time.time() - row[4] < self.ttl:
+            self.__touch(key, 'hits')
+            #No request was made, so it shouldn't count towards the rate limit
+            throttle.bucket(request.url).refund()
+            response = self.__response(request, row)
+            response.from_cache = True
+            return response
+        if row and row[2]:
+            request.headers['If-None-Match'] = row[2]
+        if row and row[3]:
+            request.headers['If-Modified-Since'] = row[3]
+        response = super().send(request, stream, **kwargs)
+        if row and response.status_code == 304:
+            self.__touch(key, 'revalidated', refresh=True)
+            cached = self.__response(request, row)
+            cached.elapsed = response.elapsed
+            return cached
+        with self.__lock:
+            self.counters['misses'] += 1
+        if response.status_code == 200 and 'no-store' not in response.headers.get(
+                                                               'Cache-Control', ''):
+            self.__store(key, response)
+        return response
+
+    def __touch(self, key:str, counter:str, refresh:bool=False):
+        '''
+        Mark a cached response as used, and optionally as freshly validated
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+        counter : str
+            Counter to increase
+        refresh : bool, optional
+            Restart the TTL
+        '''
+        now = time.time()
+        with self.__lock:
+            self.counters[counter] += 1
+            if refresh:
+                self.__db.execute('UPDATE responses SET used = ?, stored = ? WHERE key = ?',
+                                  (now, now, key))
+            else:
+                self.__db.execute('UPDATE responses SET used = ? WHERE key = ?', (now, key))
+
+    def __store(self, key:str, response:requests.Response):
+        '''
+        Save a response, and remove the least recently used ones if
+        the cache is too big
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+        response : requests.Response
+            Response
+        '''
+        body = zlib.compress(response.content)
+        now = time.time()
+        with self.__lock:
+            self.__db.execute('INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?,?,?)',
+                              (key, response.url, json.dumps(dict(response.headers)), body,
+                               response.headers.get('ETag'),
+                               response.headers.get('Last-Modified'),
+                               now, now, len(body)))
+            self.counters['stored'] += 1
+            total = self.__db.execute('SELECT COALESCE(SUM(size), 0) '
+                                      'FROM responses').fetchone()[0]
+            if total <= self.max_size:
+                return
+            for old, size in self.__db.execute('SELECT key, size FROM responses '
+                                               'ORDER BY used').fetchall():
+                if total <= self.max_size or old == key:
+                    break
+                self.__db.execute('DELETE FROM responses WHERE key = ?', (old,))
+                total -= size
+                self.counters['evicted'] += 1
+
+    def close(self):
+        '''
+        Close the connections and the database. A session calls this
+        once for each prefix the adapter is mounted on, so only the
+        first call does anything.
+        '''
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__db.close()
+            counters = dict(self.counters)
+        super().close()
+        LOGGER.info('Response cache %s: %s', self.path, counters)
+
+def cached_session(path=PATH, ttl:float=TTL, max_size:int=MAX_SIZE, **kwargs)->requests.Session:
+    '''
+    Returns a requests.Session which caches GET responses.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path, optional, default=PATH
+        Cache database file
+    ttl : float, optional, default=TTL
+        Seconds for which a cached response is used without checking
+    max_size : int, optional, default=MAX_SIZE
+        Maximum size of the cache in bytes
+
+    **kwargs : dict
+        Other parameters for requests.adapters.HTTPAdapter. max_retries
+        defaults to dataverse_utils.throttle.RETRY.
+    '''
+    kwargs.setdefault('max_retries', throttle.RETRY)
+    session = requests.Session()
+    adapter = CachingAdapter(path, ttl, max_size, **kwargs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def add_arguments(parser:argparse.ArgumentParser):
+    '''
+    Adds the --cache and --cache-ttl options to a script's arguments
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        Argument parser
+    '''
+    parser.add_argument('--cache',
+                        help=textwrap.fill(textwrap.dedent(
+                        f'''
+                        Keep metadata responses in a cache file, so that
+                        later runs only download what has changed. Optionally
+                        specify the file. Default {PATH}
+                        '''),80),
+                        nargs='?',
+                        const=PATH)
+    parser.add_argument('--cache-ttl',
+                        help=textwrap.fill(textwrap.dedent(
+                        '''
+                        Seconds for which a cached response is used without
+                        checking with the server. Default 86400 (one day).
+                        '''),80),
+                        default=TTL,
+                        type=float)
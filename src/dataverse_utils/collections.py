@@ -3,20 +3,21 @@ Utilities for recursively analysing a Dataverse collection.
 '''
 #pylint: disable=too-many-lines
 
+import contextlib
 import copy
 import datetime
 import io
+import itertools
 import logging
 import pathlib
-import random
 import string
 import sys
 import tempfile
-import time
 import textwrap
 import typing
 import traceback
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import bs4
 import charset_normalizer as cn
@@ -27,15 +28,12 @@ import pandas as pd
 import pyreadr
 import requests
 import tqdm #Progress meter
-from urllib3.util import Retry
 from dataverse_utils import UAHEADER
+from dataverse_utils import cache
+from dataverse_utils import throttle
 
 LOGGER = logging.getLogger(__name__)
-RETRY = Retry(total=10,
-                       status_forcelist=[429, 500, 502, 503, 504],
-                       allowed_methods=['HEAD', 'GET', 'OPTIONS',
-                                         'POST', 'PUT'],
-                       backoff_factor=1)
+RETRY = throttle.RETRY
 BAR_FORMAT='{l_bar}{bar}{n_fmt}/{total_fmt} : time remaining - {remaining}'
 
 class MetadataError(Exception):
@@ -45,7 +43,7 @@ class MetadataError(Exception):
 
 class RateLimiter:
     '''
-    Pauses for a random interval
+    Limits the rate of requests to a Dataverse installation
     '''
     #pylint: disable=too-few-public-methods
     def __init__(self, **kwargs):
@@ -56,6 +54,9 @@ class RateLimiter:
 
         Other parameters
         ----------------
+        url : str
+            URL of the Dataverse installation (or any URL on the same host)
+
         rate_limit_on: bool
             Turn on rate limit for requests
 
@@ -65,15 +66,26 @@ class RateLimiter:
         rate_limit_max : int
             Maximum time between requests in seconds
 
+        rate_limit_burst : int
+            Number of requests which can be made at once after
+            a quiet period. Default 1.
+
         session : requests.Session
             A requests session if available, to help
             ensure against having too many open connections
 
         Notes
         -----
-        The rate limiter will wait for a random interval between
-        rate_limit_min and rate_limit_max. Obviously, if you want
-        a constant interval, set them to be equal.
+        Requests are limited to an average of one every
+        (rate_limit_min + rate_limit_max) / 2 seconds, but the time since
+        the last request counts towards the wait, so requests are only
+        delayed if they would be too frequent.
+
+        All rate limiters for the same host share a single
+        `dataverse_utils.throttle` token bucket, so the limit applies to all
+        requests from all threads and objects together. If they ask for
+        different rates, the slowest applies. A `Retry-After` from the
+        server pauses all of them, even if rate limiting is off.
         '''
         self.kwargs = kwargs
 
@@ -81,13 +93,17 @@ class RateLimiter:
             self.kwargs['rate_limit_on'] = False
             self.kwargs['rate_limit_min'] = 0
             self.kwargs['rate_limit_max'] = 0
+        interval = (self.kwargs.get('rate_limit_min', 0) +
+                    self.kwargs.get('rate_limit_max', 0)) / 2
+        self.bucket = throttle.bucket(kwargs.get('url', ''),
+                                      rate=1 / interval if interval else None,
+                                      burst=kwargs.get('rate_limit_burst'))
 
     def rate_limit(self):
         '''
-        Sleep before requests for the time set by the rate limits
+        Wait before requests for the time set by the rate limits
         '''
-        time.sleep(random.uniform(self.kwargs['rate_limit_min'],
-                                  self.kwargs['rate_limit_max']))
+        self.bucket.acquire(limited=self.kwargs['rate_limit_on'])
 
 class DvCollection:
     '''
@@ -128,17 +144,28 @@ class DvCollection:
 
         session : requests.Session
             A requests session if available, to help
-            ensure against having too many open connections
+            ensure against having too many open connections.
+            A session from `dataverse_utils.cache.cached_session`
+            caches metadata between runs.
+
+        workers : int
+            Number of requests to make at once while crawling. Default 1.
+
+        adaptive : bool
+            Adjust the number of requests at once, up to `workers`, to
+            what the server can handle. See `dataverse_utils.throttle.Controller`.
 
         Notes
         -----
-        The rate limiter will wait for a random interval between
-        rate_limit_min and rate_limit_max. Obviously, if you want
-        a constant interval, set them to be equal.
+        Requests are limited to an average of one every
+        (rate_limit_min + rate_limit_max) / 2 seconds, across all workers
+        and shared with everything else making requests to the same host.
+        See `RateLimiter`.
 
         '''
         self.kwargs = kwargs
-        self.limit = RateLimiter(**kwargs)
+        self.limit = RateLimiter(url=url, **kwargs)
+        self.workers = max(1, int(kwargs.get('workers', 1) or 1))
         self.coll = coll
         self.url = self.__clean_url(url)
         self.headers = None
@@ -154,10 +181,20 @@ class DvCollection:
             self.retry_strategy = kwargs['retry']
         self.collections = None
         self.session = kwargs.get('session', requests.Session())
-        self.session.mount('https://',
-                           requests.adapters.HTTPAdapter(max_retries=RETRY))
+        #A cache stays in place; it already retries
+        if not isinstance(self.session.get_adapter('https://'), cache.CachingAdapter):
+            self.session.mount('https://',
+                               requests.adapters.HTTPAdapter(max_retries=RETRY,
+                                                             pool_maxsize=max(10,
+                                                                              self.workers)))
+        self.control = None
+        if kwargs.get('adaptive') and self.workers > 1:
+            self.control = throttle.controller(self.url, maximum=self.workers)
+            throttle.watch(self.session)
         self.studies = None
         self.__root = None
+        self.__contents = {}
+        self.__aliases = {}
         self.all_colls = [self.root]
 
     @property
@@ -200,66 +237,217 @@ class DvCollection:
         shortname.raise_for_status()
         return shortname.json()['data']['alias']
 
-    def get_collections(self, coll:str=None, output=None)->list:#pylint: disable=unused-argument
+    def __map(self, func, items:list, **kwargs)->list:
         '''
-        Get a [recursive] listing of all dataverses in a collection.
+        Apply a function to every item, using up to `workers` threads
+        (fewer if the concurrency is adaptive). Results are in the same
+        order as the items.
 
         Parameters
         ----------
-        coll : str, optional, default=None
+        func : callable
+            Function taking a single item
+
+        items : list
+            Items to process
+
+        **kwargs : dict
+            If supplied, arguments for a tqdm progress bar
+        '''
+        return list(self.__imap(func, items, **kwargs))
+
+    def __imap(self, func, items:list, **kwargs)->typing.Generator:
+        '''
+        Generator version of `__map`. Results are yielded in order as they
+        arrive, and no more than twice `workers` items are in progress or
+        waiting to be used at once.
+
+        Parameters
+        ----------
+        func : callable
+            Function taking a single item
+
+        items : list
+            Items to process
+
+        **kwargs : dict
+            If supplied, arguments for a tqdm progress bar
+        '''
+        parallel = self.workers > 1 and len(items) > 1
+        def limited(item):
+            with self.control.slot():
+                return func(item)
+        work = limited if parallel and self.control else func
+        with (tqdm.tqdm(total=len(items), **kwargs) if kwargs
+              else contextlib.nullcontext()) as pbar:
+            if not parallel:
+                for item in items:
+                    yield work(item)
+                    if pbar is not None:
+                        pbar.update()
+                return
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as pool:
+                todo = iter(items)
+                pending = [pool.submit(work, _)
+                           for _ in itertools.islice(todo, 2 * self.workers)]
+                while pending:
+                    result = pending.pop(0).result()
+                    pending.extend(pool.submit(work, _) for _ in itertools.islice(todo, 1))
+                    yield result
+                    if pbar is not None:
+                        pbar.update()
+
+    def __get_contents(self, coll:str)->list:
+        '''
+        Returns the contents of a single collection
+
+        Parameters
+        ----------
+        coll : str
             Collection short name or id
-        output : list, optional, default=[]
-            output list to append to
         '''
-        if not output:
-            output = []
-        if not coll:
-            coll = self.coll
         self.limit.rate_limit()
         x = self.session.get(f'{self.url}/api/dataverses/{coll}/contents',
                                 headers=self.headers,
                                 timeout=self.kwargs.get('timeout', 15))
-        data = x.json().get('data')
+        #Kept so that the study listing doesn't need the same request
+        self.__contents[coll] = x.json().get('data')
+        return self.__contents[coll]
+
+    def __search_aliases(self, coll:str)->dict:
+        '''
+        Returns the short names of the collections under coll from the
+        search API, a thousand at a time, keyed on both collection id
+        and (parent short name, title). Titles shared by
+        sibling collections are left out.
+
+        Parameters
+        ----------
+        coll : str
+            Short name of top level collection
+        '''
+        out = {}
+        dupes = set()
+        start = 0
+        while True:
+            self.limit.rate_limit()
+            found = self.session.get(f'{self.url}/api/search',
+                                     params={'q': '*', 'type': 'dataverse',
+                                             'subtree': coll, 'per_page': 1000,
+                                             'show_entity_ids': 'true',
+                                             'start': start},
+                                     headers=self.headers,
+                                     timeout=self.kwargs.get('timeout', 15))
+            if found.status_code != 200:
+                LOGGER.warning('Collection search failed for %s: %s',
+                               coll, found.status_code)
+                break
+            data = found.json()['data']
+            for item in data['items']:
+                if item.get('entity_id'):
+                    out[item['entity_id']] = item['identifier']
+                key = (item.get('parentDataverseIdentifier'), item.get('name'))
+                if key in out:
+                    dupes.add(key)
+                out[key] = item['identifier']
+            start += len(data['items'])
+            if not data['items'] or start >= data['total_count']:
+                break
+        for key in dupes:
+            del out[key]
+        return out
+
+    def __get_child(self, job:tuple)->tuple:
+        '''
+        Returns (title, short name) for a child collection
+
+        Parameters
+        ----------
+        job : tuple
+            (Parent short name, collection entry from the parent's contents)
+        '''
+        parent, child = job
+        alias = self.__aliases.get(child.get('id'),
+                                   self.__aliases.get((parent, child.get('title'))))
+        if alias:
+            return (child['title'], alias)
         #---
         #Because it's possible that permissions errors can cause API read errors,
         #we have this insane way of checking errors.
         #I have no idea what kind of errors would be raised, so it has
         #a bare except, which is bad. But what can you do?
-        dvs =[]
-        for _ in data:
-            if _['type'] == 'dataverse':
-                try:
-                    out=self.__get_shortname(_['id'])
-                    dvs.append((_['title'], out))
-                except Exception as e:
-                    obscure_error = f'''
-                                        An error has occured where a collection can be
-                                        identified by ID but its name cannot be determined.
-                                        This is (normally) caused by a configuration error where
-                                        administrator permissions are not correctly inherited by
-                                        the child collection.
-
-                                        Please check with the system administrator to determine
-                                        any exact issues.
-
-                                        Problematic collection id number: {_.get("id",
-                                        "not available")}'''
-                    #to sys.stdout?
-                    print(50*'-', file=sys.stderr)
-                    print(textwrap.dedent(obscure_error), file=sys.stderr)
-                    print(e)
-                    LOGGER.error(textwrap.fill(textwrap.dedent(obscure_error).strip()))
-                    traceback.print_exc()
-                    print(50*'-', file=sys.stderr)
-                    raise e
-        #---
-        if not dvs:
-            dvs = []
-        output.extend(dvs)
-        for dv in dvs:
-            LOGGER.debug('%s/api/dataverses/%s/contents', self.url, dv[1])
-            LOGGER.debug('recursive')
-            self.get_collections(dv[1], output)
+        try:
+            return (child['title'], self.__get_shortname(child['id']))
+        except Exception as e:
+            obscure_error = f'''
+                                An error has occured where a collection can be
+                                identified by ID but its name cannot be determined.
+                                This is (normally) caused by a configuration error where
+                                administrator permissions are not correctly inherited by
+                                the child collection.
+
+                                Please check with the system administrator to determine
+                                any exact issues.
+
+                                Problematic collection id number: {child.get("id",
+                                "not available")}'''
+            #to sys.stdout?
+            print(50*'-', file=sys.stderr)
+            print(textwrap.dedent(obscure_error), file=sys.stderr)
+            print(e)
+            LOGGER.error(textwrap.fill(textwrap.dedent(obscure_error).strip()))
+            traceback.print_exc()
+            print(50*'-', file=sys.stderr)
+            raise e
+
+    def get_collections(self, coll:str=None, output=None)->list:#pylint: disable=unused-argument
+        '''
+        Get a [recursive] listing of all dataverses in a collection.
+
+        Parameters
+        ----------
+        coll : str, optional, default=None
+            Collection short name or id
+        output : list, optional, default=[]
+            output list to append to
+
+        Notes
+        -----
+        The tree is crawled breadth-first, one level at a time, with up to
+        `workers` requests at once. The listing is in the same order as
+        a one-at-a-time depth-first crawl.
+
+        Short names come from the search API where possible. Collections
+        it can't identify are looked up individually. The contents of
+        each collection are kept for `get_studies`.
+        '''
+        if not output:
+            output = []
+        if not coll:
+            coll = self.coll
+        children = {}
+        self.__contents = {}
+        #One search instead of a request for each collection's short name
+        self.__aliases = self.__search_aliases(self.__get_shortname(coll)
+                                               if str(coll).isdigit() else coll)
+        level = [coll]
+        while level:
+            LOGGER.debug('Crawling %s collection(s)', len(level))
+            contents = self.__map(self.__get_contents, level)
+            kids = [[(parent, _) for _ in data if _['type'] == 'dataverse']
+                    for parent, data in zip(level, contents)]
+            found = iter(self.__map(self.__get_child, [_ for k in kids for _ in k]))
+            for parent, kid in zip(level, kids):
+                children[parent] = [next(found) for _ in kid]
+            level = [_[1] for parent in level for _ in children[parent]]
+        if coll == self.coll:
+            self.__contents.setdefault(self.root[1], self.__contents[coll])
+        #Each collection's children, followed by each child's own listing
+        stack = [coll]
+        while stack:
+            dvs = children[stack.pop()]
+            output.extend(dvs)
+            stack.extend(reversed([_[1] for _ in dvs]))
         self.collections = output
         if self.root not in self.collections:
             self.collections.insert(0, self.root)
@@ -274,54 +462,309 @@ class DvCollection:
         root : str
             Short name or id of *top* level of tree. Default self.coll
         '''
-        all_studies = []
+        self.studies = list(self.iter_studies(root))
+        return self.studies
+
+    def iter_studies(self, root:str=None)->typing.Generator:
+        '''
+        Yield StudyMetadata for every study in a collection tree as it's
+        downloaded, in the same order as `get_studies`.
+
+        Parameters
+        ----------
+        root : str
+            Short name or id of *top* level of tree. Default self.coll
+
+        Notes
+        -----
+        The collections and their study listings are fetched first. After
+        that, each study can be used (and discarded) while the next ones
+        are downloaded, so that memory use doesn't grow with the size of
+        the collection. self.studies is not set.
+        '''
         if not root:
             root=self.coll
         #Redundant, as root is now added to get_collections
         #all_studies = self.get_collection_listing(root)
-        all_studies = []
         collections = self.get_collections(root)
-        for collection in tqdm.tqdm(collections,
-                             desc='collections',
-                             unit='collection',
-                             leave=False,
-                             bar_format=BAR_FORMAT):
-            all_studies.extend(self.get_collection_listing(collection[1]))
-        self.studies = all_studies
-        return all_studies
+        listings = self.__map(self.__get_pids, [_[1] for _ in collections],
+                              desc='collections',
+                              unit='collection',
+                              leave=False,
+                              bar_format=BAR_FORMAT)
+        yield from self.__iter_studies([_ for listing in listings for _ in listing],
+                                       desc='studies')
 
-    def get_collection_listing(self, coll_id):
+    def search_studies(self, root:str=None, **kwargs)->list:
         '''
-        Return a listing of studies in a collection, with pid.
+        Return StudyMetadata for every study in a collection tree, using
+        the search API instead of crawling the collections.
+
+        Parameters
+        ----------
+        root : str, optional
+            Short name or id of *top* level of tree. Default self.coll
+
+        **kwargs : dict
+            Other parameters
+
+        Other parameters
+        ----------------
+        blocks : list, optional, default=['citation']
+            Metadata blocks to request from the search index
+
+        require : list, optional
+            Study level fields (eg. 'licence') which must be present.
+            Studies missing any of them in the search index are fetched
+            individually.
+
+        per_page : int, optional, default=1000
+            Number of studies per search request (maximum 1000)
+
+        complete : bool, optional
+            Use the search only to find the studies, and fetch the
+            complete metadata of each one, `workers` at a time. Use this
+            if file metadata is wanted for every study anyway.
+
+        Notes
+        -----
+        The search index doesn't contain file information, licences or
+        terms of use, so those aren't available unless `complete` is set.
+        Otherwise, file metadata for a study (`files`, `all_files`) is
+        fetched from the study when it is used, which also fills in the
+        remaining study level fields.
+
+        The search index may lag slightly behind the Dataverse
+        installation, and deaccessioned studies aren't listed.
+        '''
+        complete = kwargs.get('complete')
+        found = self.__search_datasets(root,
+                                       [] if complete else kwargs.get('blocks') or ['citation'],
+                                       kwargs.get('per_page', 1000))
+        studies = {}
+        fetch = []
+        for pid, item in found.items():
+            info = {'collection_name': item.get('name_of_dataverse'),
+                    'collection_short_name': item.get('identifier_of_dataverse')}
+            meta = None if complete else self.__search_meta(item)
+            if not meta:
+                fetch.append((pid, info))
+                continue
+            stud = StudyMetadata(study_meta=meta, key=self.__key, url=self.url,
+                                 session=self.session, **info)
+            if any(_ not in stud for _ in kwargs.get('require', [])):
+                fetch.append((pid, info))
+                continue
+            stud.update({'pid': pid})
+            studies[pid] = stud
+        LOGGER.debug('%s studies from search, %s fetched individually',
+                     len(studies), len(fetch))
+        if fetch:
+            studies.update(zip([_[0] for _ in fetch],
+                               self.__get_studies(fetch, desc='studies')))
+        self.studies = [studies[_] for _ in found]
+        return self.studies
+
+    def __search_datasets(self, root:str=None, blocks:list=None, per_page:int=1000)->dict:
+        '''
+        Returns {pid: search result} for every study in a collection tree
+
+        Parameters
+        ----------
+        root : str, optional
+            Short name or id of *top* level of tree. Default self.coll
+        blocks : list, optional
+            Metadata blocks to include in the results
+        per_page : int, optional, default=1000
+            Number of studies per search request (maximum 1000)
+        '''
+        if not root:
+            root = self.coll
+        alias = self.__get_shortname(root) if str(root).isdigit() else root
+        found = {}
+        start = 0
+        with tqdm.tqdm(desc='search', unit='study', leave=False,
+                       bar_format=BAR_FORMAT) as pbar:
+            while True:
+                self.limit.rate_limit()
+                page = self.session.get(f'{self.url}/api/search',
+                                        params={'q': '*', 'type': 'dataset',
+                                                'subtree': alias,
+                                                'metadata_fields': [f'{_}:*'
+                                                                    for _ in blocks or []],
+                                                'show_entity_ids': 'true',
+                                                'sort': 'date', 'order': 'asc',
+                                                'per_page': min(per_page, 1000),
+                                                'start': start},
+                                        headers=self.headers,
+                                        timeout=self.kwargs.get('timeout', 15))
+                page.raise_for_status()
+                data = page.json()['data']
+                pbar.total = data['total_count']
+                for item in data['items']:
+                    #Draft and published versions are separate search results.
+                    #Like the dataset API, use the draft if it's visible.
+                    if (item['global_id'] not in found
+                        or item.get('versionState') == 'DRAFT'):
+                        found[item['global_id']] = item
+                pbar.update(len(data['items']))
+                start += len(data['items'])
+                if not data['items'] or start >= data['total_count']:
+                    break
+        return found
+
+    def refresh_studies(self, known:dict=None, root:str=None)->dict:
+        '''
+        Find the studies in a collection tree which have been added or
+        changed since an earlier harvest, and those which have gone.
+
+        Parameters
+        ----------
+        known : dict, optional
+            {pid: update statement} from an earlier harvest, ie. the
+            `updated` value returned last time. If empty, every study
+            is treated as new.
+        root : str, optional
+            Short name or id of *top* level of tree. Default self.coll
+
+        Returns
+        -------
+        dict
+            changed : list of StudyMetadata for added or changed studies
+            removed : list of pids of studies no longer in the tree
+            updated : {pid: update statement} for every study, to be
+                      supplied as `known` next time
+
+        Notes
+        -----
+        Update times and versions come from the search API, a thousand
+        studies per request, so only the changed studies are downloaded.
+        Complete metadata is fetched for those, as with `get_studies`,
+        and self.studies is set to them.
+
+        The search index may lag slightly behind the Dataverse
+        installation, in which case a change is found on a later run.
+        Deaccessioned studies aren't listed, so they are reported as
+        removed.
+        '''
+        known = known or {}
+        found = self.__search_datasets(root)
+        updated = {pid: f"{item.get('updatedAt')} {item.get('versionState')} "
+                        f"{item.get('majorVersion')}.{item.get('minorVersion')}"
+                   for pid, item in found.items()}
+        fetch = [(pid, {'collection_name': item.get('name_of_dataverse'),
+                        'collection_short_name': item.get('identifier_of_dataverse')})
+                 for pid, item in found.items() if known.get(pid) != updated[pid]]
+        removed = [_ for _ in known if _ not in found]
+        LOGGER.info('%s studies: %s added or changed, %s removed',
+                    len(found), len(fetch), len(removed))
+        self.studies = self.__get_studies(fetch, desc='studies') if fetch else []
+        return {'changed': self.studies, 'removed': removed, 'updated': updated}
+
+    def __search_meta(self, item:dict)->dict:
+        '''
+        Returns study metadata in the form of the dataset API from a
+        search result, or None if the result doesn't have enough
+        information.
+
+        Parameters
+        ----------
+        item : dict
+            A dataset from the search API
+        '''
+        if not (item.get('entity_id') and item.get('metadataBlocks')):
+            return None
+        protocol, rest = item['global_id'].split(':', 1)
+        authority, identifier = rest.split('/', 1)
+        version = {'versionState': item.get('versionState'),
+                   'createTime': item.get('createdAt'),
+                   'lastUpdateTime': item.get('updatedAt'),
+                   'releaseTime': item.get('published_at'),
+                   'metadataBlocks': item['metadataBlocks']}
+        if item.get('majorVersion') is not None:
+            version.update({'versionNumber': item['majorVersion'],
+                            'versionMinorNumber': item.get('minorVersion', 0)})
+        return {'status': 'OK',
+                'data': {'id': item['entity_id'],
+                         'protocol': protocol,
+                         'authority': authority,
+                         'identifier': identifier,
+                         'persistentUrl': item.get('url'),
+                         'publisher': item.get('publisher'),
+                         'latestVersion': version}}
+
+    def __get_pids(self, coll_id)->list:
+        '''
+        Return a list of (pid, collection info) for the studies in a collection
 
         Parameters
         ----------
         coll_id : str
             Short name or id of a dataverse collection
         '''
-        self.limit.rate_limit()
-        cl = self.session.get(f'{self.url}/api/dataverses/{coll_id}/contents',
-                               headers=self.headers,
-                               timeout=self.kwargs.get('timeout', 15))
-        cl.raise_for_status()
+        data = self.__contents.get(coll_id)
+        if data is None:
+            self.limit.rate_limit()
+            cl = self.session.get(f'{self.url}/api/dataverses/{coll_id}/contents',
+                                   headers=self.headers,
+                                   timeout=self.kwargs.get('timeout', 15))
+            cl.raise_for_status()
+            data = cl.json()['data']
         pids = [f"{z['protocol']}:{z['authority']}/{z['identifier']}"
-                for z in cl.json()['data'] if z['type'] == 'dataset']
+                for z in data if z['type'] == 'dataset']
         #Pass collection info into the study because that's not available from
         #a metadata download
         smkwargs = [{'collection_name':_[0] , 'collection_short_name':_[1]}
                     for _ in self.collections if coll_id == _[1]][0]
-        #out = [(self.get_study_info(pid, **smkwargs), pid) for pid in pids]
-        out = []
-        for pid in tqdm.tqdm(pids,
-                             desc=smkwargs.get('collection_short_name', 'collection'),
-                             unit='study',
-                             leave=False,
-                             colour='red',
-                             bar_format=BAR_FORMAT):
-            out.append((self.get_study_info(pid, **smkwargs), pid))
-        for _ in out:
-            _[0].update({'pid': _[1]})
-        return [x[0] for x in out]
+        return [(pid, smkwargs) for pid in pids]
+
+    def __get_studies(self, jobs:list, desc:str)->list:
+        '''
+        Return StudyMetadata objects for a list of (pid, collection info)
+
+        Parameters
+        ----------
+        jobs : list
+            (pid, collection info) tuples
+        desc : str
+            Progress bar description
+        '''
+        return list(self.__iter_studies(jobs, desc))
+
+    def __iter_studies(self, jobs:list, desc:str)->typing.Generator:
+        '''
+        Yield StudyMetadata objects for a list of (pid, collection info)
+        as they are downloaded
+
+        Parameters
+        ----------
+        jobs : list
+            (pid, collection info) tuples
+        desc : str
+            Progress bar description
+        '''
+        out = self.__imap(lambda job: self.get_study_info(job[0], **job[1]), jobs,
+                          desc=desc,
+                          unit='study',
+                          leave=False,
+                          colour='red',
+                          bar_format=BAR_FORMAT)
+        for stud, job in zip(out, jobs):
+            stud.update({'pid': job[0]})
+            yield stud
+
+    def get_collection_listing(self, coll_id):
+        '''
+        Return a listing of studies in a collection, with pid.
+
+        Parameters
+        ----------
+        coll_id : str
+            Short name or id of a dataverse collection
+        '''
+        jobs = self.__get_pids(coll_id)
+        return self.__get_studies(jobs, jobs[0][1].get('collection_short_name', 'collection')
+                                  if jobs else 'collection')
 
     def get_study_info(self, pid, **kwargs):
         '''
@@ -365,6 +808,10 @@ class StudyMetadata(dict):
         study_meta : dict, optional
             The dataverse study metadata JSON
 
+        all_versions : dict, optional
+            The JSON from the dataset versions API. If not supplied it is
+            fetched when versions or files from all versions are needed.
+
         url :  str, optional
             Base URL to dataverse instance
 
@@ -393,18 +840,24 @@ class StudyMetadata(dict):
         if either a draft study is being accessed or the Dataverse installation
         requires API keys for all requests.
 
-        The rate limiter will wait for a random interval between
-        rate_limit_min and rate_limit_max. Obviously, if you want
-        a constant interval, set them to be equal.
+        Requests are limited to an average of one every
+        (rate_limit_min + rate_limit_max) / 2 seconds, shared with everything
+        else making requests to the same host. See `RateLimiter`.
 
         '''
         self.kwargs = kwargs
         self.session = kwargs.get('session', requests.Session())
-        self.session.mount('https://',
-                           requests.adapters.HTTPAdapter(max_retries=RETRY))
+        #Don't replace an adapter which already retries, as with a session
+        #shared by a collection crawl; its connection pool is in use
+        if not self.session.get_adapter('https://').max_retries.total:
+            self.session.mount('https://',
+                               requests.adapters.HTTPAdapter(max_retries=RETRY))
         self.limit = RateLimiter(**kwargs)
         self.study_meta  = kwargs.get('study_meta')
-        self.all_versions = kwargs.get('all_versions')
+        #Version history is only fetched if it's used
+        self.__all_versions = (kwargs['all_versions']
+                               if isinstance(kwargs.get('all_versions'), dict) else None)
+        self.__index = None
         self.url = kwargs.get('url')
         self.pid = kwargs.get('pid')
         #If only there would be an easy way to check if something was deaccessioned
@@ -427,8 +880,8 @@ class StudyMetadata(dict):
         if not (('study_meta' in kwargs) or ('url' in kwargs and 'pid' in kwargs)):
             raise TypeError('At least one of a URL/pid combo (url, pid) (and possibly key) or '
             'study metadata json (study_meta) is required.')
-        if not self.study_meta or not self.all_versions:
-            self.study_meta, self.all_versions = self.__obtain_metadata()
+        if not self.study_meta:
+            self.study_meta = self.__obtain_metadata()
         try:
             self.update(self.extract_metadata(self.study_meta['data']['latestVersion']))
         except KeyError as e:
@@ -448,11 +901,16 @@ class StudyMetadata(dict):
                                f'Offending JSON: {self.study_meta}') from e
         self.__files = None
         self.__all_files = None
-        self.index = {_: n for n, _ in enumerate(self.versions)}
 
-    def __obtain_metadata(self):
+    def __obtain_metadata(self, endpoint:str=''):
         '''
         Obtain study metadata as required.
+
+        Parameters
+        ----------
+        endpoint : str, optional, default=''
+            Part of the dataset API after :persistentId, eg. '/versions'.
+            The default is the study metadata.
         '''
         if self.kwargs.get('key'):
             self.headers.update({'X-Dataverse-key':self.kwargs['key']})
@@ -461,20 +919,38 @@ class StudyMetadata(dict):
         if not self.url.startswith('https://'):
             self.url = f'https://{self.url}'
         self.limit.rate_limit()
-        LOGGER.debug('Attempting %s/api/datasets/, params %s, headers %s',
-                     self.url, params, self.headers)
-        data = self.session.get(f'{self.url}/api/datasets/:persistentId',
+        LOGGER.debug('Attempting %s/api/datasets/:persistentId%s, params %s, headers %s',
+                     self.url, endpoint, params, self.headers)
+        data = self.session.get(f'{self.url}/api/datasets/:persistentId{endpoint}',
                                 headers=self.headers, params=params,
                                 timeout=self.kwargs.get('timeout', 15))
         data.raise_for_status()
-        self.limit.rate_limit()
-        LOGGER.debug('Attempting %s/api/datasets/:persistentId/versions, params %s, headers %s',
-                     self.url, params, self.headers)
-        all_versions = self.session.get(f'{self.url}/api/datasets/:persistentId/versions',
-                                        headers=self.headers, params=params,
-                                        timeout=self.kwargs.get('timeout', 15))
-        all_versions.raise_for_status()
-        return data.json(), all_versions.json()
+        return data.json()
+
+    @property
+    def all_versions(self)->dict:
+        '''
+        Return the study metadata JSON for *all* versions. This is
+        only requested from the Dataverse installation when first used.
+        '''
+        if self.__all_versions is None:
+            self.__all_versions = self.__obtain_metadata('/versions')
+        return self.__all_versions
+
+    @all_versions.setter
+    def all_versions(self, value:dict):
+        self.__all_versions = value
+        self.__index = None
+        self.__all_files = None
+
+    @property
+    def index(self)->dict:
+        '''
+        Return a dict of {version statement: position in all_versions}
+        '''
+        if self.__index is None:
+            self.__index = {_: n for n, _ in enumerate(self.versions)}
+        return self.__index
 
     def __has_metadata(self)->bool:
         '''
@@ -736,11 +1212,23 @@ class StudyMetadata(dict):
         #That bothers me on an intellectual level. Therefore, it will be attribute.
         #Iterate over StudyMetadata.files if you want to know the contents
         if not self.__files and not self.deaccession_flag:
+            self.__complete()
             self.__files = self.extract_files(self.study_meta['data']
                                                    ['latestVersion']['files'])
         if self.deaccession_flag:
             self.__files = []
 
+    def __complete(self):
+        '''
+        Replace metadata from the search index, which has no file
+        information, with the complete study metadata.
+        '''
+        if 'files' in self.study_meta['data']['latestVersion']:
+            return
+        LOGGER.debug('Fetching complete metadata for %s', self.pid)
+        self.study_meta = self.__obtain_metadata()
+        self.update(self.extract_metadata(self.study_meta['data']['latestVersion']))
+
     def __extract_licence_info(self, indict)->dict:
         '''
         Extract all the licence information fields and add them
@@ -1265,9 +1753,9 @@ class FileAnalysis(dict):
         Either `local` must be supplied, or `url`, `key` and at least one of
         `id` or `pid` must be supplied
 
-        The rate limiter will wait for a random interval between
-        rate_limit_min and rate_limit_max. Obviously, if you want
-        a constant interval, set them to be equal.
+        Requests are limited to an average of one every
+        (rate_limit_min + rate_limit_max) / 2 seconds, shared with everything
+        else making requests to the same host. See `RateLimiter`.
 
         '''
         #pylint disable=too-many-instance-attributes
@@ -3,23 +3,46 @@ A collection of Dataverse utilities for file and metadata
 manipulation
 '''
 
-import csv
-import io
+import atexit
+import contextlib
 #Dataverse/Glassfish can sometimes partially crash and the
 #API doesn't return JSON correctly, so:
 import json
 import logging
 import mimetypes
 import os
+import re
 #import sys
+import threading
 import time
 
 import requests
-from requests_toolbelt.multipart.encoder import MultipartEncoder
+from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
+from urllib3.util import Retry
 import dataverse_utils
+from dataverse_utils import throttle
+#Manifest and checksum functions used to live here
+from dataverse_utils.manifest import walk_files, write_tsv, make_tsv, dump_tsv#pylint: disable=unused-import
+from dataverse_utils.streams import file_digest, digest_files, HashingReader#pylint: disable=unused-import
+from dataverse_utils.streams import _IterStream, _multipart_stream
 LOGGER = logging.getLogger(__name__)
+#POST is deliberately excluded, as a retried add can duplicate a file
+UPLOAD_RETRY = throttle.Retry(total=5,
+                              status_forcelist=[429, 502, 503, 504],
+                              allowed_methods=['HEAD', 'GET', 'OPTIONS', 'PUT', 'DELETE'],
+                              backoff_factor=1)
+SESSION = None
+_SESSION_LOCK = threading.Lock()
+#Per-thread upload statistics, see _measure
+_STATS = threading.local()
 #A list of extensions which disable tabular processing
 NOTAB = ['.sav', '.por', '.zip', '.csv', '.tsv', '.dta', '.rdata', '.xlsx']
+#A list of extensions which may trigger tabular ingest (and a study lock)
+INGEST = ['.sav', '.por', '.csv', '.tsv', '.dta', '.rdata', '.rda', '.xlsx']
+#Dataverse's refusal when a study is locked, eg. 'Dataset cannot be edited due to dataset lock.'
+LOCK_REFUSAL = re.compile(r'cannot be edited due to .*\block\b', re.IGNORECASE)
+#Dataverse checksum types and their hashlib equivalents
+CHECKSUM_TYPES = {'MD5': 'md5', 'SHA-1': 'sha1', 'SHA-256': 'sha256', 'SHA-512': 'sha512'}
 
 
 class DvGeneralUploadError(Exception):
@@ -32,166 +55,126 @@ class Md5Error(Exception):
     Raised on md5 mismatch
     '''
 
-def _make_info(dv_url, study, apikey) -> tuple:
+def make_session(pool_maxsize:int=10, retry:Retry=None) -> requests.Session:
     '''
-    Returns correctly formated headers and URLs for a request
+    Returns a requests session with a connection pool and retry strategy
+    mounted for both http and https.
 
     Parameters
     ----------
-    study : str
-        Study handle or file ID
-
-    dv_url : str
-        URL to base dataverse instance
+    pool_maxsize : int, optional, default=10
+        Maximum number of connections kept open per host. Use at least
+        the number of concurrent upload workers.
 
-    apikey : str
-        Dataverse API key
+    retry : urllib3.util.Retry, optional
+        Retry strategy. Defaults to UPLOAD_RETRY
     '''
-    if dv_url.endswith('/'):
-        dv_url = dv_url[:-1]
-    headers = {'X-Dataverse-key': apikey}
-    headers.update(dataverse_utils.UAHEADER)
-    params = {'persistentId': study}
-    return (dv_url, headers, params)
-
-def make_tsv(start_dir, in_list=None, def_tag='Data',
-             inc_header=True,
-             mime=False,
-             quotype=csv.QUOTE_MINIMAL,
-             **kwargs) -> str:
-    # pylint: disable=too-many-positional-arguments
-    # pylint: disable=too-many-arguments
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_maxsize,
+                                            pool_maxsize=pool_maxsize,
+                                            max_retries=retry if retry else UPLOAD_RETRY)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_session() -> requests.Session:
     '''
-    Recurses the tree for files and produces tsv output with
-    with headers 'file', 'description', 'tags'.
-
-    The 'description' is the filename without an extension.
-
-    Returns tsv as string.
+    Returns the shared, module-level session used by the upload functions,
+    creating it if required. It is closed when the interpreter exits.
+    '''
+    global SESSION #pylint: disable=global-statement
+    with _SESSION_LOCK:
+        if SESSION is None:
+            SESSION = make_session()
+            atexit.register(SESSION.close)
+    return SESSION
+
+def session_stats(session:requests.Session=None) -> dict:
+    '''
+    Returns connection reuse counters for a session as a dict with
+    keys 'requests', 'connections' and 'reused'. 'connections' is the
+    number of new TCP (and TLS) connections which were opened.
 
     Parameters
     ----------
-    start_dir : str
-        Path to start directory
-
-    in_list : list
-        Input file list. Defaults to recursive walk of current directory.
+    session : requests.Session, optional
+        Session to inspect. Defaults to the shared session.
+    '''
+    if not session:
+        session = get_session()
+    out = {'requests': 0, 'connections': 0}
+    for adapter in set(session.adapters.values()):
+        pools = getattr(adapter, 'poolmanager', None)
+        if not pools:
+            continue
+        for key in pools.pools.keys():
+            pool = pools.pools.get(key)
+            if pool:
+                out['requests'] += pool.num_requests
+                out['connections'] += pool.num_connections
+    out['reused'] = out['requests'] - out['connections']
+    return out
+
+def _count_request(response, *args, **kwargs):#pylint: disable=unused-argument
+    '''
+    Response hook which counts requests against the statistics
+    being collected in the current thread.
 
-    def_tag : str
-        Default Dataverse tag (eg, Data, Documentation, etc)
-        Separate tags with a comma:
-        eg. ('Data, 2016')
+    Parameters
+    ----------
+    response : requests.Response
+        Response from the Dataverse API
+    '''
+    stats = getattr(_STATS, 'current', None)
+    if stats is not None:
+        stats['requests'] = stats.get('requests', 0) + 1
 
-    inc_header : bool
-        Include header row
+@contextlib.contextmanager
+def _measure(stats:dict, key:str):
+    '''
+    Context manager which adds the elapsed time to stats[key]. Requests
+    made in the meantime by this thread are counted in stats['requests'].
 
-    mime : bool
-        Include automatically determined mimetype
+    Parameters
+    ----------
+    stats : dict
+        Statistics dict
 
-    quotype: int
-        integer value or csv quote type.
-        Default = csv.QUOTE_MINIMAL
-        Acceptable values:
-        csv.QUOTE_MINIMAL / 0
-        csv.QUOTE_ALL / 1
-        csv.QUOTE_NONNUMERIC / 2
-        csv.QUOTE_NONE / 3
+    key : str
+        Key to which elapsed seconds are added
+    '''
+    previous = getattr(_STATS, 'current', None)
+    _STATS.current = stats
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats[key] = stats.get(key, 0) + time.perf_counter() - start
+        _STATS.current = previous
 
-    **kwargs : dict
-        Other parameters
 
-    Other parameters
-    ----------------
-    path : bool
-        If true include a 'path' field so that you can type
-        in a custom path instead of actually structuring
-        your data
-
-    '''
-    if start_dir.endswith(os.sep):
-        #start_dir += os.sep
-        start_dir = start_dir[:-1]
-    if not in_list:
-        in_list = [f'{x[0]}{os.sep}{y}'
-                   for x in os.walk(start_dir)
-                   for y in x[2]
-                   if not y.startswith('.')]
-    if isinstance(in_list, set):
-        in_list=list(in_list)
-    in_list.sort()
-    def_tag = ", ".join([x.strip() for x in def_tag.split(',')])
-    headers = ['file', 'description', 'tags']
-    if mime:
-        headers.append('mimetype')
-    if kwargs.get('path'):
-        headers.insert(1, 'path')
-    outf = io.StringIO(newline='')
-    tsv_writer = csv.DictWriter(outf, delimiter='\t',
-                                quoting=quotype,
-                                fieldnames=headers,
-                                extrasaction='ignore')
-    if inc_header:
-        tsv_writer.writeheader()
-    for row in in_list:
-        #the columns
-        r = {}
-        r['file'] = row
-        r['description'] = os.path.splitext(os.path.basename(row))[0]
-        r['mimetype'] = mimetypes.guess_type(row)[0]
-        r['tags'] = def_tag
-        r['path'] =  ''
-        tsv_writer.writerow(r)
-    outf.seek(0)
-    outfile = outf.read()
-    outf.close()
-
-    return outfile
-
-def dump_tsv(start_dir, filename, in_list=None,
-             **kwargs):
-    '''
-    Dumps output of make_tsv manifest to a file.
+def _make_info(dv_url, study, apikey) -> tuple:
+    '''
+    Returns correctly formated headers and URLs for a request
 
     Parameters
     ----------
-    start_dir : str
-        Path to start directory
-
-    in_list : list
-        List of files for which to create manifest entries. Will
-        default to recursive directory crawl
-
-    **kwargs : dict
-        Other parameters
-
-    Other parameters
-    ----------------
-    def_tag : str, optional, default='Data'
-        Default Dataverse tag (eg, Data, Documentation, etc).
-        Separate tags with an easily splitable character:
-        eg. ('Data, 2016')
+    study : str
+        Study handle or file ID
 
-    inc_header : bool, optional, default=True
-        Include header for tsv.
+    dv_url : str
+        URL to base dataverse instance
 
-    quotype : int, optional, default=csv.QUOTE_MINIMAL
-        integer value or csv quote type.
-        Acceptable values:
-        * csv.QUOTE_MINIMAL / 0
-        * csv.QUOTE_ALL / 1
-        * csv.QUOTE_NONNUMERIC / 2
-        * csv.QUOTE_NONE / 3
+    apikey : str
+        Dataverse API key
     '''
+    if dv_url.endswith('/'):
+        dv_url = dv_url[:-1]
+    headers = {'X-Dataverse-key': apikey}
+    headers.update(dataverse_utils.UAHEADER)
+    params = {'persistentId': study}
+    return (dv_url, headers, params)
 
-    def_tag= kwargs.get('def_tag', 'Data')
-    inc_header =kwargs.get('inc_header', True)
-    mime = kwargs.get('mime', False)
-    path = kwargs.get('path', False)
-    quotype = kwargs.get('quotype', csv.QUOTE_MINIMAL)
-
-    dumper = make_tsv(start_dir, in_list, def_tag, inc_header, mime, quotype, path=path)
-    with open(filename, 'w', newline='', encoding='utf-8') as tsvfile:
-        tsvfile.write(dumper)
 
 def file_path(fpath, trunc='') -> str:
     '''
@@ -230,7 +213,8 @@ def file_path(fpath, trunc='') -> str:
     except ValueError:
         return ''
 
-def check_lock(dv_url, study, apikey) -> bool:
+
+def check_lock(dv_url, study, apikey, session=None) -> bool:
     '''
     Checks study lock status; returns True if locked.
 
@@ -244,11 +228,15 @@ def check_lock(dv_url, study, apikey) -> bool:
 
     apikey : str
         API key for user
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
     '''
     dv_url, headers, params = _make_info(dv_url, study, apikey)
-    lock_status = requests.get(f'{dv_url}/api/datasets/:persistentId/locks',
-                               headers=headers,
-                               params=params, timeout=300)
+    session = session if session else get_session()
+    lock_status = session.get(f'{dv_url}/api/datasets/:persistentId/locks',
+                              headers=headers,
+                              params=params, timeout=300)
     lock_status.raise_for_status()
     data = lock_status.json().get('data')
     if data:
@@ -257,7 +245,82 @@ def check_lock(dv_url, study, apikey) -> bool:
         return True
     return False
 
-def force_notab_unlock(study, dv_url, fid, apikey, try_uningest=True) -> int:
+def wait_for_unlock(dv_url, study, apikey, lock=None, interval=10,#pylint: disable=too-many-arguments, too-many-positional-arguments
+                    session=None) -> None:
+    '''
+    Blocks until a study is no longer locked.
+
+    Parameters
+    ----------
+    dv_url : str
+        URL of Dataverse installation
+
+    study: str
+        Persistent ID of study
+
+    apikey : str
+        API key for user
+
+    lock : threading.Lock, optional
+        If supplied, the wait is serialized so that concurrent uploads
+        to the same study don't all poll the lock endpoint at once
+
+    interval : int, optional, default=10
+        Seconds between lock checks
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
+    '''
+    with lock if lock else contextlib.nullcontext():
+        while check_lock(dv_url, study, apikey, session):
+            time.sleep(interval)
+
+def _is_lock_refusal(response) -> bool:
+    '''
+    Returns True if Dataverse refused a request because the study is locked.
+
+    Parameters
+    ----------
+    response : requests.Response
+        Response from the Dataverse API
+    '''
+    if response.status_code == 423:
+        return True
+    if response.status_code not in (400, 403, 409):
+        return False
+    return bool(LOCK_REFUSAL.search(response.text))
+
+def dataset_files(dv_url, study, apikey, session=None, version=':latest') -> list:
+    '''
+    Returns the list of file metadata for a study version, as
+    supplied by the Dataverse API.
+
+    Parameters
+    ----------
+    dv_url : str
+        URL of Dataverse installation
+
+    study: str
+        Persistent ID of study
+
+    apikey : str
+        API key for user
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
+
+    version : str, optional, default=':latest'
+        Study version. ':latest' includes any draft.
+    '''
+    dv_url, headers, params = _make_info(dv_url, study, apikey)
+    session = session if session else get_session()
+    files = session.get(f'{dv_url}/api/datasets/:persistentId/versions/{version}/files',
+                        headers=headers, params=params, timeout=300)
+    files.raise_for_status()
+    return files.json().get('data', [])
+
+def force_notab_unlock(study, dv_url, fid, apikey, try_uningest=True,#pylint: disable=too-many-arguments, too-many-positional-arguments
+                       session=None) -> int:
     '''
     Forcibly unlocks and uningests
     to prevent tabular file processing. Required if mime and filename
@@ -282,19 +345,23 @@ def force_notab_unlock(study, dv_url, fid, apikey, try_uningest=True) -> int:
     try_uningest : bool
         Try to uningest the file that was locked.
         Default: True
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
     '''
     dv_url, headers, params = _make_info(dv_url, study, apikey)
-    force_unlock = requests.delete(f'{dv_url}/api/datasets/:persistentId/locks',
-                                   params=params, headers=headers,
-                                   timeout=300)
+    session = session if session else get_session()
+    force_unlock = session.delete(f'{dv_url}/api/datasets/:persistentId/locks',
+                                  params=params, headers=headers,
+                                  timeout=300)
     LOGGER.warning('Lock removed for %s', study)
     LOGGER.warning('Lock status:\n %s', force_unlock.json())
     if try_uningest:
-        uningest_file(dv_url, fid, apikey, study)
+        uningest_file(dv_url, fid, apikey, study, session)
         return int(fid)
     return 0
 
-def uningest_file(dv_url, fid, apikey, study='n/a'):
+def uningest_file(dv_url, fid, apikey, study='n/a', session=None):
     '''
     Tries to uningest a file that has been ingested.
     Requires superuser API key.
@@ -312,30 +379,70 @@ def uningest_file(dv_url, fid, apikey, study='n/a'):
 
     study : str, optional
         Optional handle parameter for log messages
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
     '''
     dv_url, headers, params = _make_info(dv_url, fid, apikey)
+    session = session if session else get_session()
     fid = params['persistentId']
     #TODONE: Awaiting answer from Harvard on how to remove progress bar
     #for uploaded tab files that squeak through.
     #Answer: you can't!
     try:
-        uningest = requests.post(f'{dv_url}/api/files/{fid}/uningest',
-                                 headers=headers,
-                                 timeout=300)
+        uningest = session.post(f'{dv_url}/api/files/{fid}/uningest',
+                                headers=headers,
+                                timeout=300)
         LOGGER.warning('Ingest halted for file %s for fileID %s', fid, study)
         uningest.raise_for_status()
     except requests.exceptions.HTTPError:
         LOGGER.error('Uningestion error: %s', uningest.reason)
         print(uningest.reason)
 
+
+def _upload_names(name, **kwargs) -> tuple:
+    '''
+    Returns the file name to send, the file name to display and the
+    mimetype for an upload. Files which Dataverse would otherwise
+    process (see NOTAB) are sent with a .NOPROCESS suffix as
+    application/octet-stream.
+
+    Parameters
+    ----------
+    name : str
+        File name or path
+
+    **kwargs : dict
+        Parameters for `upload_file`; 'override' and 'mimetype' are used
+    '''
+    if os.path.splitext(name)[1].lower() in NOTAB and not kwargs.get('override'):
+        file_name_clean = os.path.basename(name)
+        #file_name = os.path.basename(fpath) + '.NOPROCESS'
+        # using .NOPROCESS doesn't seem to work?
+        file_name = os.path.basename(name) + '.NOPROCESS'
+    else:
+        file_name = os.path.basename(name)
+        file_name_clean = file_name
+    #My workstation python on Windows produces null for isos for some reason
+    if mimetypes.guess_type('test.iso') == (None, None):
+        mimetypes.add_type('application/x-iso9660-image', '.iso')
+    mime = mimetypes.guess_type(name)[0]
+    if kwargs.get('mimetype'):
+        mime = kwargs['mimetype']
+    if file_name.endswith('.NOPROCESS') or mime == 'application/zip':
+        mime = 'application/octet-stream'
+    return file_name, file_name_clean, mime
+
 def upload_file(fpath, hdl, **kwargs):
     '''
     Uploads file to Dataverse study and sets file metadata and tags.
 
     Parameters
     ----------
-    fpath : str
-        file location (ie, complete path)
+    fpath : str, file or iterable
+        file location (ie, complete path). A readable binary stream or
+        an iterable of bytes (eg. requests.Response.iter_content())
+        may be used instead, in which case `label` is required.
 
     hdl : str
         Dataverse persistent ID for study (handle or DOI)
@@ -352,12 +459,20 @@ def upload_file(fpath, hdl, **kwargs):
     apikey : str, required
         API key for user
 
+    size : int, optional
+        Length in bytes of a stream. If a stream's length isn't known,
+        it is sent using chunked transfer encoding.
+
     descr : str, optional
         File description
 
     md5 : str, optional
         md5sum for file checking
 
+    sha256 : str, optional
+        sha256 digest for file checking. Only checked if the Dataverse
+        installation uses SHA-256 checksums.
+
     tags : list, optional
         list of text file tags. Eg ['Data', 'June 2020']
 
@@ -388,28 +503,91 @@ def upload_file(fpath, hdl, **kwargs):
 
     override : bool, optional
         Ignore NOTAB (ie, NOTAB = [])
+
+    lock : threading.Lock, optional
+        Lock shared between concurrent uploads to the same study so that
+        only one of them waits on the study lock at any time
+
+    pipeline : bool, optional
+        Don't wait for the study lock to clear after the upload. The
+        study lock is only waited for if Dataverse refuses a later
+        request because the study is locked.
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
+
+    replace : int, optional
+        Database ID of an existing file in the study. If supplied, that
+        file is replaced with this one instead of adding a new file.
+
+    verify : str or list, optional, default='md5'
+        Hash type(s) calculated while the file is sent. Whichever matches the
+        checksum type of the Dataverse installation is compared with the
+        checksum Dataverse reports. Use None to skip the check.
+
+    expand : bool, optional
+        The file is a zip which Dataverse should unpack. Each file in
+        the zip is added to the study, with `descr`, `tags` and `rest`
+        applied to all of them. Paths in the zip become directory labels.
+        Files which Dataverse didn't restrict on upload are restricted
+        individually.
+
+    retries : int, optional, default=3
+        Number of times to retry an upload which fails with a connection
+        error, a timeout, a server (5xx) error or a response which
+        isn't JSON. Before each retry, the study is checked in case the
+        file arrived anyway.
+
+    backoff : float, optional, default=2
+        Seconds to wait before the first retry. The wait doubles
+        with each retry.
+
+    stats : dict, optional
+        If supplied, timing information for the upload is added to this
+        dict, with keys 'bytes' (file size), 'upload' (total seconds),
+        'transfer' (sending the file), 'server' (waiting for the response
+        after sending), 'lock_wait', 'restrict', 'requests', 'retries'
+        and 'mbps' (transfer rate in MB/s).
+
+    Returns
+    -------
+    dict or list
+        The 'dataFile' portion of the Dataverse JSON response. If `expand`
+        is True, the list of file metadata for every file from the zip.
+
+    Notes
+    -----
+    Verification happens in the same pass as the upload, so the file is
+    only read once. An `md5` or `sha256` parameter is still checked
+    against the Dataverse checksum if one is supplied.
+
+    A failed upload counts as having arrived if the study holds a file
+    with the same name, path and checksum, in which case it isn't sent
+    again. A zip sent with `expand` is never resent once it has been
+    sent in full, as it may already have been unpacked.
+
+    Streams are read once, in constant memory, so they are never retried.
+    The study lock is always waited for before a stream is sent, as an
+    upload refused because of a lock can't be resent either.
     '''
     #Why are SPSS files getting processed anyway?
     #Does SPSS detection happen *after* upload
     #Does the file need to be renamed post hoc?
     #I don't think this can be fixed. Goddamitsomuch.
     dvurl = kwargs['dv'].strip('\\ /')
-    if os.path.splitext(fpath)[1].lower() in NOTAB and not kwargs.get('override'):
-        file_name_clean = os.path.basename(fpath)
-        #file_name = os.path.basename(fpath) + '.NOPROCESS'
-        # using .NOPROCESS doesn't seem to work?
-        file_name = os.path.basename(fpath) + '.NOPROCESS'
-    else:
-        file_name = os.path.basename(fpath)
-        file_name_clean = file_name
-    #My workstation python on Windows produces null for isos for some reason
-    if mimetypes.guess_type('test.iso') == (None, None):
-        mimetypes.add_type('application/x-iso9660-image', '.iso')
-    mime = mimetypes.guess_type(fpath)[0]
-    if kwargs.get('mimetype'):
-        mime = kwargs['mimetype']
-    if file_name.endswith('.NOPROCESS') or mime == 'application/zip':
-        mime = 'application/octet-stream'
+    name = fpath
+    if not isinstance(fpath, (str, os.PathLike)):
+        #Streams have no path, so the name comes from the label
+        name = kwargs.get('label') or getattr(fpath, 'name', None)
+        if not isinstance(name, str):
+            raise KeyError('A label is required to upload a stream')
+    file_name, file_name_clean, mime = _upload_names(name, **kwargs)
+    if kwargs.get('expand'):
+        #The one time Dataverse *should* unzip
+        file_name = file_name_clean
+        mime = 'application/zip'
+        #The zip's checksum won't match any of its contents
+        kwargs['verify'] = None
 
     #create file metadata in nice, simple, chunks
     dv4_meta = {'label' : kwargs.get('label', file_name_clean),
@@ -417,52 +595,240 @@ def upload_file(fpath, hdl, **kwargs):
                 'directoryLabel': kwargs.get('dirlabel', ''),
                 'categories': kwargs.get('tags', []),
                 'mimetype' : mime}
-    fpath = os.path.abspath(fpath)
-    fields = {'file': (file_name, open(fpath, 'rb'), mime)}#pylint: disable=consider-using-with
-    fields.update({'jsonData' : json.dumps(dv4_meta)})
-    multi = MultipartEncoder(fields=fields) # use multipart streaming for large files
-    headers = {'X-Dataverse-key' : kwargs.get('apikey'),
-               'Content-type' : multi.content_type}
-    headers.update(dataverse_utils.UAHEADER)
-    params = {'persistentId' : hdl}
+    if isinstance(fpath, (str, os.PathLike)):
+        fpath = os.path.abspath(fpath)
+    session = kwargs.get('session') or get_session()
+    endpoint = f'{dvurl}/api/datasets/:persistentId/add'
+    if kwargs.get('expand') and kwargs.get('rest'):
+        #Restrict everything from the zip as it's added
+        dv4_meta['restrict'] = True
+    if kwargs.get('replace'):
+        #Replacement is the only way to keep file history intact
+        endpoint = f'{dvurl}/api/files/{kwargs["replace"]}/replace'
+        dv4_meta['forceReplace'] = True
+
+    stats = kwargs.pop('stats', None)
+    stats = {} if stats is None else stats
+    for key in ('bytes', 'upload', 'transfer', 'server', 'lock_wait',
+                'restrict', 'requests', 'retries'):
+        stats.setdefault(key, 0)
+    with throttle.hooked(session, _count_request), _measure(stats, 'upload'):
+        kwargs.update({'session': session, 'file_name': file_name, 'mime': mime,
+                       'dv4_meta': dv4_meta, 'endpoint': endpoint})
+        data_file = _send_file(fpath, hdl, stats, **kwargs)
+    stats['mbps'] = stats['bytes'] / stats['transfer'] / 1e6 if stats['transfer'] else 0
+    LOGGER.info('Uploaded %s: %s bytes in %.2fs (%.2f MB/s), '
+                'server %.2fs, lock wait %.2fs, %s request(s)',
+                name, stats['bytes'], stats['upload'], stats['mbps'],
+                stats['server'], stats['lock_wait'], stats['requests'])
+    return data_file
+
+def _send_file(fpath, hdl, stats:dict, **kwargs) -> dict:
+    '''
+    Does the work for `upload_file`: sends the file, checks the response
+    and waits for or breaks the study lock, collecting timing information.
 
-    LOGGER.info('Uploading %s to %s', fpath, hdl)
-    upload = requests.post(f"{dvurl}/api/datasets/:persistentId/add",
-                           params=params, headers=headers, data=multi,
-                           timeout=kwargs.get('timeout',1000))
-    try:
-        print(upload.json())
-    except json.decoder.JSONDecodeError:
-        #This can happend when Glassfish crashes
-        LOGGER.critical(upload.text)
-        print(upload.text)
-        err = ('It\'s possible Glassfish may have crashed. '
-               'Check server logs for anomalies')
-        LOGGER.exception(err)
-        print(err)
-        raise
+    Parameters
+    ----------
+    fpath : str
+        Absolute file location
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    stats : dict
+        Statistics dict, see `upload_file`
+
+    **kwargs : dict
+        Parameters for `upload_file` plus 'session', 'file_name',
+        'mime', 'dv4_meta' and 'endpoint' as prepared by `upload_file`
+    '''
+    #pylint: disable=too-many-locals, too-many-branches, too-many-statements
+    dvurl = kwargs['dv'].strip('\\ /')
+    params = {'persistentId' : hdl}
+    lock = kwargs.get('lock')
+    session = kwargs['session']
+    verify = kwargs.get('verify', 'md5')
+    retries = kwargs.get('retries', 3)
+    stream = not isinstance(fpath, (str, os.PathLike))
+    source = kwargs['file_name'] if stream else fpath
+    if stream:
+        #A stream can only be read once
+        retries = 0
+        fpath = fpath if hasattr(fpath, 'read') else _IterStream(fpath)
+        with _measure(stats, 'lock_wait'):
+            wait_for_unlock(dvurl, hdl, kwargs['apikey'], lock, session=session)
+    attempt = 0
+    refused = 0
+    files = None
+    LOGGER.info('Uploading %s to %s', kwargs['file_name'], hdl)
+    while True:
+        with contextlib.nullcontext(fpath) if stream else open(fpath, 'rb') as fobj:
+            reader = HashingReader(fobj, verify if verify else [],
+                                   kwargs.get('size') if stream else None)
+            fields = {'file': (kwargs['file_name'], reader, kwargs['mime'])}
+            fields.update({'jsonData' : json.dumps(kwargs['dv4_meta'])})
+            #Note when the last byte goes out; the rest is server time
+            sent = {}
+            if reader.size is None:
+                multi, content_type = _multipart_stream(
+                                        fields,
+                                        lambda: sent.setdefault('at', time.perf_counter()))
+            else:
+                multi = MultipartEncoder(fields=fields) # use multipart streaming for large files
+                multi = MultipartEncoderMonitor(multi,
+                                                lambda x: (x.bytes_read >= x.len and
+                                                           sent.setdefault('at',
+                                                                           time.perf_counter())))
+                content_type = multi.content_type
+            headers = {'X-Dataverse-key' : kwargs.get('apikey'),
+                       'Content-type' : content_type}
+            headers.update(dataverse_utils.UAHEADER)
+            start = time.perf_counter()
+            failure = None
+            try:
+                upload = session.post(kwargs['endpoint'],
+                                      params=params, headers=headers, data=multi,
+                                      timeout=kwargs.get('timeout',1000))
+                if upload.status_code >= 500:
+                    failure = f'{upload.status_code} {upload.reason}'
+                elif upload.status_code == 200:
+                    upload.json()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as err:
+                upload = None
+                failure = err
+            except json.decoder.JSONDecodeError as err:
+                failure = err
+            done = time.perf_counter()
+            stats['bytes'] = reader.count
+            stats['transfer'] += sent.get('at', done) - start
+            stats['server'] += done - sent.get('at', done)
+        if upload is not None and _is_lock_refusal(upload):
+            if stream:
+                raise DvGeneralUploadError(f'Study {hdl} is locked; '
+                                           f'{kwargs["file_name"]} can\'t be resent')
+            refused += 1
+            if refused > retries:
+                raise DvGeneralUploadError(f'Study {hdl} is still locked after '
+                                           f'{refused} attempts to upload {fpath}')
+            #Another upload (or ingest) holds the study, so wait our turn
+            LOGGER.warning('Upload of %s refused; study %s is locked', fpath, hdl)
+            with _measure(stats, 'lock_wait'):
+                wait_for_unlock(dvurl, hdl, kwargs['apikey'], lock, session=session)
+            continue
+        if not failure or attempt >= retries:
+            break
+        if kwargs.get('expand') and not reader.len:
+            #The zip may have been unpacked, and sending it again could
+            #duplicate everything in it
+            break
+        attempt += 1
+        stats['retries'] = attempt
+        LOGGER.warning('Upload of %s failed (%s); retry %s of %s',
+                       fpath, failure, attempt, retries)
+        files = _arrived(fpath, reader, hdl, **kwargs)
+        if files:
+            LOGGER.warning('%s arrived in %s despite the error; not resending', fpath, hdl)
+            break
+        time.sleep(kwargs.get('backoff', 2) * 2 ** (attempt - 1))
+    if not files:
+        if upload is None:
+            raise failure
+        try:
+            LOGGER.debug('Upload response for %s: %s', fpath, upload.json())
+        except json.decoder.JSONDecodeError:
+            #This can happend when Glassfish crashes
+            LOGGER.critical(upload.text)
+            LOGGER.exception('It\'s possible Glassfish may have crashed. '
+                             'Check server logs for anomalies')
+            raise
+        if upload.status_code != 200:
+            LOGGER.critical('Upload failure: %s', (upload.status_code, upload.reason))
+            raise DvGeneralUploadError(f'\nReason: {(upload.status_code, upload.reason)}'
+                                       f'\n{upload.text}')
+        files = upload.json()['data']['files']
     #SPSS files still process despite spoof, so there's
     #a forcible unlock check
-    fid = upload.json()['data']['files'][0]['dataFile']['id']
-    print(f'FID: {fid}')
-    if kwargs.get('nowait') and check_lock(dvurl, hdl, kwargs['apikey']):
-        force_notab_unlock(hdl, dvurl, fid, kwargs['apikey'])
-    else:
-        while check_lock(dvurl, hdl, kwargs['apikey']):
-            time.sleep(10)
-
-    if upload.status_code != 200:
-        LOGGER.critical('Upload failure: %s', (upload.status_code, upload.reason))
-        raise DvGeneralUploadError(f'\nReason: {(upload.status_code, upload.reason)}'
-                                   f'\n{upload.text}')
+    data_file = files[0]['dataFile']
+    fid = data_file['id']
+    LOGGER.info('%s uploaded to %s as FID %s', fpath, hdl, fid)
+    with _measure(stats, 'lock_wait'):
+        if kwargs.get('nowait') and check_lock(dvurl, hdl, kwargs['apikey'], session):
+            force_notab_unlock(hdl, dvurl, fid, kwargs['apikey'], session=session)
+        elif not kwargs.get('pipeline'):
+            wait_for_unlock(dvurl, hdl, kwargs['apikey'], lock, session=session)
 
     if kwargs.get('md5'):
-        if upload.json()['data']['files'][0]['dataFile']['md5'] != kwargs.get('md5'):
-            LOGGER.warning('md5sum mismatch on %s', fpath)
+        if data_file.get('md5') != kwargs.get('md5'):
+            LOGGER.warning('md5sum mismatch on %s', source)
             raise Md5Error('md5sum mismatch')
+    if (kwargs.get('sha256') and
+        data_file.get('checksum', {}).get('type') == 'SHA-256'):
+        if data_file['checksum']['value'] != kwargs['sha256']:
+            LOGGER.warning('sha256 mismatch on %s', source)
+            raise Md5Error('sha256 mismatch')
+    checksum = data_file.get('checksum', {'type': 'MD5', 'value': data_file.get('md5')})
+    prot = CHECKSUM_TYPES.get(checksum.get('type'))
+    if prot in reader.hashes:
+        if reader.hexdigest(prot) != checksum.get('value'):
+            LOGGER.warning('%s mismatch on %s: sent %s, Dataverse reports %s',
+                           prot, source, reader.hexdigest(prot), checksum.get('value'))
+            raise Md5Error(f'{prot} mismatch')
+    elif verify:
+        LOGGER.info('Not verifying %s; Dataverse checksum type is %s',
+                    source, checksum.get('type'))
+
+    #Files are added unrestricted, so only restricting needs a request
+    if kwargs.get('rest'):
+        with _measure(stats, 'restrict'):
+            for _ in files if kwargs.get('expand') else files[:1]:
+                if _.get('restricted'):
+                    continue
+                restrict_file(fid=_['dataFile']['id'], dv=dvurl, apikey=kwargs.get('apikey'),
+                              rest=True, hdl=hdl, lock=lock, session=session)
+    return files if kwargs.get('expand') else data_file
+
+def _arrived(fpath, reader:HashingReader, hdl, **kwargs) -> list:
+    '''
+    After a failed upload, checks whether the file reached the study
+    anyway. Returns a list holding the study's metadata for the file,
+    in the form of the 'files' portion of an upload response, or None.
+
+    Parameters
+    ----------
+    fpath : str
+        Absolute file location
+
+    reader : HashingReader
+        Reader used for the failed attempt
 
-    restrict_file(fid=fid, dv=dvurl, apikey=kwargs.get('apikey'),
-                  rest=kwargs.get('rest', False))
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    **kwargs : dict
+        Parameters as for `_send_file`
+    '''
+    if reader.len or kwargs.get('expand'):
+        #It can't have arrived if it wasn't all sent, and there's
+        #no single file to look for in an unpacked zip
+        return None
+    try:
+        listing = dataset_files(kwargs['dv'].strip('\\ /'), hdl, kwargs.get('apikey'),
+                                kwargs['session'])
+    except (requests.exceptions.RequestException, json.decoder.JSONDecodeError) as err:
+        LOGGER.warning('Unable to check %s for %s: %s', hdl, fpath, err)
+        return None
+    found = _remote_match({'fpath': fpath, 'label': kwargs['dv4_meta']['label'],
+                           'dirlabel': kwargs['dv4_meta']['directoryLabel']},
+                          _remote_index(listing))
+    if not found:
+        return None
+    checksum = found['dataFile'].get('checksum',
+                                     {'type': 'MD5', 'value': found['dataFile'].get('md5')})
+    prot = CHECKSUM_TYPES.get(checksum.get('type'), 'md5')
+    local = reader.hexdigest(prot) if prot in reader.hashes else file_digest(fpath, prot)
+    return [found] if local == checksum.get('value') else None
 
 def restrict_file(**kwargs):
     '''
@@ -490,6 +856,21 @@ def restrict_file(**kwargs):
     rest : bool
         On True, restrict. Default True
 
+    hdl : str, optional
+        Persistent ID of the study holding the file. If supplied, a
+        restriction refused because the study is locked is retried
+        once the lock clears.
+
+    retries : int, optional, default=3
+        Number of times a restriction refused because of a lock is retried
+        before giving up with DvGeneralUploadError
+
+    lock : threading.Lock, optional
+        Lock shared between concurrent uploads to the same study
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
+
     Notes
     --------
     One of `pid` or `fid` is **required**
@@ -502,91 +883,96 @@ def restrict_file(**kwargs):
     else:
         rest= 'false'
     if kwargs.get('pid'):
+        url = f'{kwargs["dv"]}/api/files/:persistentId/restrict'
         params={'persistentId':kwargs['pid']}
-        rest = requests.put(f'{kwargs["dv"]}/api/files/:persistentId/restrict',
-                            headers=headers,
-                            params=params,
-                            data=rest,
-                            timeout=300)
     elif kwargs.get('fid'):
-        rest = requests.put(f'{kwargs["dv"]}/api/files/{kwargs["fid"]}/restrict',
-                            headers=headers, data=rest, timeout=300)
+        url = f'{kwargs["dv"]}/api/files/{kwargs["fid"]}/restrict'
+        params = None
     else:
         LOGGER.error('No file ID/PID supplied for file restriction')
         raise KeyError('One of persistentId (pid) or database ID'
                        '(fid) is required for file restriction')
-
-def upload_from_tsv(fil, hdl, **kwargs):
+    session = kwargs.get('session') or get_session()
+    refused = 0
+    while True:
+        restricted = session.put(url, headers=headers, params=params,
+                                 data=rest, timeout=300)
+        if not (kwargs.get('hdl') and _is_lock_refusal(restricted)):
+            break
+        refused += 1
+        if refused > kwargs.get('retries', 3):
+            raise DvGeneralUploadError(f'Study {kwargs["hdl"]} is still locked after '
+                                       f'{refused} attempts to restrict a file')
+        wait_for_unlock(kwargs['dv'], kwargs['hdl'], kwargs['apikey'],
+                        kwargs.get('lock'), session=session)
+
+def update_file_metadata(dv_url, fid, apikey, meta:dict, session=None) -> None:
     '''
-    Utility for bulk uploading. Assumes fil is formatted
-    as tsv with headers 'file', 'description', 'tags'.
-
-    'tags' field will be split on commas.
+    Replaces the metadata of a file already in a study.
 
     Parameters
     ----------
-    fil
-        Open file object or io.IOStream()
+    dv_url : str
+        URL to base Dataverse installation
 
-    hdl : str
-        Dataverse persistent ID for study (handle or DOI)
+    fid : int or str
+        File ID of file
 
-    **kwargs : dict
-        Other parameters
+    apikey : str
+        API key for user
 
-    Other parameters
-    ----------------
-    trunc : str
-        Leftmost portion of Dataverse study file path to remove.
-        eg: trunc ='/home/user/' if the tsv field is
-        '/home/user/Data/ASCII'
-        would set the path for that line of the tsv to 'Data/ASCII'.
-        Defaults to None.
+    meta : dict
+        File metadata, eg. {'description': 'A file', 'categories': ['Data']}.
+        Omitted fields are removed from the file, so include everything
+        which should be kept.
 
-    dv : str, required
-        url to base Dataverse installation
-        eg: 'https://abacus.library.ubc.ca'
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
+    '''
+    headers = {'X-Dataverse-key': apikey}
+    headers.update(dataverse_utils.UAHEADER)
+    dv_url = dv_url.strip('\\ /')
+    session = session if session else get_session()
+    updated = session.post(f'{dv_url}/api/files/{fid}/metadata',
+                           headers=headers,
+                           files={'jsonData': (None, json.dumps(meta))},
+                           timeout=300)
+    updated.raise_for_status()
 
-    apikey : str, required
-        API key for user
 
-    rest : bool, optional
-        On True, restrict access. Default False
-        '''
-    #reader = csv.reader(fil, delimiter='\t', quotechar='"')
-    #new, optional mimetype column allows using GeoJSONS.
-    #Read the headers from the file first before using DictReader
-    headers = fil.readline().strip('\n\r').split('\t')#Goddamn it Windows
-    fil.seek(0)
-    reader = csv.DictReader(fil, fieldnames=headers, quotechar='"', delimiter='\t')
-    #See API call for "Adding File Metadata"
-    for num, row in enumerate(reader):
-        if num == 0:
-            continue
-        #dirlabel = file_path(row[0], './')
-        if row.get('path'):
-            #Explicit separate path because that way you can organize
-            #on upload
-            dirlabel = row.get('path')
-        else:
-            dirlabel = file_path(row['file'], kwargs.get('trunc', ''))
-        tags = row['tags'].split(',')
-        tags = [x.strip() for x in tags]
-        descr = row['description']
-        mimetype = row.get('mimetype')
-        params = {'dv' : kwargs.get('dv'),
-                  'tags' : tags,
-                  'descr' : descr,
-                  'dirlabel' : dirlabel,
-                  'apikey' : kwargs.get('apikey'),
-                  'md5' : kwargs.get('md5', ''),
-                  'rest': kwargs.get('rest', False)}
-        if mimetype:
-            params['mimetype'] = mimetype
-        #So that you can pass everything all at once, params
-        #is merged onto kwargs. This is for easier upgradability
-        kwargs.update(params)
-        upload_file(row['file'], hdl, **kwargs)
+def _remote_index(files:list) -> dict:
+    '''
+    Returns study file metadata keyed on (directoryLabel, label). Ingested
+    files are also keyed on their original file name.
+
+    Parameters
+    ----------
+    files : list
+        File metadata, as from `dataset_files`
+    '''
+    out = {}
+    for fil in files:
+        dirlabel = fil.get('directoryLabel', '').strip('/')
+        out[(dirlabel, fil['label'])] = fil
+        if fil['dataFile'].get('originalFileName'):
+            out.setdefault((dirlabel, fil['dataFile']['originalFileName']), fil)
+    return out
+
+def _remote_match(row, remote:dict) -> dict:
+    '''
+    Find the file already in a study that corresponds to a manifest row.
+
+    Parameters
+    ----------
+    row : dict
+        Manifest row as produced by `_manifest_rows`
+
+    remote : dict
+        Study file metadata keyed on (directoryLabel, label)
+    '''
+    label = row.get('label', os.path.basename(row['fpath']))
+    return remote.get((row.get('dirlabel', '').strip('/'), label))
+
 
 if __name__ == '__main__':
     import doctest
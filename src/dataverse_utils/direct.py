@@ -0,0 +1,532 @@
+'''
+Direct upload of files to a Dataverse installation's S3 storage.
+
+Instead of sending files through the Dataverse application server, the
+server hands out pre-signed URLs and the files are sent straight to the
+storage, large ones in parts which are uploaded in parallel. The files are
+then registered with the study in bulk. Any S3-compatible storage will
+do, including a local stand-in such as MinIO on plain http, as long as
+direct upload is enabled for the Dataverse store.
+'''
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import dataverse_utils
+import dataverse_utils.dataverse_utils as dvu
+from dataverse_utils import streams
+from dataverse_utils import throttle
+
+LOGGER = logging.getLogger(__name__)
+
+BATCH = 100
+'''Maximum number of files registered with a study in one request'''
+
+PARTS = 4
+'''Default number of parts of a file sent at once'''
+
+_ETAG_MD5 = re.compile('^[0-9a-f]{32}$')
+
+class _Part:
+    '''
+    Read-only window on a section of a file, hashed as it is read,
+    so that a part can be streamed to storage without reading it
+    into memory.
+
+    Parameters
+    ----------
+    fpath : str
+        File location
+
+    offset : int
+        Start of the part in bytes
+
+    length : int
+        Length of the part in bytes
+    '''
+    def __init__(self, fpath, offset:int, length:int):
+        self.fobj = open(fpath, 'rb') #pylint: disable=consider-using-with
+        self.fobj.seek(offset)
+        self.length = length
+        self.remaining = length
+        self.hash = hashlib.md5()
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size:int=-1) -> bytes:
+        '''
+        Reads up to size bytes from the part
+
+        Parameters
+        ----------
+        size : int, optional
+            Maximum number of bytes to return. The rest of the part if
+            negative or omitted.
+        '''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        chunk = self.fobj.read(size)
+        self.remaining -= len(chunk)
+        self.hash.update(chunk)
+        return chunk
+
+    def close(self) -> None:
+        '''
+        Closes the underlying file
+        '''
+        self.fobj.close()
+
+def upload_urls(dv_url, hdl, apikey, size:int, session=None) -> dict:
+    '''
+    Requests pre-signed storage URLs for a file of a given size. Returns
+    the 'data' portion of the response, which has 'url' for a file which
+    can be sent in one request, or 'urls' (keyed on part number),
+    'partSize', 'complete' and 'abort' for a multipart upload. Both
+    include the 'storageIdentifier' used to register the file.
+
+    Parameters
+    ----------
+    dv_url : str
+        URL of Dataverse installation
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    apikey : str
+        API key for user
+
+    size : int
+        File size in bytes
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
+    '''
+    session = session or dvu.get_session()
+    headers = {'X-Dataverse-key' : apikey}
+    headers.update(dataverse_utils.UAHEADER)
+    resp = session.get(f'{dv_url}/api/datasets/:persistentId/uploadurls',
+                       params={'persistentId': hdl, 'size': size},
+                       headers=headers, timeout=100)
+    if resp.status_code != 200:
+        #Most often because the study's store doesn't allow direct upload
+        raise dvu.DvGeneralUploadError(f'No upload URL for {hdl}: '
+                                       f'{resp.status_code} {resp.text}')
+    return resp.json()['data']
+
+def _put_part(url, fpath, offset:int, length:int, **kwargs) -> tuple:
+    '''
+    Sends one part of a file to a pre-signed URL, retrying on connection
+    errors, server errors and corrupted parts. Returns a tuple of
+    (ETag, md5 hex digest, number of attempts).
+
+    Parameters
+    ----------
+    url : str
+        Pre-signed URL
+
+    fpath : str
+        File location
+
+    offset : int
+        Start of the part in bytes
+
+    length : int
+        Length of the part in bytes
+
+    **kwargs : dict
+        'session', 'retries', 'backoff' and 'timeout' as in `put_file`,
+        and 'headers', any extra headers for the request
+    '''
+    retries = kwargs.get('retries', 3)
+    attempt = 0
+    while True:
+        attempt += 1
+        part = _Part(fpath, offset, length)
+        try:
+            resp = kwargs['session'].put(url, data=part if length else b'',
+                                         headers=kwargs.get('headers'),
+                                         timeout=kwargs.get('timeout', 1000))
+            if resp.status_code >= 500:
+                failure = f'{resp.status_code} {resp.reason}'
+            elif resp.status_code >= 300:
+                raise dvu.DvGeneralUploadError(f'Storage refused part at {offset} '
+                                               f'of {fpath}: {resp.status_code} '
+                                               f'{resp.text}')
+            else:
+                etag = resp.headers.get('ETag', '')
+                #Unless the storage encrypts, a part's ETag is its md5
+                if (_ETAG_MD5.match(etag.strip('"')) and
+                        etag.strip('"') != part.hash.hexdigest()):
+                    failure = 'ETag does not match the part sent'
+                else:
+                    return etag, part.hash.hexdigest(), attempt
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as err:
+            failure = err
+        finally:
+            part.close()
+        if attempt > retries:
+            raise dvu.DvGeneralUploadError(f'Part at {offset} of {fpath} failed: {failure}')
+        LOGGER.warning('Part at %s of %s failed (%s); retry %s of %s',
+                       offset, fpath, failure, attempt, retries)
+        time.sleep(kwargs.get('backoff', 2) * 2 ** (attempt - 1))
+
+def put_file(fpath, hdl, **kwargs) -> dict:
+    '''
+    Sends a file straight to the storage of a study without adding it to
+    the study. Returns the file's entry for `add_files`.
+
+    Parameters
+    ----------
+    fpath : str
+        File location
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    **kwargs : dict
+        Other parameters
+
+    Other parameters
+    ----------------
+    dv : str, required
+        URL to base Dataverse installation
+
+    apikey : str, required
+        API key for user
+
+    descr, dirlabel, tags, label, rest, mimetype, override, md5, sha256
+        File metadata and checks, as in `dataverse_utils.upload_file`.
+        Restriction is applied when the file is registered.
+
+    parts : int, optional, default=PARTS
+        Number of parts sent at once for a multipart upload
+
+    tagging : bool, optional, default=True
+        Send the 'dv-state=temp' object tag which Dataverse expects when
+        files are sent in one request. Turn it off for storage which
+        doesn't support tagging, as in Dataverse's disable-tagging
+        store option.
+
+    retries : int, optional, default=3
+        Number of times a part is resent after a connection error, a
+        server error or a mismatched ETag
+
+    backoff : float, optional, default=2
+        Seconds before the first retry, doubling each time
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
+
+    stats : dict, optional
+        Statistics as in `dataverse_utils.upload_file`
+
+    Notes
+    -----
+    The file's md5 is calculated while it is sent, and for multipart
+    uploads in a separate read alongside the parts. Each part is checked
+    against the ETag returned by the storage. If a part can't be sent,
+    the multipart upload is aborted so that the storage doesn't keep the
+    parts.
+    '''
+    #pylint: disable=too-many-locals
+    dvurl = kwargs['dv'].strip('\\ /')
+    session = kwargs.get('session') or dvu.get_session()
+    stats = kwargs.get('stats')
+    stats = {} if stats is None else stats
+    for key in ('bytes', 'upload', 'transfer', 'server', 'requests', 'retries'):
+        stats.setdefault(key, 0)
+    size = os.stat(fpath).st_size
+    file_name, file_name_clean, mime = dvu._upload_names(fpath, **kwargs)#pylint: disable=protected-access
+    send = {'session': session, 'retries': kwargs.get('retries', 3),
+            'backoff': kwargs.get('backoff', 2), 'timeout': kwargs.get('timeout', 1000)}
+    prots = ['sha256'] if kwargs.get('sha256') else []
+    LOGGER.info('Sending %s directly to storage for %s', fpath, hdl)
+    with throttle.hooked(session, dvu._count_request), dvu._measure(stats, 'upload'):#pylint: disable=protected-access
+        target = upload_urls(dvurl, hdl, kwargs.get('apikey'), size, session)
+        if 'url' in target:
+            send['headers'] = ({'x-amz-tagging': 'dv-state=temp'}
+                               if kwargs.get('tagging', True) else None)
+            with dvu._measure(stats, 'transfer'):#pylint: disable=protected-access
+                _, md5, attempts = _put_part(target['url'], fpath, 0, size, **send)
+            digests = streams.file_digest(fpath, prots) if prots else {}
+            digests['md5'] = md5
+            stats['retries'] += attempts - 1
+        else:
+            digests = _put_parts(fpath, target, send, **dict(kwargs, stats=stats))
+    stats['bytes'] = size
+    stats['mbps'] = size / stats['transfer'] / 1e6 if stats['transfer'] else 0
+    LOGGER.info('Sent %s: %s bytes in %.2fs (%.2f MB/s)',
+                fpath, size, stats['upload'], stats['mbps'])
+    if kwargs.get('md5') and digests['md5'] != kwargs['md5']:
+        LOGGER.warning('md5sum mismatch on %s', fpath)
+        raise dvu.Md5Error('md5sum mismatch')
+    if kwargs.get('sha256') and digests['sha256'] != kwargs['sha256']:
+        LOGGER.warning('sha256 mismatch on %s', fpath)
+        raise dvu.Md5Error('sha256 mismatch')
+    return {'storageIdentifier': target['storageIdentifier'],
+            'fileName': file_name,
+            'label': kwargs.get('label', file_name_clean),
+            'mimeType': mime,
+            'description': kwargs.get('descr', ''),
+            'directoryLabel': kwargs.get('dirlabel', ''),
+            'categories': kwargs.get('tags', []),
+            'restrict': bool(kwargs.get('rest')),
+            'checksum': {'@type': 'MD5', '@value': digests['md5']}}
+
+def _put_parts(fpath, target:dict, send:dict, **kwargs) -> dict:
+    '''
+    Sends a file to storage in parts for `put_file`, `parts` at a time,
+    and completes the multipart upload, or aborts it if a part can't be
+    sent. Returns a dict of {hash type: hex digest}, always including md5.
+
+    Parameters
+    ----------
+    fpath : str
+        File location
+
+    target : dict
+        Multipart upload URLs, as from `upload_urls`
+
+    send : dict
+        Parameters for `_put_part`
+
+    **kwargs : dict
+        Parameters as in `put_file`, with `stats` required
+    '''
+    dvurl = kwargs['dv'].strip('\\ /')
+    size = os.stat(fpath).st_size
+    part_size = int(target['partSize'])
+    headers = {'X-Dataverse-key' : kwargs.get('apikey')}
+    headers.update(dataverse_utils.UAHEADER)
+    try:
+        with dvu._measure(kwargs['stats'], 'transfer'):#pylint: disable=protected-access
+            with ThreadPoolExecutor(max_workers=kwargs.get('parts', PARTS) + 1) as pool:
+                digest = pool.submit(streams.file_digest, fpath,
+                                     ['sha256', 'md5'] if kwargs.get('sha256') else ['md5'])
+                futures = {num: pool.submit(_put_part, url, fpath,
+                                            (int(num) - 1) * part_size,
+                                            min(part_size, size - (int(num) - 1) * part_size),
+                                            **send)
+                           for num, url in target['urls'].items()}
+                try:
+                    etags = {num: future.result()[0] for num, future in futures.items()}
+                finally:
+                    for _ in futures.values():
+                        _.cancel()
+                digests = digest.result()
+        #Parts are sent from other threads, so aren't counted by the hook
+        attempts = sum(_.result()[2] for _ in futures.values())
+        kwargs['stats']['requests'] += attempts
+        kwargs['stats']['retries'] += attempts - len(futures)
+        with dvu._measure(kwargs['stats'], 'server'):#pylint: disable=protected-access
+            done = send['session'].put(f'{dvurl}{target["complete"]}', json=etags,
+                                       headers=headers, timeout=kwargs.get('timeout', 1000))
+        if done.status_code != 200:
+            raise dvu.DvGeneralUploadError(f'Multipart upload of {fpath} '
+                                           f'not completed: {done.status_code} '
+                                           f'{done.text}')
+    except (dvu.DvGeneralUploadError, OSError,
+            requests.exceptions.RequestException):
+        LOGGER.warning('Aborting multipart upload of %s', fpath)
+        send['session'].delete(f'{dvurl}{target["abort"]}', headers=headers,
+                               timeout=kwargs.get('timeout', 1000))
+        raise
+    return digests
+
+def add_files(files:list, hdl, **kwargs) -> list:
+    '''
+    Registers files which have been sent to storage with a study,
+    all in one request. Returns the 'Files' portion of the response,
+    one dict per file with the 'storageIdentifier' and either
+    'fileDetails' or an 'errorMessage'.
+
+    Parameters
+    ----------
+    files : list
+        File entries, as from `put_file`
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    **kwargs : dict
+        Other parameters
+
+    Other parameters
+    ----------------
+    dv : str, required
+        URL to base Dataverse installation
+
+    apikey : str, required
+        API key for user
+
+    session : requests.Session, optional
+        Session to use. Defaults to the shared session.
+
+    lock : threading.Lock, optional
+        Serializes waiting for the study lock, as in `dataverse_utils.upload_file`
+
+    retries : int, optional, default=3
+        Number of times a registration refused because of a lock is retried
+        before giving up with DvGeneralUploadError
+
+    timeout : int, optional, default=1000
+        Request timeout in seconds
+    '''
+    dvurl = kwargs['dv'].strip('\\ /')
+    session = kwargs.get('session') or dvu.get_session()
+    headers = {'X-Dataverse-key' : kwargs.get('apikey')}
+    headers.update(dataverse_utils.UAHEADER)
+    refused = 0
+    while True:
+        resp = session.post(f'{dvurl}/api/datasets/:persistentId/addFiles',
+                            params={'persistentId': hdl}, headers=headers,
+                            files={'jsonData': (None, json.dumps(files))},
+                            timeout=kwargs.get('timeout', 1000))
+        if not dvu._is_lock_refusal(resp):#pylint: disable=protected-access
+            break
+        refused += 1
+        if refused > kwargs.get('retries', 3):
+            raise dvu.DvGeneralUploadError(f'Study {hdl} is still locked after '
+                                           f'{refused} attempts to register files')
+        LOGGER.warning('Registration refused; study %s is locked', hdl)
+        dvu.wait_for_unlock(dvurl, hdl, kwargs.get('apikey'), kwargs.get('lock'),
+                            session=session)
+    if resp.status_code != 200:
+        LOGGER.critical('Registration failure: %s', (resp.status_code, resp.reason))
+        raise dvu.DvGeneralUploadError(f'\nReason: {(resp.status_code, resp.reason)}'
+                                       f'\n{resp.text}')
+    return resp.json()['data']['Files']
+
+def direct_upload(rows:list, hdl, **kwargs) -> list:
+    '''
+    Uploads manifest rows straight to storage, then registers them with
+    the study up to BATCH files at a time. Returns a list of result dicts
+    in the same order as the rows, as for `dataverse_utils.upload_from_tsv`.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows, as used by `dataverse_utils.upload_from_tsv`
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    **kwargs : dict
+        Parameters for `put_file` and `add_files`, plus
+
+    Other parameters
+    ----------------
+    batch : int, optional, default=BATCH
+        Maximum number of files per registration request
+
+    journal : dataverse_utils.UploadJournal, optional
+        Journal in which progress is recorded
+
+    pipeline : bool, optional
+        Don't wait for the study lock after registering files
+    '''
+    dvurl = kwargs['dv'].strip('\\ /')
+    journal = kwargs.get('journal')
+    batch = max(1, kwargs.get('batch', BATCH))
+    results = []
+    pending = []
+    for num, row in enumerate(rows):
+        params = kwargs.copy()
+        params.update(row)
+        stats = {'bytes': 0, 'requests': 0}
+        result = {'file': row['fpath'], 'pid': hdl, 'status': 'uploaded',
+                  'fid': None, 'error': None, 'stats': stats}
+        results.append(result)
+        try:
+            with dvu._measure(stats, 'wall'):#pylint: disable=protected-access
+                if journal:
+                    journal.mark(hdl, row, 'started')
+                params['stats'] = stats
+                pending.append((result, row, put_file(params.pop('fpath'), hdl, **params)))
+        except (dvu.DvGeneralUploadError, dvu.Md5Error, KeyError, OSError,
+                json.decoder.JSONDecodeError,
+                requests.exceptions.RequestException) as err:
+            _failed(result, err, hdl, row, journal)
+        if pending and (len(pending) >= batch or num == len(rows) - 1):
+            _register(pending, hdl, **kwargs)
+            pending = []
+    if not kwargs.get('pipeline') and any(_['fid'] for _ in results):
+        dvu.wait_for_unlock(dvurl, hdl, kwargs.get('apikey'), kwargs.get('lock'),
+                            session=kwargs.get('session'))
+    return results
+
+def _register(pending:list, hdl, **kwargs) -> None:
+    '''
+    Registers a batch of files for `direct_upload` and fills in their results.
+    The time taken is shared between the files.
+
+    Parameters
+    ----------
+    pending : list
+        (result, manifest row, file entry) for each file
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    **kwargs : dict
+        Parameters as in `direct_upload`
+    '''
+    journal = kwargs.get('journal')
+    start = time.perf_counter()
+    try:
+        added = add_files([_[2] for _ in pending], hdl, **kwargs)
+    except (dvu.DvGeneralUploadError, json.decoder.JSONDecodeError,
+            requests.exceptions.RequestException) as err:
+        for result, row, _ in pending:
+            _failed(result, err, hdl, row, journal)
+        return
+    share = (time.perf_counter() - start) / len(pending)
+    #The one request is counted against the first file
+    pending[0][0]['stats']['requests'] += 1
+    added = {_.get('storageIdentifier'): _ for _ in added}
+    for result, row, entry in pending:
+        result['stats']['server'] += share
+        result['stats']['wall'] += share
+        done = added.get(entry['storageIdentifier'], {})
+        if not done.get('fileDetails'):
+            _failed(result, done.get('errorMessage', 'Not registered'), hdl, row, journal)
+            continue
+        result['fid'] = done['fileDetails'].get('id')
+        if journal:
+            journal.mark(hdl, row, 'complete', fid=result['fid'],
+                         md5=entry['checksum']['@value'], restricted=entry['restrict'])
+
+def _failed(result:dict, err, hdl, row:dict, journal=None) -> None:
+    '''
+    Marks a result from `direct_upload` as failed
+
+    Parameters
+    ----------
+    result : dict
+        Result dict
+
+    err : Exception or str
+        The reason
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    row : dict
+        Manifest row
+
+    journal : dataverse_utils.UploadJournal, optional
+        Journal in which to record the failure
+    '''
+    LOGGER.error('Direct upload of %s failed: %s', row['fpath'], err)
+    result['status'] = 'failed'
+    result['error'] = str(err)
+    if journal:
+        journal.mark(hdl, row, 'failed', error=str(err))
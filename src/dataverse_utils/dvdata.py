@@ -44,10 +44,15 @@ class Study(dict): #pylint:  disable=too-few-public-methods
         ----------------
         timeout : int
             Request timeout in seconds
+
+        session : requests.Session
+            Session for metadata requests, such as one from
+            `dataverse_utils.cache.cached_session`
         '''
         self['pid'] = pid
         self['url'] = url
         self.__key = key
+        self.__session = kwargs.get('session', requests)
         self['orig_json'] = None
         self['timeout'] = kwargs.get('timeout',TIMEOUT)
         if not self['orig_json']:
@@ -131,10 +136,10 @@ class Study(dict): #pylint:  disable=too-few-public-methods
         #$SERVER_URL/api/datasets/:persistentId/?persistentId=$PERSISTENT_IDENTIFIER
         headers = {'X-Dataverse-key' : self.__key}
         headers.update(UAHEADER)
-        getjson = requests.get(self['url']+'/api/datasets/:persistentId',
-                               headers=headers,
-                               params = {'persistentId': self['pid']},
-                               timeout = self['timeout'])
+        getjson = self.__session.get(self['url']+'/api/datasets/:persistentId',
+                                     headers=headers,
+                                     params = {'persistentId': self['pid']},
+                                     timeout = self['timeout'])
         getjson.raise_for_status()
         return getjson.json()['data']['latestVersion']
 
@@ -365,6 +370,38 @@ class File(dict):
                 return False
         return None
 
+    def stream_file(self, blocksize: int = 2**20) -> tuple:
+        '''
+        Opens the file for streaming instead of downloading it. Data will be in
+        the ORIGINAL format, not Dataverse-processed TSVs. Returns a tuple of
+        (iterator of bytes, size in bytes), where the size is None if the server
+        doesn't supply it.
+
+        Parameters
+        ----------
+        blocksize : int, optional, default=2**20
+            Size of the chunks produced by the iterator
+
+        Notes
+        -----
+        The iterator can be passed directly to `dataverse_utils.upload_file`
+        along with the size, so that a file can be copied from one
+        Dataverse installation to another without a temporary file.
+        '''
+        headers = {'X-Dataverse-key':self.__key}
+        headers.update(UAHEADER)
+        dwnld = requests.get(self['url']+'/api/access/datafile/'+
+                                        str(self['dataFile']['id']),
+                             headers=headers,
+                             params = {'format':'original'},
+                             timeout=self['timeout'], stream=True)
+        dwnld.raise_for_status()
+        size = dwnld.headers.get('Content-Length')
+        #Compressed transfers are decoded, so the length would be wrong
+        if size is None or dwnld.headers.get('Content-Encoding'):
+            return dwnld.iter_content(blocksize), None
+        return dwnld.iter_content(blocksize), int(size)
+
     def del_tempfile(self):
         '''
         Delete tempfile if it exists
@@ -466,6 +503,10 @@ class FileInfo(dict):
 
         timeout : int, optional
             Optional timeout in seconds
+
+        session : requests.Session, optional
+            Session for requests, such as one from
+            `dataverse_utils.cache.cached_session`
         '''
         self.kwargs = kwargs
         self['version_list'] = []
@@ -482,7 +523,8 @@ class FileInfo(dict):
             headers={'X-Dataverse-key' : self.kwargs.get('apikey')}
             headers.update(UAHEADER)
             params = {'persistentId': self.kwargs['pid']}
-            self.dv = requests.get(f'{self.kwargs["url"]}/api/datasets/:persistentId/versions',
+            self.dv = self.kwargs.get('session', requests).get(
+                                   f'{self.kwargs["url"]}/api/datasets/:persistentId/versions',
                                    params=params,
                                    timeout=self.kwargs.get('timeout', 100),
                                    headers=headers)
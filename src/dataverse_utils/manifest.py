@@ -0,0 +1,294 @@
+'''
+Finding files and writing the tab-separated manifests which
+describe them for upload
+'''
+
+import csv
+import io
+import itertools
+import logging
+import mimetypes
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from dataverse_utils import streams
+LOGGER = logging.getLogger(__name__)
+
+def walk_files(start_dir, hidden:bool=False, recursive:bool=True, prune:bool=False):
+    '''
+    Generator yielding the paths of files under start_dir, using
+    os.scandir so that no extra stat calls are needed to tell
+    files from directories. Paths come out in sorted order, as if the
+    complete list had been sorted, but only one directory listing
+    per level is held in memory.
+
+    Parameters
+    ----------
+    start_dir : str
+        Path to start directory
+
+    hidden : bool, optional, default=False
+        Include hidden (ie, dot) files
+
+    recursive : bool, optional, default=True
+        Descend into subdirectories
+
+    prune : bool, optional, default=False
+        Also skip hidden directories and everything under them, as
+        glob does. Ignored if hidden is True.
+    '''
+    stack = [iter(_listing(str(start_dir), hidden, prune))]
+    while stack:
+        for path, isdir in stack[-1]:
+            if not isdir:
+                yield path
+            elif recursive:
+                stack.append(iter(_listing(path, hidden, prune)))
+                break
+        else:
+            stack.pop()
+
+def _listing(path:str, hidden:bool, prune:bool) -> list:
+    '''
+    Returns a list of (path, is directory) for the entries of a
+    directory, in the order `walk_files` yields them.
+
+    Parameters
+    ----------
+    path : str
+        Directory
+
+    hidden : bool
+        Include hidden files
+
+    prune : bool
+        Leave out hidden directories
+
+    Notes
+    -----
+    Directories sort as if their names ended with os.sep, as the paths
+    of the files in them do, so that a depth-first walk yields paths
+    in the same order as sorting them all.
+    '''
+    out = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                dot = not hidden and entry.name.startswith('.')
+                if entry.is_dir(follow_symlinks=False):
+                    if not (dot and prune):
+                        out.append((f'{entry.name}{os.sep}', True))
+                elif entry.is_file() and not dot:
+                    out.append((entry.name, False))
+    except (PermissionError, FileNotFoundError, NotADirectoryError) as err:
+        LOGGER.warning('Unable to read %s: %s', path, err)
+    return [(f'{path}{os.sep}{name.rstrip(os.sep)}', isdir) for name, isdir in sorted(out)]
+
+def _iter_digests(paths, prots:list, workers:int=None):
+    '''
+    Generator yielding (path, {hash type: hex digest}) pairs in input
+    order, hashing in a process pool while holding only a bounded number
+    of paths in memory.
+
+    Parameters
+    ----------
+    paths : iterable
+        File locations
+
+    prots : list
+        Hash types
+
+    workers : int, optional
+        Number of processes. Defaults to the number of CPUs.
+    '''
+    workers = workers if workers else (os.cpu_count() or 1)
+    paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        batch = list(itertools.islice(paths, workers * 32))
+        while batch:
+            jobs = [(str(_), prots, False) for _ in batch]
+            pending = pool.map(streams._digest_job, jobs, chunksize=8)#pylint: disable=protected-access
+            nextbatch = list(itertools.islice(paths, workers * 32))
+            yield from zip(batch, pending)
+            batch = nextbatch
+
+def write_tsv(outf, start_dir, in_list=None, **kwargs) -> int:
+    '''
+    Writes a tsv manifest, one row at a time, to an open file
+    object. Rows are written as files are found, so memory use does not
+    grow with the number of files.
+
+    Returns the number of files written.
+
+    Parameters
+    ----------
+    outf : file object
+        Open, writable text file (eg. opened with newline='')
+
+    start_dir : str
+        Path to start directory
+
+    in_list : iterable, optional
+        Files for which to create manifest entries. Lists and sets are
+        sorted; other iterables are written in the order supplied.
+        Defaults to walking start_dir with `walk_files`.
+
+    **kwargs : dict
+        Other parameters, as in `make_tsv`: def_tag, inc_header,
+        mime, quotype, path, checksum and workers.
+    '''
+    if str(start_dir).endswith(os.sep):
+        start_dir = str(start_dir)[:-1]
+    if not in_list:
+        in_list = walk_files(start_dir)
+    if isinstance(in_list, (set, list)):
+        in_list = sorted(in_list)
+    def_tag = ", ".join([x.strip() for x in kwargs.get('def_tag', 'Data').split(',')])
+    headers = ['file', 'description', 'tags']
+    if kwargs.get('mime'):
+        headers.append('mimetype')
+    if kwargs.get('path'):
+        headers.insert(1, 'path')
+    checksums = kwargs.get('checksum') or []
+    if isinstance(checksums, str):
+        checksums = [checksums]
+    headers.extend(checksums)
+    tsv_writer = csv.DictWriter(outf, delimiter='\t',
+                                quoting=kwargs.get('quotype', csv.QUOTE_MINIMAL),
+                                fieldnames=headers,
+                                extrasaction='ignore')
+    if kwargs.get('inc_header', True):
+        tsv_writer.writeheader()
+    if checksums:
+        in_list = _iter_digests(in_list, checksums, kwargs.get('workers'))
+    else:
+        in_list = ((_, {}) for _ in in_list)
+    count = 0
+    for row, digests in in_list:
+        #the columns
+        r = {}
+        r['file'] = row
+        r['description'] = os.path.splitext(os.path.basename(row))[0]
+        r['mimetype'] = mimetypes.guess_type(row)[0]
+        r['tags'] = def_tag
+        r['path'] =  ''
+        r.update(digests)
+        tsv_writer.writerow(r)
+        count += 1
+    return count
+
+def make_tsv(start_dir, in_list=None, def_tag='Data',
+             inc_header=True,
+             mime=False,
+             quotype=csv.QUOTE_MINIMAL,
+             **kwargs) -> str:
+    # pylint: disable=too-many-positional-arguments
+    # pylint: disable=too-many-arguments
+    '''
+    Recurses the tree for files and produces tsv output with
+    with headers 'file', 'description', 'tags'.
+
+    The 'description' is the filename without an extension.
+
+    Returns tsv as string.
+
+    Parameters
+    ----------
+    start_dir : str
+        Path to start directory
+
+    in_list : list
+        Input file list. Defaults to recursive walk of start_dir.
+
+    def_tag : str
+        Default Dataverse tag (eg, Data, Documentation, etc)
+        Separate tags with a comma:
+        eg. ('Data, 2016')
+
+    inc_header : bool
+        Include header row
+
+    mime : bool
+        Include automatically determined mimetype
+
+    quotype: int
+        integer value or csv quote type.
+        Default = csv.QUOTE_MINIMAL
+        Acceptable values:
+        csv.QUOTE_MINIMAL / 0
+        csv.QUOTE_ALL / 1
+        csv.QUOTE_NONNUMERIC / 2
+        csv.QUOTE_NONE / 3
+
+    **kwargs : dict
+        Other parameters
+
+    Other parameters
+    ----------------
+    path : bool
+        If true include a 'path' field so that you can type
+        in a custom path instead of actually structuring
+        your data
+
+    checksum : str or list
+        Add checksum column(s) for these hash types. Supported
+        values are 'md5' and 'sha256'. Checksums are calculated
+        in parallel using a process pool.
+
+    workers : int
+        Number of processes used for checksums. Defaults to the number of CPUs.
+
+    '''
+    outf = io.StringIO(newline='')
+    write_tsv(outf, start_dir, in_list, def_tag=def_tag, inc_header=inc_header,
+              mime=mime, quotype=quotype, **kwargs)
+    outf.seek(0)
+    outfile = outf.read()
+    outf.close()
+
+    return outfile
+
+def dump_tsv(start_dir, filename, in_list=None,
+             **kwargs):
+    '''
+    Dumps output of make_tsv manifest to a file.
+
+    Parameters
+    ----------
+    start_dir : str
+        Path to start directory
+
+    in_list : iterable
+        Files for which to create manifest entries. Will
+        default to recursive directory crawl. Generators are streamed
+        to the file without being held in memory.
+
+    **kwargs : dict
+        Other parameters
+
+    Other parameters
+    ----------------
+    def_tag : str, optional, default='Data'
+        Default Dataverse tag (eg, Data, Documentation, etc).
+        Separate tags with an easily splitable character:
+        eg. ('Data, 2016')
+
+    inc_header : bool, optional, default=True
+        Include header for tsv.
+
+    quotype : int, optional, default=csv.QUOTE_MINIMAL
+        integer value or csv quote type.
+        Acceptable values:
+        * csv.QUOTE_MINIMAL / 0
+        * csv.QUOTE_ALL / 1
+        * csv.QUOTE_NONNUMERIC / 2
+        * csv.QUOTE_NONE / 3
+
+    checksum : str or list, optional
+        Add checksum column(s): 'md5' and/or 'sha256'
+    '''
+
+    #Written straight to the file rather than via make_tsv
+    #so that huge trees don't need to fit in memory
+    with open(filename, 'w', newline='', encoding='utf-8') as tsvfile:
+        write_tsv(tsvfile, start_dir, in_list, **kwargs)
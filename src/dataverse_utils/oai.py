@@ -0,0 +1,540 @@
+'''
+Bulk study metadata harvesting with OAI-PMH.
+
+A Dataverse installation publishes the metadata of every released study
+through OAI-PMH (`/oai`), a page of records at a time. This is far
+cheaper than requesting the metadata of each study separately when
+mirroring an installation or a large collection. Records are read as
+they arrive, so memory use doesn't grow with the size of the harvest,
+and a state file records when the last harvest took place so that
+the next one only asks for records which have changed since.
+
+Any OAI-PMH server will do, including a local stand-in on plain http.
+'''
+import json
+import logging
+import pathlib
+import xml.etree.ElementTree as ET
+
+import requests
+
+import dataverse_utils.collections as dvc
+from dataverse_utils import UAHEADER
+
+LOGGER = logging.getLogger(__name__)
+
+FORMATS = ('dataverse_json', 'oai_ddi')
+'''Supported metadata prefixes'''
+
+#DDI element: Dataverse study level field. These are not in metadata blocks
+DDI_TERMS = {'restrctn': 'restrictions',
+             'conditions': 'conditions',
+             'disclaimer': 'disclaimer',
+             'citReq': 'citationRequirements',
+             'deposReq': 'depositorRequirements',
+             'confDec': 'confidentialityDeclaration',
+             'specPerm': 'specialPermissions',
+             'accsPlac': 'dataAccessPlace',
+             'origArch': 'originalArchive',
+             'avlStatus': 'availabilityStatus',
+             'collSize': 'sizeOfCollection',
+             'complete': 'studyCompletion'}
+
+class OAIError(Exception):
+    '''
+    Raised on an error reported by the OAI-PMH server
+    '''
+
+def _local(tag:str)->str:
+    '''
+    Tag name without namespace
+    '''
+    return tag.rsplit('}', 1)[-1]
+
+def _all(elem:ET.Element, name:str)->list:
+    '''
+    All descendants of elem with tag name, in any namespace
+    '''
+    return [_ for _ in elem.iter() if _local(_.tag) == name]
+
+def _text(elem:ET.Element, name:str)->str:
+    '''
+    Stripped text of the first descendant called name, or None
+    '''
+    found = _all(elem, name)
+    return ((found[0].text or '').strip() or None) if found else None
+
+def _primitive(name:str, value, multiple:bool=False)->dict:
+    '''
+    Dataverse primitive field
+    '''
+    return {'typeName': name, 'multiple': multiple,
+            'typeClass': 'primitive', 'value': value}
+
+def _compound(name:str, rows:list)->dict:
+    '''
+    Dataverse compound field with multiple values, from a list of
+    {typeName: value} dicts
+    '''
+    return {'typeName': name, 'multiple': True, 'typeClass': 'compound',
+            'value': [{k: _primitive(k, v) for k, v in row.items() if v}
+                      for row in rows]}
+
+def json_meta(exported:dict)->dict:
+    '''
+    Returns study metadata in the form of the dataset API from a
+    dataverse_json export.
+
+    Parameters
+    ----------
+    exported : dict
+        dataverse_json study metadata
+    '''
+    data = {k:v for k, v in exported.items() if k != 'datasetVersion'}
+    data['latestVersion'] = exported['datasetVersion']
+    return {'status': 'OK', 'data': data}
+
+def _ddi_version(cite:ET.Element)->dict:
+    '''
+    Version state, number and release time from a DDI citation element
+    '''
+    ver = (_all(cite, 'version') or [None])[0]
+    if ver is None:
+        return {}
+    version = {'versionState': ver.get('type')}
+    number = (ver.text or '').strip().split('.')
+    if len(number) == 2 and all(_.isdigit() for _ in number):
+        version.update({'versionNumber': int(number[0]),
+                        'versionMinorNumber': int(number[1])})
+    if ver.get('date'):
+        version['releaseTime'] = ver.get('date')
+    return version
+
+def _ddi_files(codebook:ET.Element)->list:
+    '''
+    Dataverse file metadata from the file descriptions of a DDI codebook
+    '''
+    files = []
+    for file in _all(codebook, 'fileDscr') + _all(codebook, 'otherMat'):
+        name = _text(file, 'fileName') or _text(file, 'labl')
+        if not name:
+            continue
+        dfile = {'filename': name}
+        if file.get('ID', '')[1:].isdigit():
+            dfile['id'] = int(file.get('ID')[1:])
+        files.append({'label': name,
+                      'description': _text(file, 'fileCont') or _text(file, 'txt') or '',
+                      'dataFile': dfile})
+    return files
+
+def ddi_meta(codebook:ET.Element, pid:str)->dict:
+    '''
+    Returns study metadata in the form of the dataset API from a
+    DDI codebook.
+
+    Parameters
+    ----------
+    codebook : xml.etree.ElementTree.Element
+        DDI codeBook element
+    pid : str
+        Persistent ID of the study
+
+    Notes
+    -----
+    DDI can't be mapped back to Dataverse metadata exactly. The title,
+    authors, abstracts, keywords, contacts, producers, distributors,
+    grants, dates, kind of data and terms of use are recovered, along with
+    file names and descriptions. Dataverse only writes the major version
+    number into DDI, so unless there is a minor version the version
+    statement is the version state (eg. RELEASED).
+    '''
+    #pylint: disable=too-many-locals
+    stdy = (_all(codebook, 'stdyDscr') or [codebook])[0]
+    cite = (_all(stdy, 'citation') or [stdy])[0]
+    fields = []
+    for name, tag in [('title', 'titl'), ('subtitle', 'subTitl'),
+                      ('productionDate', 'prodDate'),
+                      ('distributionDate', 'distDate'),
+                      ('dateOfDeposit', 'depDate')]:
+        value = _text(cite, tag)
+        if value:
+            fields.append(_primitive(name, value))
+    for name, tag, rows in [('author', 'AuthEnty',
+                             lambda e: {'authorName': e.text,
+                                        'authorAffiliation': e.get('affiliation')}),
+                            ('datasetContact', 'contact',
+                             lambda e: {'datasetContactName': e.text,
+                                        'datasetContactAffiliation': e.get('affiliation')}),
+                            ('producer', 'producer',
+                             lambda e: {'producerName': e.text}),
+                            ('distributor', 'distrbtr',
+                             lambda e: {'distributorName': e.text}),
+                            ('grantNumber', 'grantNo',
+                             lambda e: {'grantNumberValue': e.text,
+                                        'grantNumberAgency': e.get('agency')}),
+                            ('keyword', 'keyword',
+                             lambda e: {'keywordValue': e.text}),
+                            ('dsDescription', 'abstract',
+                             lambda e: {'dsDescriptionValue': e.text,
+                                        'dsDescriptionDate': e.get('date')})]:
+        found = [rows(_) for _ in _all(stdy, tag) if (_.text or '').strip()]
+        if found:
+            fields.append(_compound(name, found))
+    kinds = [_.text.strip() for _ in _all(stdy, 'dataKind') if (_.text or '').strip()]
+    if kinds:
+        fields.append(_primitive('kindOfData', kinds, True))
+    version = {'metadataBlocks': {'citation': {'displayName': 'Citation Metadata',
+                                               'fields': fields}},
+               'files': _ddi_files(codebook)}
+    version.update(_ddi_version(cite))
+    for tag, field in DDI_TERMS.items():
+        value = _text(stdy, tag)
+        if value:
+            version[field] = value
+    protocol, rest = pid.split(':', 1)
+    authority, identifier = rest.split('/', 1)
+    #There is no database id in DDI; the pid stands in for it
+    return {'status': 'OK',
+            'data': {'id': pid, 'protocol': protocol,
+                     'authority': authority, 'identifier': identifier,
+                     'latestVersion': version}}
+
+class Harvester:
+    '''
+    OAI-PMH harvester for Dataverse study metadata.
+    '''
+    #pylint: disable=too-many-instance-attributes
+    def __init__(self, url:str, metadata_prefix:str='dataverse_json', **kwargs):
+        '''
+        Parameters
+        ----------
+        url : str
+            Base URL of Dataverse installation (or OAI server).
+            eg: https://borealisdata.ca
+                borealisdata.ca
+                http://localhost:8080
+        metadata_prefix : str, optional, default='dataverse_json'
+            Record format. One of 'dataverse_json' or 'oai_ddi'.
+
+        **kwargs : dict
+            Other parameters
+
+        Other parameters
+        ----------------
+        oai_set : str
+            OAI set to harvest. Default is the whole installation.
+
+        state : str
+            Path to a JSON file holding the date of the previous harvest.
+            If supplied, only records changed since then are harvested,
+            and the file is updated when the harvest is complete.
+            Records which couldn't be read are listed in the file and
+            requested again by the next harvest.
+
+        from_date : str
+            Harvest records changed on or after this date (YYYY-MM-DD or
+            YYYY-MM-DDThh:mm:ssZ). Overrides the state file.
+
+        until : str
+            Harvest records changed on or before this date.
+
+        endpoint : str
+            Path of the OAI-PMH service. Default '/oai'.
+
+        key : str
+            Dataverse API key, used when a record refers to the API
+
+        timeout : int
+            Request timeout in seconds. Default 100.
+
+        session : requests.Session
+            A requests session if available. It is used as it is;
+            otherwise a new session which retries failed requests is made.
+
+        rate_limit_on: bool
+            Turn on rate limit for requests
+
+        rate_limit_min : int
+            Minimum time between requests in seconds
+
+        rate_limit_max : int
+            Maximum time between requests in seconds
+
+        Notes
+        -----
+        ```
+        harvest = Harvester('https://borealisdata.ca', state='borealis.json')
+        for header, study in harvest.records():
+            if header['deleted']:
+                remove(header['identifier'])
+            else:
+                store(study)
+        ```
+        The state file is only written once every record has been read,
+        so an interrupted harvest is repeated in full next time.
+        '''
+        if metadata_prefix not in FORMATS:
+            raise ValueError(f'metadata_prefix must be one of {FORMATS}')
+        self.kwargs = kwargs
+        self.prefix = metadata_prefix
+        self.url = url.strip().strip('/')
+        if '://' not in self.url:
+            self.url = f'https://{self.url}'
+        self.endpoint = f"{self.url}/{kwargs.get('endpoint', 'oai').strip('/')}"
+        self.headers = UAHEADER.copy()
+        if kwargs.get('key'):
+            self.headers.update({'X-Dataverse-key': kwargs['key']})
+        #A session passed in is used as it is, keeping its adapters
+        #(eg. a cache) and their pool and retry settings
+        self.session = kwargs.get('session')
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.mount('https://',
+                               requests.adapters.HTTPAdapter(max_retries=dvc.RETRY))
+            self.session.mount('http://',
+                               requests.adapters.HTTPAdapter(max_retries=dvc.RETRY))
+        self.limit = dvc.RateLimiter(url=self.url, **kwargs)
+        self.__state_key = f"{self.endpoint} {self.prefix} {kwargs.get('oai_set') or ''}".strip()
+        self.counts = {'records': 0, 'deleted': 0, 'pages': 0}
+
+    @property
+    def state(self)->dict:
+        '''
+        Return the saved state of previous harvests from this server,
+        format and set, or an empty dict.
+        '''
+        if not self.kwargs.get('state'):
+            return {}
+        path = pathlib.Path(self.kwargs['state']).expanduser()
+        if not path.exists():
+            return {}
+        return json.loads(path.read_text(encoding='utf-8')).get(self.__state_key, {})
+
+    def __save_state(self, response_date:str, failed:set):
+        '''
+        Record the time of a complete harvest in the state file
+
+        Parameters
+        ----------
+        response_date : str
+            Date of the first response of the harvest, by the server's clock
+        failed : set
+            Identifiers of records which couldn't be read
+        '''
+        path = pathlib.Path(self.kwargs['state']).expanduser()
+        saved = json.loads(path.read_text(encoding='utf-8')) if path.exists() else {}
+        saved[self.__state_key] = {'from': response_date}
+        saved[self.__state_key].update(self.counts)
+        saved[self.__state_key]['failed'] = sorted(failed)
+        tmp = path.with_suffix(f'{path.suffix}.tmp')
+        tmp.write_text(json.dumps(saved, indent=2), encoding='utf-8')
+        tmp.replace(path)
+        LOGGER.info('Saved harvest state for %s: %s', self.__state_key, saved[self.__state_key])
+
+    def __params(self)->dict:
+        '''
+        Parameters for the first ListRecords request
+        '''
+        params = {'verb': 'ListRecords', 'metadataPrefix': self.prefix}
+        if self.kwargs.get('oai_set'):
+            params['set'] = self.kwargs['oai_set']
+        start = self.kwargs.get('from_date') or self.state.get('from')
+        if start:
+            params['from'] = start
+        if self.kwargs.get('until'):
+            params['until'] = self.kwargs['until']
+        return params
+
+    def __page(self, params:dict):
+        '''
+        Yields ('responseDate', date), ('record', element) and finally
+        ('resumptionToken', token) from one page of a ListRecords response.
+        Each record element is discarded once it has been used.
+
+        Parameters
+        ----------
+        params : dict
+            Request parameters
+        '''
+        self.limit.rate_limit()
+        LOGGER.debug('Harvesting %s, params %s', self.endpoint, params)
+        with self.session.get(self.endpoint, params=params, headers=self.headers,
+                              stream=True, timeout=self.kwargs.get('timeout', 100)) as page:
+            page.raise_for_status()
+            page.raw.decode_content = True
+            self.counts['pages'] += 1
+            parent = None
+            token = None
+            for event, elem in ET.iterparse(page.raw, events=('start', 'end')):
+                tag = _local(elem.tag)
+                if event == 'start':
+                    if tag == 'ListRecords':
+                        parent = elem
+                    continue
+                if tag == 'responseDate':
+                    yield 'responseDate', elem.text.strip()
+                elif tag == 'error':
+                    if elem.get('code') == 'noRecordsMatch':
+                        LOGGER.info('No records to harvest: %s', params)
+                        break
+                    raise OAIError(f"{elem.get('code')}: {(elem.text or '').strip()}")
+                elif tag == 'record':
+                    yield 'record', elem
+                    elem.clear()
+                    if parent is not None:
+                        parent.remove(elem)
+                elif tag == 'resumptionToken':
+                    token = (elem.text or '').strip() or None
+            yield 'resumptionToken', token
+
+    def __study(self, header:dict, record:ET.Element)->dvc.StudyMetadata:
+        '''
+        Returns StudyMetadata for a record
+
+        Parameters
+        ----------
+        header : dict
+            Record header
+        record : xml.etree.ElementTree.Element
+            OAI record element
+        '''
+        meta = (_all(record, 'metadata') or [None])[0]
+        if meta is None:
+            raise OAIError(f"No metadata for {header['identifier']}")
+        if self.prefix == 'oai_ddi':
+            codebook = (_all(meta, 'codeBook') or [meta])[0]
+            study_meta = ddi_meta(codebook, header['identifier'])
+        elif (meta.text or '').strip():
+            study_meta = json_meta(json.loads(meta.text))
+        else:
+            #Dataverse doesn't embed non-XML formats, but points to the export
+            self.limit.rate_limit()
+            exported = self.session.get(meta.get('directApiCall'), headers=self.headers,
+                                        timeout=self.kwargs.get('timeout', 100))
+            exported.raise_for_status()
+            study_meta = json_meta(exported.json())
+        return dvc.StudyMetadata(study_meta=study_meta, url=self.url,
+                                 session=self.session, **{k:v for k, v in self.kwargs.items()
+                                                          if k in ('key', 'timeout',
+                                                                   'rate_limit_on',
+                                                                   'rate_limit_min',
+                                                                   'rate_limit_max')})
+
+    @staticmethod
+    def __header(record:ET.Element)->dict:
+        '''
+        Returns the header of a record as a dict
+
+        Parameters
+        ----------
+        record : xml.etree.ElementTree.Element
+            OAI record element
+        '''
+        head = (_all(record, 'header') or [record])[0]
+        return {'identifier': _text(head, 'identifier'),
+                'datestamp': _text(head, 'datestamp'),
+                'setSpec': [_.text for _ in _all(head, 'setSpec')],
+                'deleted': head.get('status') == 'deleted'}
+
+    def __entry(self, record:ET.Element, failed:set)->tuple:
+        '''
+        Returns (header, StudyMetadata) for a record, or None if its
+        metadata can't be read, in which case its identifier is added
+        to failed.
+
+        Parameters
+        ----------
+        record : xml.etree.ElementTree.Element
+            OAI record element
+        failed : set
+            Identifiers of records which couldn't be read
+        '''
+        header = self.__header(record)
+        if header['deleted']:
+            self.counts['deleted'] += 1
+            return header, None
+        try:
+            study = self.__study(header, record)
+        except (OAIError, requests.exceptions.RequestException,
+                ValueError, KeyError, TypeError) as err:
+            LOGGER.warning('Skipping record %s: %s', header['identifier'], err)
+            self.counts['failed'] += 1
+            failed.add(header['identifier'])
+            return None
+        self.counts['records'] += 1
+        return header, study
+
+    def __pages(self, params:dict):
+        '''
+        Yields ('responseDate', date) and ('record', element) from
+        every page of a response, following resumption tokens.
+
+        Parameters
+        ----------
+        params : dict
+            Parameters of the first request
+        '''
+        while params:
+            token = None
+            for kind, value in self.__page(params):
+                if kind == 'resumptionToken':
+                    token = value
+                else:
+                    yield kind, value
+            params = {'verb': 'ListRecords', 'resumptionToken': token} if token else None
+
+    def __retries(self, retry:set):
+        '''
+        Yields ('record', element) for each record which couldn't be
+        read by the previous harvest and hasn't turned up in this one.
+
+        Parameters
+        ----------
+        retry : set
+            Identifiers of records to request again
+        '''
+        for ident in sorted(retry):
+            LOGGER.info('Retrying record %s', ident)
+            try:
+                for kind, value in self.__pages({'verb': 'GetRecord', 'identifier': ident,
+                                                 'metadataPrefix': self.prefix}):
+                    if kind == 'record':
+                        yield kind, value
+            except (OAIError, requests.exceptions.RequestException) as err:
+                LOGGER.warning('Record %s is still unavailable: %s', ident, err)
+                yield 'failed', ident
+
+    def records(self):
+        '''
+        Yields (header, StudyMetadata) for every record in the harvest.
+
+        The header is a dict with the OAI identifier (the study's
+        persistent ID), datestamp, setSpec (a list) and deleted
+        (bool). For deleted records the StudyMetadata is None.
+
+        A record whose metadata can't be read is logged and skipped.
+        With a state file, skipped records are listed in it and
+        requested again by the next harvest.
+        '''
+        response_date = None
+        self.counts = {'records': 0, 'deleted': 0, 'failed': 0, 'pages': 0}
+        retry = set(self.state.get('failed', []))
+        failed = set()
+        for kind, value in self.__pages(self.__params()):
+            if kind == 'responseDate':
+                response_date = response_date or value
+                continue
+            retry.discard(_text(value, 'identifier'))
+            entry = self.__entry(value, failed)
+            if entry:
+                yield entry
+        for kind, value in self.__retries(retry):
+            if kind == 'failed':
+                failed.add(value)
+                continue
+            entry = self.__entry(value, failed)
+            if entry:
+                yield entry
+        LOGGER.info('Harvest of %s complete: %s', self.__state_key, self.counts)
+        if self.kwargs.get('state') and response_date:
+            self.__save_state(response_date, failed)
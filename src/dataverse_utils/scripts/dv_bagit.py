@@ -50,6 +50,17 @@ def parse()->argparse.ArgumentParser:
                               'if present. Optional'))
     parser.add_argument('--contact-phone',
                         help='Bag contact telephone number. Optional')
+    parser.add_argument('-w', '--workers',
+                        help='Number of files to download at once. Default 1',
+                        default=1,
+                        type=int)
+    parser.add_argument('--adaptive',
+                        help=textwrap.fill(textwrap.dedent(
+                        '''
+                        Adjust the number of downloads at once, up to
+                        --workers, to what the server can handle
+                        '''), 80),
+                        action='store_true')
     parser.add_argument('pids',
                         help='Dataverse study persistent identifier(s) (DOI/handle)',
                         nargs='+')
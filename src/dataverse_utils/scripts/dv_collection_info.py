@@ -3,16 +3,20 @@ Recursively parses a dataverse collection and
 outputs study metadata for the latest version
 '''
 import argparse
-import io
 import csv
+import json
 import logging
 import pathlib
 import sqlite3
 import sys
+import tempfile
 import textwrap
+import typing
 
 import pandas as pd # I could use sqlite but why go the hassle
+import requests
 import dataverse_utils
+import dataverse_utils.cache
 import dataverse_utils.collections as dvc
 
 def parse() -> argparse.ArgumentParser():
@@ -89,6 +93,45 @@ def parse() -> argparse.ArgumentParser():
                         help='Timeout for lengthy requests, default 300s',
                         default=300,
                         type=float)
+    parser.add_argument('-w', '--workers',
+                        help=textwrap.fill(textwrap.dedent(
+                        '''
+                        Number of requests to make at once while crawling.
+                        The rate limit applies across all of them. Default 4.
+                        '''),80),
+                        default=4,
+                        type=int)
+    parser.add_argument('--adaptive',
+                        help=textwrap.fill(textwrap.dedent(
+                        '''
+                        Start with one request at a time and add more, up to
+                        --workers, while the server keeps up. Cut back on
+                        errors or slow responses.
+                        '''),80),
+                        action='store_true')
+    parser.add_argument('-S', '--search',
+                        help=textwrap.fill(textwrap.dedent(
+                        '''
+                        Find studies with the search API instead of crawling
+                        every collection. Much faster for collections with
+                        many subcollections. The metadata of each study is
+                        still fetched, --workers at a time, as it's needed
+                        for the file information.
+                        '''),80),
+                        action='store_true')
+    parser.add_argument('--incremental',
+                        help=textwrap.fill(textwrap.dedent(
+                        '''
+                        Update an existing SQLite output (-s) of a collection,
+                        fetching only the studies which have been added or
+                        changed since it was made, and removing those which
+                        have gone. Changes are found with the search API.
+                        If there is no earlier output, all studies are
+                        fetched. With --cache, cached responses are always
+                        checked with the server.
+                        '''),80),
+                        action='store_true')
+    dataverse_utils.cache.add_arguments(parser)
     group = parser.add_argument_group(title='Harvest options',
                                       description=textwrap.fill(
                                       'You can obtain info for *either* a recursive crawl '
@@ -106,38 +149,41 @@ def parse() -> argparse.ArgumentParser():
                         help='Show version number and exit')
     return parser
 
-def fields(include_all:bool, is_file:bool, all_studies)->dict:
+class Spool:
     '''
-    Outputs appropriate header fields based on argparse values
+    Rows for one output, kept in a temporary file as they arrive,
+    because the column names aren't known until every study has been seen
     '''
-    match (include_all, is_file):
-        case (0, 0):
-            fieldnames = sorted(list(set(key for study in all_studies for key in study)))
-        case (1, 0):
-            fieldnames = sorted(list(set(key for study in all_studies
-                                         for ver in study.versions
-                                         for key in study.version_metadata(ver))))
-        case (0, 1):
-            fieldnames = sorted(list(set(key for study in all_studies
-                                         for file in study.files
-                                         for key in file)))
-        #this is actually an outer join
-        #case (1, 1, 0):
-        #    fieldnames1 = sorted(list(set(key for study in coll_me.studies
-        #                  for ver in study.versions
-        #                  for file in study.version_files(ver)
-        #                  for key in file)))
-        #    fieldnames = sorted(list(set(key for study in coll_me.studies
-        #                                 for ver in study.versions
-        #                                 for key in study.version_metadata(ver))))
-        #    fieldnames.extend(fieldnames1)
-        case (1, 1):
-            fieldnames = sorted(list(set(key for study in all_studies
-                          for ver in study.versions
-                          for file in study.version_files(ver)
-                          for key in file)))
+    def __init__(self):
+        self.file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self.fields = set()
+        self.rows = 0
 
-    return fieldnames
+    def add(self, row:dict):
+        '''
+        Add a row of output, removing tabs and line breaks from text
+        '''
+        data = {k:v.replace('\t',' ').replace('\r\n', ' ').replace('\n',' ')
+                         if isinstance(v, str) else v
+                         for k, v in row.items()}
+        self.fields.update(data)
+        self.rows += 1
+        self.file.write(json.dumps(data, default=str) + '\n')
+
+    def write(self, out:typing.TextIO, delimiter:str):
+        '''
+        Write the rows as delimited text, with a header of all the column
+        names in alphabetical order
+        '''
+        writer = csv.DictWriter(out,
+                                fieldnames=sorted(self.fields),
+                                delimiter=delimiter,
+                                quoting=csv.QUOTE_MINIMAL,
+                                extrasaction='ignore')
+        writer.writeheader()
+        self.file.seek(0)
+        for line in self.file:
+            writer.writerow(json.loads(line))
 
 def output(study, include_all=False, file=False)->list:
     '''
@@ -171,6 +217,40 @@ def output(study, include_all=False, file=False)->list:
         case _:
             return []
 
+def known_studies(args:argparse.Namespace)->dict:
+    '''
+    Returns {pid: update statement} from the harvest_state table
+    of an existing SQLite output, or an empty dict if there isn't one
+    '''
+    path = pathlib.Path(args.output+extension(args)).expanduser()
+    if not path.exists():
+        return {}
+    conn = sqlite3.connect(path)
+    try:
+        return dict(conn.execute('SELECT pid, updated FROM harvest_state').fetchall())
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
+
+def merge(conn:sqlite3.Connection, table:str, new:pd.DataFrame, refresh:dict)->pd.DataFrame:
+    '''
+    Returns the existing contents of table, with the rows for changed and
+    removed studies replaced by the new data
+    '''
+    try:
+        old = pd.read_sql(f'SELECT * FROM {table}', conn)
+    except pd.errors.DatabaseError:
+        return new
+    col = 'pid' if table == 'studies' else 'dataset_pid'
+    if col in old:
+        gone = set(refresh['removed']) | {_['pid'] for _ in refresh['changed']}
+        old = old[~old[col].isin(gone)]
+    if new.empty:
+        return old
+    out = pd.concat([old, new], ignore_index=True)
+    return out[sorted(out.columns)]
+
 def extension(args:argparse.ArgumentParser):
     '''
     Return extension for output
@@ -209,21 +289,39 @@ def main():
     You know what this is
     '''
     #pylint: disable=too-many-branches, too-many-locals, too-many-statements
-    args = parse().parse_args()
+    parser = parse()
+    args = parser.parse_args()
+    if args.incremental and not (args.sqlite and args.collection):
+        parser.error('--incremental requires SQLite output (-s) and a collection (-c)')
     logger = logme(args)
+    session = requests.Session()
+    if args.cache:
+        #An incremental harvest must see today's changes, so everything is
+        #checked with the server; unchanged responses still cost only a 304
+        session = dataverse_utils.cache.cached_session(args.cache,
+                                                       ttl=0 if args.incremental
+                                                       else args.cache_ttl,
+                                                       pool_maxsize=max(10, args.workers))
     if args.collection:
         coll_me = dvc.DvCollection(args.url, args.collection, args.key,
                                    rate_limit_on=not args.rate_limit_off,
                                    rate_limit_min=args.rate_limit_min,
                                    rate_limit_max=args.rate_limit_max,
-                                   timeout=args.timeout)
+                                   timeout=args.timeout,
+                                   workers=args.workers,
+                                   adaptive=args.adaptive,
+                                   session=session)
         try:
-            coll_me.get_studies()
-            all_studies = coll_me.studies
-            if not all_studies: #Stupid but this happens
-                print('No studies in collection', file=sys.stderr)
-                logger.warning('No studies to process in collection %s', args.collection)
-                sys.exit()
+            if args.incremental:
+                refresh = coll_me.refresh_studies(known_studies(args))
+                all_studies = refresh['changed']
+            elif args.search:
+                #File rows need the complete record of each study anyway,
+                #and the study rows should have what's only in that
+                all_studies = coll_me.search_studies(complete=True)
+            else:
+                #Studies are written out as they arrive
+                all_studies = coll_me.iter_studies()
         except dataverse_utils.collections.MetadataError as e:
             print(e, file=sys.stderr)
             logger.critical(e)
@@ -237,48 +335,62 @@ def main():
             all_studies = [dvc.StudyMetadata(url=args.url, pid=args.pid, key=args.key,
                                              rate_limit_on=True,
                                              rate_limit_min=0.25,
-                                             rate_limit_max=1)]
+                                             rate_limit_max=1,
+                                             session=session)]
         except (KeyError, dataverse_utils.collections.MetadataError) as e:
             print(e, file=sys.stderr)
             logger.critical(e)
             sys.exit()
-    fname = {0: '_studies', 1:'_files'}
-    outdata = {}
-    for stud_file in range(2): # studies and files
-        fieldnames = fields(args.include_all_versions, stud_file, all_studies)
-        logger.info(fieldnames)
-        out = io.StringIO(newline='')
-        writer = csv.DictWriter(out,
-                                fieldnames=fieldnames,
-                                delimiter=args.delimiter,
-                                quoting=csv.QUOTE_MINIMAL,
-                                extrasaction='ignore')
-        writer.writeheader()
+    spools = {'studies': Spool(), 'files': Spool()}
+    try:
         for stud in all_studies:
             logger.info(stud)
-            for row in output(stud, args.include_all_versions, stud_file):
-                data = {k:v.replace('\t',' ').replace('\r\n', ' ').replace('\n',' ')
-                                 if isinstance(v, str) else v
-                                 for k, v in row.items()}
-                logger.debug(data)
-                writer.writerow(data)
-        out.seek(0)
-        outdata[fname[stud_file][1:]] = out
+            for stud_file, spool in enumerate(spools.values()): # studies and files
+                for row in output(stud, args.include_all_versions, stud_file):
+                    logger.debug(row)
+                    spool.add(row)
+    except dataverse_utils.collections.MetadataError as e:
+        print(e, file=sys.stderr)
+        logger.critical(e)
+        sys.exit()
+    except TypeError as e:
+        print(f'Error with parsing collection: {args.collection}', file=sys.stderr)
+        logger.critical(e)
+        sys.exit()
+    if not spools['studies'].rows and not args.incremental: #Stupid but this happens
+        print('No studies in collection', file=sys.stderr)
+        logger.warning('No studies to process in collection %s', args.collection)
+        sys.exit()
+    outdata = {}
+    for name, spool in spools.items():
+        logger.info(sorted(spool.fields))
         if not args.sqlite:
-            outf =  pathlib.Path(args.output+f'{fname[stud_file]}{extension(args)}').expanduser()
-            with open(outf,
-                       'w', encoding='utf-8') as f:
+            outf =  pathlib.Path(args.output+f'_{name}{extension(args)}').expanduser()
+            with open(outf, 'w', encoding='utf-8', newline='') as f:
                 print(f'Writing {str(outf)}', file=sys.stdout)
-                f.write(out.read())
-
+                spool.write(f, args.delimiter)
+        elif spool.rows:
+            out = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+            spool.write(out, args.delimiter)
+            out.seek(0)
+            outdata[name] = out
+    #All the requests are done; this also logs cache use
+    session.close()
 
     if args.sqlite:
         print(f'Writing {str(pathlib.Path(args.output+extension(args)).expanduser())}',
               file=sys.stdout)
         conn = sqlite3.connect(pathlib.Path(args.output+extension(args)).expanduser())
-        for k,v in outdata.items():
-            x = pd.read_csv(v, delimiter=args.delimiter)
+        for k in spools:
+            x = (pd.read_csv(outdata[k], delimiter=args.delimiter) if k in outdata
+                 else pd.DataFrame())
+            if args.incremental:
+                x = merge(conn, k, x, refresh)
             x.to_sql(k, conn, if_exists='replace', index=0)
+        if args.incremental:
+            pd.DataFrame(list(refresh['updated'].items()),
+                         columns=['pid', 'updated']).to_sql('harvest_state', conn,
+                                                            if_exists='replace', index=0)
         cursor = conn.cursor()
         cursor.execute('DROP VIEW IF EXISTS short_combined_view;')
         query = textwrap.fill(textwrap.dedent(
@@ -6,6 +6,7 @@ and functions to upload files complete with metadata.
 
 import argparse
 import glob
+import itertools
 import os
 import pathlib
 #import re
@@ -69,6 +70,12 @@ def parse() -> argparse.ArgumentParser():
     parser.add_argument('-p', '--path',
                         help=('Include an optional path column for custom file paths'),
                         action='store_true')
+    parser.add_argument('-c', '--checksum',
+                        help=('Include a checksum column. May be used twice to include '
+                              'both. Checksums are calculated in parallel. '
+                              'Options: md5, sha256'),
+                        choices=['md5', 'sha256'],
+                        action='append')
     parser.add_argument('--version', action='version',
                         version=du.script_ver_stmt(parser.prog),
                         help='Show version number and exit')
@@ -93,6 +100,33 @@ def quotype(quote: str)-> int:
             'none' : 3}
     return vals.get(quote.lower(), -1)
 
+def find_files(args:argparse.Namespace):
+    '''
+    Generator yielding the files selected on the command line. Directories
+    are walked with os.scandir (see `dataverse_utils.walk_files`), so files
+    are yielded as they are found without extra stat calls.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed arguments
+    '''
+    if not args.files:
+        starts = ['.']
+    else:
+        starts = [_ for file in args.files
+                  for _ in glob.glob(file, include_hidden=args.show_hidden)]
+    for start in starts:
+        if os.path.isdir(start):
+            #Top level files only, unless recursive
+            if not args.files or args.recursive:
+                #Hidden directories are skipped, as glob did before
+                for fil in du.walk_files(start, hidden=args.show_hidden,
+                                         recursive=args.recursive, prune=True):
+                    yield os.path.normpath(fil)
+        elif os.path.isfile(start) and pathlib.Path(start).stem != '':
+            yield os.path.normpath(start)
+
 def main() -> None:
     '''
     The main function call
@@ -103,26 +137,13 @@ def main() -> None:
     if  args.quote == -1:
         parser.error('Invalid quotation type')
 
-    f_list = []
-    for file in args.files:
-        if not args.recursive:
-            f_list += glob.glob(file,
-                      include_hidden=args.show_hidden)
-        else:
-            f_list += glob.glob(file+'/**', recursive=True,
-                                include_hidden=args.show_hidden)
-    if not f_list and not args.files:
-        if not args.recursive:
-            f_list += glob.glob('./*', include_hidden=args.show_hidden)
-        else:
-            f_list += glob.glob('./**', recursive=True,
-                                include_hidden=args.show_hidden)
-    f_list = [pathlib.Path(_) for _ in f_list]
-    f_list = [_ for _ in f_list if _.stem != '' and _.exists() and _.is_file()]
-    if not f_list:
+    f_list = find_files(args)
+    first = next(f_list, None)
+    if first is None:
         #nothing to do
         print('Nothing matching these criteria. No manifest generated')
         sys.exit()
+    f_list = itertools.chain([first], f_list)
 
     if args.filename:
         du.dump_tsv(os.getcwd(), filename=args.filename,
@@ -131,14 +152,16 @@ def main() -> None:
                     inc_header=args.inc_header,
                     quotype=args.quote,
                     mime=args.mime,
-                    path=args.path)
+                    path=args.path,
+                    checksum=args.checksum)
     else:
-        print(du.make_tsv(os.getcwd(), in_list=f_list,
-                          def_tag=args.tag,
-                          inc_header=args.inc_header,
-                          quotype=args.quote,
-                          mime=args.mime,
-                          path=args.path))
+        du.write_tsv(sys.stdout, os.getcwd(), in_list=f_list,
+                     def_tag=args.tag,
+                     inc_header=args.inc_header,
+                     quotype=args.quote,
+                     mime=args.mime,
+                     path=args.path,
+                     checksum=args.checksum)
 
 if __name__ == '__main__':
     main()
@@ -7,6 +7,7 @@ import pathlib
 import sys
 import textwrap
 import dataverse_utils
+import dataverse_utils.cache
 import dataverse_utils.collections as c
 
 FTYPE = 'File extension must be one of .pdf, .md or .txt (case insensitive).'
@@ -41,6 +42,7 @@ def parse() -> argparse.ArgumentParser():
                         required=True)
     parser.add_argument('-k', '--key', required=True,
                         help='API key', default=None)
+    dataverse_utils.cache.add_arguments(parser)
     parser.add_argument('outfile',
                         help = f'Output file. {FTYPE}')
     parser.add_argument('-v', '--version', action='version',
@@ -92,7 +94,11 @@ def main():
             sys.exit()
 
     fpath = pathlib.Path(args.outfile).expanduser().absolute()
-    study = c.StudyMetadata(url=args.url, pid=args.pid, key=args.key)
+    cached = {}
+    if args.cache:
+        cached['session'] = dataverse_utils.cache.cached_session(args.cache,
+                                                                 ttl=args.cache_ttl)
+    study = c.StudyMetadata(url=args.url, pid=args.pid, key=args.key, **cached)
     study_rm = c.ReadmeCreator(study, url=args.url, pid=args.pid, key=args.key)
     if fpath.suffix.lower() == '.pdf':
         study_rm.write_pdf(str(fpath))
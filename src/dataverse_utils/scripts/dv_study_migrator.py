@@ -2,6 +2,7 @@
 Copies an entire record and migrates it *including the data*
 '''
 import argparse
+import hashlib
 import logging
 import textwrap
 import sys
@@ -135,24 +136,39 @@ def upload_file_to_target(indict:dict, pid,#pylint: disable = too-many-arguments
         API key for target dataverse instance
     '''
     file = dataverse_utils.dvdata.File(source_url, source_key, **indict)
-    file.download_file()
-    file.verify()
     label = file['dataFile'].get('originalFileName',
                 file['dataFile'].get('filename', file['label']))
     mimetype=file['dataFile'].get('originalFileFormat',
                 file['dataFile'].get('contentType','application/octet-stream'))
-    if file['verified']:
-        dataverse_utils.upload_file(fpath=file['downloaded_file_name'],
-                                    dv=target_url,
-                                    mimetype=mimetype,
-                                    apikey=target_key,
-                                    hdl=pid,
-                                    rest=file.get('restricted'),
-                                    label=label,
-                                    dirlabel=file.get('directoryLabel', ''),
-                                    descr=file.get('description', ''),
-                                    tags=file.get('categories')
-                                    )
+    #Copy straight from the source to the target without a temporary file,
+    #checking the bytes sent against the source checksum on the way
+    checksum = file['dataFile']['checksum']
+    _hash = hashlib.new(checksum['type'].replace('-', '').lower())
+    chunks, size = file.stream_file()
+    def hashed():
+        for chunk in chunks:
+            _hash.update(chunk)
+            yield chunk
+    data_file = dataverse_utils.upload_file(fpath=hashed(),
+                                            size=size,
+                                            dv=target_url,
+                                            mimetype=mimetype,
+                                            apikey=target_key,
+                                            hdl=pid,
+                                            rest=file.get('restricted'),
+                                            label=label,
+                                            dirlabel=file.get('directoryLabel', ''),
+                                            descr=file.get('description', ''),
+                                            tags=file.get('categories')
+                                            )
+    if _hash.hexdigest() != checksum['value']:
+        logging.getLogger(__name__).critical('Checksum mismatch in %s from %s',
+                                             label, source_url)
+        #The stream is only checked once it has been sent, by which time
+        #the bad copy is in the target study, so it has to be taken out again
+        remove_target_files({'url': target_url.strip('/ '), 'key': target_key, 'pid': pid,
+                             'file_ids': [data_file['id']]}, log=logging.getLogger(__name__))
+        raise dataverse_utils.Md5Error(f'{checksum["type"]} mismatch in {label}')
 
 def remove_target_files(record:dataverse_utils.dvdata.Study, timeout:int=100, log=None):
     '''
@@ -6,8 +6,10 @@ from the TSV.
 '''
 
 import argparse
+import collections
 import sys
 import textwrap
+import time
 
 import dataverse_utils as du
 
@@ -34,8 +36,11 @@ def parse() -> argparse.ArgumentParser():
                                      formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('tsv', help='TSV file to upload')
     parser.add_argument('-p', '--pid',
-                        help='Dataverse study persistent identifier (DOI/handle)',
-                        required=True)
+                        help=textwrap.dedent('''
+                            Dataverse study persistent identifier (DOI/handle).
+                            Required unless every row of the TSV has a
+                            study in a "pid" column.
+                            '''))
     parser.add_argument('-k', '--key', required=True,
                         help='API key')
     parser.add_argument('-u', '--url', default='https://abacus.library.ubc.ca',
@@ -73,28 +78,196 @@ def parse() -> argparse.ArgumentParser():
 
                             '''))
 
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help=textwrap.dedent('''
+                            Number of files to upload concurrently.
+                            Default: 1
+                            '''))
+
+    parser.add_argument('-l', '--pipeline', action='store_true',
+                        help=textwrap.dedent('''
+                            Upload files back-to-back without waiting
+                            for the study lock after each file. Files
+                            which may be ingested as tabular data are
+                            uploaded last.
+                            '''))
+
+    parser.add_argument('-j', '--journal', action='store_true',
+                        help=textwrap.dedent('''
+                            Keep a journal of the upload in
+                            [tsv].journal.sqlite3. Rerunning the same
+                            command skips files which have already been
+                            uploaded and resumes interrupted ones.
+                            '''))
+
+    parser.add_argument('-s', '--sync', action='store_true',
+                        help=textwrap.dedent('''
+                            Synchronize the study with the TSV. Files whose
+                            checksums match the study copy are skipped,
+                            changed files are replaced and files which are
+                            only in the study are listed (not deleted).
+                            '''))
+
+    parser.add_argument('-d', '--lanes', type=int, default=4,
+                        help=textwrap.dedent('''
+                            Number of studies to upload to at once when
+                            the TSV has a "pid" column. Files for each
+                            study are uploaded in their own lane.
+                            Default: 4
+                            '''))
+
+    parser.add_argument('-e', '--report',
+                        help=textwrap.dedent('''
+                            Write per-file timings (bytes, transfer and
+                            server time, lock waits, requests, MB/s) and a
+                            summary to this file. Files ending in .csv are
+                            written as CSV, otherwise as JSON lines.
+                            '''))
+
+    parser.add_argument('-b', '--bundle', type=int, nargs='?',
+                        const=du.BUNDLE_SIZE, metavar='SIZE',
+                        help=textwrap.dedent(f'''
+                            Pack files of up to SIZE bytes into zip
+                            files which Dataverse unpacks, so that many
+                            small files need far fewer uploads. Tabular
+                            and zip files are never bundled.
+                            Default SIZE: {du.BUNDLE_SIZE}
+                            '''))
+
+    parser.add_argument('-g', '--direct', type=int, nargs='?',
+                        const=du.DIRECT_SIZE, metavar='SIZE',
+                        help=textwrap.dedent(f'''
+                            Send files of at least SIZE bytes straight
+                            to the study's S3 storage, in parallel parts,
+                            instead of through the Dataverse server. The
+                            storage must allow direct upload.
+                            Default SIZE: {du.DIRECT_SIZE}
+                            '''))
+
+    parser.add_argument('--adaptive', action='store_true',
+                        help=textwrap.dedent('''
+                            Start with one upload at a time and add more,
+                            up to workers x lanes, while the server keeps
+                            up. Cut back on errors or slow responses.
+                            '''))
+
+    parser.add_argument('-x', '--dry-run', action='store_true', dest='dry',
+                        help=textwrap.dedent('''
+                            Don't upload anything. Print the number and size
+                            of files by type, the files likely to cause an
+                            ingest lock and an estimated upload time. The
+                            estimate uses the rates from an earlier
+                            --report file if one is given.
+                            '''))
+
     parser.add_argument('-v', '--version', action='version',
                         version=du.script_ver_stmt(parser.prog),
                         help='Show version number and exit')
     return parser
 
+def dry_run(args:argparse.Namespace) -> None:
+    '''
+    Prints an upload plan for the TSV
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed arguments
+    '''
+    with open(args.tsv, newline='', encoding='utf-8') as fil:
+        plan = du.upload_plan(fil, hdl=args.pid, trunc=args.truncate,
+                              override=args.override, workers=args.workers,
+                              lanes=args.lanes, history=args.report)
+    print(f'{plan["files"]} file(s), {plan["bytes"]/1e6:.1f} MB '
+          f'for {plan["studies"]} stud{"y" if plan["studies"] == 1 else "ies"}')
+    for ext, kind in sorted(plan['types'].items(), key=lambda x: -x[1]['bytes']):
+        print(f'  {ext or "[none]"}: {kind["files"]} file(s), {kind["bytes"]/1e6:.1f} MB')
+    print(f'Likely ingest locks: {plan["ingest"]}')
+    print(f'Tabular files uploaded without ingest: {plan["notab"]}')
+    if plan['eta'] is not None:
+        #Large manifests can take days, so no wrapping at 24 hours
+        hours, rest = divmod(round(plan['eta']), 3600)
+        print(f'Estimated time: {hours:02d}:{rest//60:02d}:{rest%60:02d} '
+              f'({plan["mbps"]:.2f} MB/s, {plan["overhead"]:.1f}s per file)')
+    else:
+        print('Estimated time: unknown; use --report with a previous report')
+    for missing in plan['missing']:
+        print(f'Missing: {missing}', file=sys.stderr)
+
+def show_results(results:list, summary:dict, stats:dict) -> None:
+    '''
+    Prints the outcome of an upload, exiting with an error if any file failed
+
+    Parameters
+    ----------
+    results : list
+        Result dicts from upload_from_tsv
+
+    summary : dict
+        Summary from upload_summary
+
+    stats : dict
+        Connection use from session_stats
+    '''
+    failed = [_ for _ in results if _['status'] == 'failed']
+    rows = [_ for _ in results if _['status'] != 'removed']
+    counts = collections.Counter(_['status'] for _ in rows)
+    sent = sum(counts.pop(_, 0) for _ in ('uploaded', 'complete', 'replaced'))
+    others = ', '.join(f'{v} {k}' for k, v in sorted(counts.items()))
+    print(f'{sent} of {len(rows)} file(s) uploaded' + (f' ({others})' if others else ''))
+    print(f'{stats["requests"]} request(s) over {stats["connections"]} connection(s)')
+    print(f'{summary["bytes"]/1e6:.1f} MB in {summary["elapsed"]:.1f}s '
+          f'({summary["mbps"]:.2f} MB/s); transfer {summary["transfer"]:.1f}s, '
+          f'server {summary["server"]:.1f}s, lock wait {summary["lock_wait"]:.1f}s, '
+          f'restrict {summary["restrict"]:.1f}s')
+    for gone in [_ for _ in results if _['status'] == 'removed']:
+        print(f'Only in study: {gone["file"]} (file id {gone["fid"]})')
+    for fail in failed:
+        print(f'Upload failed: {fail["file"]}: {fail["error"]}', file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
 def main() -> None:
     '''
     Uploads data to an already existing Dataverse study
     '''
     parser = parse()
     args = parser.parse_args()
+    if args.dry:
+        dry_run(args)
+        return
     if not args.nc and not args.rest:
         conf = input('File(s) will be unrestricted. Continue (y/n)? ')
         if conf.lower() == 'n' or conf.lower() == 'no':
             print('Transfer aborted')
             sys.exit()
 
-    with open(args.tsv, newline='', encoding='utf-8') as fil:
-        du.upload_from_tsv(fil, hdl=args.pid,
-                           dv=args.url, apikey=args.key,
-                           trunc=args.truncate, rest=args.rest,
-                           override = args.override)
+    #Closed on the way out, including after a failed upload
+    with du.make_session(max(10, args.workers * args.lanes)) as session:
+        start = time.perf_counter()
+        with open(args.tsv, newline='', encoding='utf-8') as fil:
+            try:
+                results = du.upload_from_tsv(fil, hdl=args.pid,
+                                             dv=args.url, apikey=args.key,
+                                             trunc=args.truncate, rest=args.rest,
+                                             override = args.override,
+                                             workers=args.workers,
+                                             lanes=args.lanes,
+                                             pipeline=args.pipeline,
+                                             session=session,
+                                             journal=args.journal,
+                                             sync=args.sync,
+                                             report=args.report,
+                                             bundle=args.bundle,
+                                             direct=args.direct,
+                                             adaptive=args.adaptive)
+            except KeyError as err:
+                print(f'Upload aborted: {err}', file=sys.stderr)
+                sys.exit(1)
+        summary = du.upload_summary(results, time.perf_counter() - start)
+        #Read before closing, which discards the connection pools
+        stats = du.session_stats(session)
+    show_results(results, summary, stats)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,259 @@
+'''
+Checksums and streams for uploads: hashing files, hashing while
+reading, and multipart bodies of unknown length
+'''
+
+import hashlib
+import mmap
+import os
+import stat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
+
+def file_digest(fpath, prot='md5', blocksize:int=2**20):
+    '''
+    Returns the hex digest of a file. If prot is a list or tuple of
+    hash types, all of them are calculated in a single read and a
+    dict of {hash type: hex digest} is returned.
+
+    Parameters
+    ----------
+    fpath : str
+        File location
+
+    prot : str or list, optional, default='md5'
+        Hash type; any algorithm supported by hashlib, eg. 'md5', 'sha1', 'sha256'
+
+    blocksize : int, optional, default=2**20
+        Hash block size in bytes
+
+    Notes
+    -----
+    The file is memory-mapped rather than read into buffers, so that
+    large files are hashed without copying.
+    '''
+    prots = [prot] if isinstance(prot, str) else list(prot)
+    hashes = {_: hashlib.new(_) for _ in prots}
+    with open(fpath, 'rb') as fobj:
+        size = os.fstat(fobj.fileno()).st_size
+        if size:
+            with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for start in range(0, size, blocksize):
+                        for _hash in hashes.values():
+                            _hash.update(view[start:start+blocksize])
+    if isinstance(prot, str):
+        return hashes[prot].hexdigest()
+    return {k: v.hexdigest() for k, v in hashes.items()}
+
+def _digest_job(job:tuple):
+    '''
+    Picklable wrapper around `file_digest` for process pools.
+
+    Parameters
+    ----------
+    job : tuple
+        (fpath, prot, errors). If errors is True, an OSError
+        is returned instead of raised.
+    '''
+    try:
+        return file_digest(job[0], job[1])
+    except OSError as err:
+        if job[2]:
+            return err
+        raise
+
+def digest_files(files:list, prot='md5', workers:int=None, processes:bool=False,#pylint: disable=too-many-arguments, too-many-positional-arguments
+                 errors:bool=False) -> dict:
+    '''
+    Returns a dict of {file: hex digest} for a list of files, hashing
+    several files at once. If prot is a list, the values are
+    dicts of {hash type: hex digest}.
+
+    Parameters
+    ----------
+    files : list
+        List of file locations
+
+    prot : str or list, optional, default='md5'
+        Hash type; any algorithm supported by hashlib
+
+    workers : int, optional
+        Number of files to hash concurrently. Defaults to the number of CPUs.
+
+    processes : bool, optional, default=False
+        Use a process pool instead of threads, which spreads
+        many small files across cores more effectively.
+
+    errors : bool, optional, default=False
+        If True, the value for a file which can't be read is the
+        OSError, rather than the error stopping everything.
+    '''
+    files = [str(_) for _ in files]
+    workers = workers if workers else (os.cpu_count() or 1)
+    if processes:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(files, pool.map(_digest_job, [(_, prot, errors) for _ in files],
+                                            chunksize=max(1, len(files)//(workers*4)))))
+    #hashlib releases the GIL on large blocks, so threads are fine here
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(files, pool.map(lambda x: _digest_job((x, prot, errors)), files)))
+
+class HashingReader:
+    '''
+    Read-only file wrapper which hashes bytes as they are read, so that
+    a file can be checksummed while it is being uploaded.
+    '''
+    def __init__(self, fobj, prot='md5', size:int=None):
+        '''
+        Wrap an open binary file or stream.
+
+        Parameters
+        ----------
+        fobj : file
+            File object opened in binary mode, or anything with
+            a read method which returns bytes
+
+        prot : str or list, optional, default='md5'
+            Hash type(s); any algorithm supported by hashlib
+
+        size : int, optional
+            Number of bytes which will be read. Found automatically
+            for regular files; otherwise None means unknown.
+        '''
+        self.fobj = fobj
+        prots = [prot] if isinstance(prot, str) else list(prot)
+        self.hashes = {_: hashlib.new(_) for _ in prots}
+        self.count = 0
+        self.pos = 0
+        if size is None:
+            try:
+                fstat = os.fstat(fobj.fileno())
+                if stat.S_ISREG(fstat.st_mode):
+                    size = fstat.st_size
+                    self.pos = fobj.tell()
+            except (AttributeError, OSError, ValueError):
+                pass
+        self.size = size
+
+    @property
+    def len(self) -> int:
+        '''
+        Bytes remaining, or None if unknown. MultipartEncoder uses
+        this to find the length of the request body.
+        '''
+        if self.size is None:
+            return None
+        return self.size - self.pos
+
+    def read(self, size:int=-1) -> bytes:
+        '''
+        Read from the file, updating the hashes
+
+        Parameters
+        ----------
+        size : int, optional, default=-1
+            Number of bytes to read. -1 reads to the end of the file.
+        '''
+        chunk = self.fobj.read(size)
+        self.pos += len(chunk)
+        self.count += len(chunk)
+        for _hash in self.hashes.values():
+            _hash.update(chunk)
+        return chunk
+
+    def hexdigest(self, prot:str='md5') -> str:
+        '''
+        Returns the hex digest of the bytes read so far
+
+        Parameters
+        ----------
+        prot : str, optional, default='md5'
+            Hash type
+        '''
+        return self.hashes[prot].hexdigest()
+
+class _IterStream:
+    '''
+    File-like wrapper for an iterator of bytes, such as
+    requests.Response.iter_content()
+    '''
+    def __init__(self, chunks):
+        '''
+        Wrap an iterable.
+
+        Parameters
+        ----------
+        chunks : iterable
+            Iterable of bytes
+        '''
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def readable(self) -> bool:
+        '''
+        Always True; the stream can only be read
+        '''
+        return True
+
+    def read(self, size:int=-1) -> bytes:
+        '''
+        Read from the iterator
+
+        Parameters
+        ----------
+        size : int, optional, default=-1
+            Maximum number of bytes to read. -1 reads everything.
+        '''
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer.extend(next(self.chunks))
+            except StopIteration:
+                break
+        size = len(self.buffer) if size < 0 else min(size, len(self.buffer))
+        out = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return out
+
+def _multipart_stream(fields:dict, callback=None, blocksize:int=2**20) -> tuple:
+    '''
+    Returns a tuple of (generator, content type) for a multipart/form-data
+    body of unknown length, which requests sends with chunked
+    transfer encoding.
+
+    Parameters
+    ----------
+    fields : dict
+        Fields as for MultipartEncoder. File fields are tuples of
+        (file name, readable object, mimetype).
+
+    callback : function, optional
+        Called once the body has been generated
+
+    blocksize : int, optional, default=2**20
+        Read size for files
+    '''
+    boundary = choose_boundary()
+    def body():
+        for name, value in fields.items():
+            if isinstance(value, tuple):
+                field = RequestField(name, b'', filename=value[0])
+                field.make_multipart(content_type=value[2])
+            else:
+                field = RequestField(name, value)
+                field.make_multipart()
+            yield f'--{boundary}\r\n{field.render_headers()}'.encode()
+            if isinstance(value, tuple):
+                chunk = value[1].read(blocksize)
+                while chunk:
+                    yield chunk
+                    chunk = value[1].read(blocksize)
+            else:
+                yield value.encode() if isinstance(value, str) else value
+            yield b'\r\n'
+        yield f'--{boundary}--\r\n'.encode()
+        if callback:
+            callback()
+    return body(), f'multipart/form-data; boundary={boundary}'
@@ -0,0 +1,458 @@
+'''
+Request throttling shared by everything talking to the same server.
+
+Each host has a single token bucket for the whole process, however many
+objects or threads are making requests to it. Tokens accumulate at the
+permitted rate while nothing is happening, up to the burst size, so that
+requests are only delayed when they would otherwise exceed the rate. A
+server asking for a pause with `Retry-After` pauses every request to it,
+not just the one which was refused.
+
+Separately, a `Controller` can limit how many requests are in progress
+at once, raising the limit while the server keeps up and cutting it when
+it returns errors or slows down.
+'''
+import contextlib
+import logging
+import threading
+import time
+import urllib.parse
+
+from urllib3.util import Retry as _Retry
+
+LOGGER = logging.getLogger(__name__)
+
+_BUCKETS = {}
+_LOCK = threading.Lock()
+#Response hooks added by hooked, with the number of users of each
+_HOOKS = {}
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket for one host.
+    '''
+    #pylint: disable=too-many-instance-attributes
+    def __init__(self, host:str, rate:float=None, burst:float=1):
+        '''
+        Parameters
+        ----------
+        host : str
+            Host name
+        rate : float, optional
+            Requests per second. None is unlimited.
+        burst : float, optional, default=1
+            Maximum number of requests which can be made at once
+            after a quiet period
+        '''
+        self.host = host
+        self.rate = rate
+        self.burst = max(1, burst or 1)
+        self.__lock = threading.Lock()
+        self.__tokens = self.burst
+        self.__last = time.monotonic()
+        self.__hold = 0
+        self.__counters = {'requests': 0, 'waits': 0, 'waited': 0.0,
+                           'retry_after': 0, 'retry_after_wait': 0.0}
+
+    @property
+    def counters(self)->dict:
+        '''
+        Return a copy of the counters: number of requests, number
+        which had to wait, total seconds waited, Retry-After pauses
+        and their total length in seconds.
+        '''
+        with self.__lock:
+            return dict(self.__counters)
+
+    def configure(self, rate:float=None, burst:float=None):
+        '''
+        Set the rate and burst. Where different parts of a program want
+        different rates for the same host, the slowest one applies; the
+        burst is the one set most recently.
+
+        Parameters
+        ----------
+        rate : float, optional
+            Requests per second. None leaves the rate unchanged.
+        burst : float, optional
+            Maximum number of requests at once. None leaves the burst unchanged.
+        '''
+        with self.__lock:
+            if rate:
+                self.rate = min(rate, self.rate) if self.rate else rate
+            if burst:
+                self.burst = max(1, burst)
+                self.__tokens = min(self.__tokens, self.burst)
+
+    def acquire(self, limited:bool=True)->float:
+        '''
+        Wait until a request may be made and return the time waited.
+
+        Parameters
+        ----------
+        limited : bool, optional, default=True
+            If False, only wait for a Retry-After pause
+        '''
+        with self.__lock:
+            now = time.monotonic()
+            self.__counters['requests'] += 1
+            wait = 0
+            if limited and self.rate:
+                self.__tokens = min(self.burst,
+                                    self.__tokens + (now - self.__last) * self.rate)
+                self.__last = now
+                #Negative tokens are requests booked in the future
+                self.__tokens -= 1
+                wait = max(0, -self.__tokens / self.rate)
+            wait = max(wait, self.__hold - now)
+        waited = 0
+        while wait > 0:
+            time.sleep(wait)
+            waited += wait
+            #A Retry-After may have arrived while sleeping
+            with self.__lock:
+                wait = self.__hold - time.monotonic()
+        if waited:
+            with self.__lock:
+                self.__counters['waits'] += 1
+                self.__counters['waited'] += waited
+        return waited
+
+    def refund(self):
+        '''
+        Return the token for a request which turned out not to need the
+        server, such as one answered from a cache
+        '''
+        with self.__lock:
+            if self.rate:
+                self.__tokens = min(self.burst, self.__tokens + 1)
+            self.__counters['requests'] = max(0, self.__counters['requests'] - 1)
+
+    def pause(self, delay:float):
+        '''
+        Hold all requests for delay seconds
+
+        Parameters
+        ----------
+        delay : float
+            Seconds
+        '''
+        with self.__lock:
+            now = time.monotonic()
+            self.__hold = max(self.__hold, now + delay)
+            #No saved-up burst straight after the pause
+            self.__tokens = min(self.__tokens, 0)
+            self.__last = max(self.__last, self.__hold)
+            self.__counters['retry_after'] += 1
+            self.__counters['retry_after_wait'] += delay
+        LOGGER.warning('%s asked for a pause of %ss', self.host, delay)
+
+def host_of(url:str)->str:
+    '''
+    Host name from a URL, with or without scheme
+
+    Parameters
+    ----------
+    url : str
+        URL
+    '''
+    if not url:
+        return ''
+    url = url.strip()
+    if '://' not in url:
+        url = f'https://{url}'
+    return urllib.parse.urlsplit(url).hostname or ''
+
+def bucket(host:str, rate:float=None, burst:float=None)->TokenBucket:
+    '''
+    Return the process-wide bucket for a host, creating it if necessary.
+
+    Parameters
+    ----------
+    host : str
+        Host name or URL
+    rate : float, optional
+        Requests per second
+    burst : float, optional
+        Maximum number of requests at once
+    '''
+    host = host_of(host)
+    with _LOCK:
+        if host not in _BUCKETS:
+            _BUCKETS[host] = TokenBucket(host, rate, burst)
+            return _BUCKETS[host]
+    _BUCKETS[host].configure(rate, burst)
+    return _BUCKETS[host]
+
+def stats()->dict:
+    '''
+    Return {host: counters} for every host
+    '''
+    with _LOCK:
+        return {k: v.counters for k, v in _BUCKETS.items()}
+
+class Retry(_Retry):
+    '''
+    urllib3 Retry which also applies a server's Retry-After to every
+    request to that host, via its bucket, and tells the host's
+    `Controller` (if any) about each failure.
+    '''
+    def increment(self, *args, **kwargs):
+        new = super().increment(*args, **kwargs)
+        response = kwargs.get('response')
+        pool = kwargs.get('_pool')
+        if pool is None:
+            return new
+        if response is not None and response.status in (429, 503):
+            delay = self.get_retry_after(response)
+            if delay:
+                bucket(pool.host).pause(delay)
+        control = _CONTROLLERS.get(pool.host)
+        error = kwargs.get('error') is not None
+        if control and (error or (response is not None and
+                                  (response.status == 429 or response.status >= 500))):
+            control.record(status=response.status if response is not None else None,
+                           error=error)
+        return new
+
+RETRY = Retry(total=10,
+              status_forcelist=[429, 500, 502, 503, 504],
+              allowed_methods=['HEAD', 'GET', 'OPTIONS',
+                                'POST', 'PUT'],
+              backoff_factor=1)
+'''Default retry strategy for API requests'''
+
+class Controller:
+    '''
+    Adaptive limit on the number of requests in progress at once to
+    one host, using additive increase, multiplicative decrease (AIMD).
+    '''
+    #pylint: disable=too-many-instance-attributes
+    def __init__(self, host:str, maximum:int=16, **kwargs):
+        '''
+        Parameters
+        ----------
+        host : str
+            Host name
+        maximum : int, optional, default=16
+            Highest concurrency allowed
+
+        **kwargs : dict
+            Other parameters
+
+        Other parameters
+        ----------------
+        minimum : int
+            Lowest concurrency. Default 1.
+        start : int
+            Starting concurrency. Default 1.
+        window : int
+            Number of responses between adjustments. Default 10.
+        latency : float
+            Concurrency is cut if the 95th percentile response time of a
+            window is this many times the best seen. Default 2.
+        decrease : float
+            Factor by which concurrency is cut. Default 0.5.
+        '''
+        self.host = host
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(kwargs.get('minimum', 1), self.maximum))
+        self.window = kwargs.get('window', 10)
+        self.latency = kwargs.get('latency', 2)
+        self.decrease = kwargs.get('decrease', 0.5)
+        self.limit = float(min(max(kwargs.get('start', 1), self.minimum), self.maximum))
+        self.__cond = threading.Condition()
+        self.__active = 0
+        self.__times = []
+        self.__bad = 0
+        self.__since = 0
+        self.__best = None
+        self.__counters = {'increases': 0, 'decreases': 0, 'errors': 0, 'responses': 0}
+
+    @property
+    def counters(self)->dict:
+        '''
+        Return a copy of the counters, with the current limit
+        '''
+        with self.__cond:
+            out = dict(self.__counters)
+            out['limit'] = int(self.limit)
+            return out
+
+    def configure(self, maximum:int=None):
+        '''
+        Change the highest concurrency allowed
+
+        Parameters
+        ----------
+        maximum : int, optional
+            Highest concurrency allowed
+        '''
+        with self.__cond:
+            if maximum:
+                self.maximum = max(1, maximum)
+                self.limit = min(self.limit, self.maximum)
+                self.__cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        '''
+        Context manager which waits until there is room for another
+        piece of work, and holds its place until it is done.
+        '''
+        with self.__cond:
+            while self.__active >= int(self.limit):
+                self.__cond.wait()
+            self.__active += 1
+        try:
+            yield self
+        finally:
+            with self.__cond:
+                self.__active -= 1
+                self.__cond.notify_all()
+
+    def __set(self, limit:float, reason:str):
+        '''
+        Change the limit and log it. Call with the lock held.
+        '''
+        old = int(self.limit)
+        self.limit = min(max(limit, self.minimum), self.maximum)
+        self.__times = []
+        self.__bad = 0
+        self.__since = 0
+        if int(self.limit) > old:
+            self.__counters['increases'] += 1
+            self.__cond.notify_all()
+        elif int(self.limit) < old:
+            self.__counters['decreases'] += 1
+        if int(self.limit) != old:
+            LOGGER.info('%s concurrency %s -> %s: %s', self.host, old, int(self.limit), reason)
+
+    def record(self, seconds:float=None, status:int=None, error:bool=False):
+        '''
+        Record the outcome of a request
+
+        Parameters
+        ----------
+        seconds : float, optional
+            Response time. Leave out if it doesn't reflect how busy the
+            server is (eg. an upload, which takes as long as the file
+            takes to send).
+        status : int, optional
+            HTTP status code
+        error : bool, optional
+            True for a connection error or timeout
+        '''
+        bad = error or status == 429 or (status or 0) >= 500
+        with self.__cond:
+            self.__counters['responses'] += 1
+            self.__since += 1
+            if bad:
+                self.__counters['errors'] += 1
+                #At most one cut for the requests which were in flight together
+                if not self.__bad or self.__since >= int(self.limit):
+                    self.__set(self.limit * self.decrease,
+                               f'{"error" if error else status} response')
+                    self.__bad = 1
+                return
+            if seconds is not None:
+                self.__times.append(seconds)
+            if self.__since < self.window:
+                return
+            p95 = (sorted(self.__times)[int(0.95 * (len(self.__times) - 1))]
+                   if self.__times else None)
+            if p95 is not None:
+                self.__best = p95 if self.__best is None else min(self.__best, p95)
+            if p95 is not None and p95 > self.latency * self.__best:
+                self.__set(self.limit * self.decrease,
+                           f'p95 response time {p95:.2f}s, best {self.__best:.2f}s')
+            elif self.__active >= int(self.limit) - 1:
+                #Only worth raising if the current limit is being used
+                self.__set(self.limit + 1, f'healthy, p95 {p95 if p95 else 0:.2f}s')
+            else:
+                self.__set(self.limit, 'healthy')
+
+_CONTROLLERS = {}
+
+def controller(host:str, maximum:int=None, **kwargs)->Controller:
+    '''
+    Return the process-wide concurrency controller for a host,
+    creating it if necessary.
+
+    Parameters
+    ----------
+    host : str
+        Host name or URL
+    maximum : int, optional
+        Highest concurrency allowed
+
+    **kwargs : dict
+        Other parameters for a new `Controller`
+    '''
+    host = host_of(host)
+    with _LOCK:
+        if host not in _CONTROLLERS:
+            _CONTROLLERS[host] = Controller(host, maximum or 16, **kwargs)
+            return _CONTROLLERS[host]
+    _CONTROLLERS[host].configure(maximum)
+    return _CONTROLLERS[host]
+
+def feedback(response, *args, **kwargs):#pylint: disable=unused-argument
+    '''
+    requests response hook which reports to the host's controller, if
+    there is one. Only GET and HEAD response times are used, as other
+    requests take as long as their content takes to send. Responses from
+    a cache say nothing about the server and are ignored.
+    '''
+    control = _CONTROLLERS.get(host_of(response.url))
+    if control and not getattr(response, 'from_cache', False):
+        control.record(response.elapsed.total_seconds()
+                       if response.request.method in ('GET', 'HEAD') else None,
+                       response.status_code)
+
+def watch(session):
+    '''
+    Add the `feedback` hook to a requests session, once
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session
+    '''
+    if feedback not in session.hooks['response']:
+        session.hooks['response'].append(feedback)
+    return session
+
+@contextlib.contextmanager
+def hooked(session, hook):
+    '''
+    Context manager which adds a response hook to a requests session
+    until the last concurrent user of the hook is finished, so that a
+    caller's session is left as it was. A hook which the session
+    already had is left alone.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session
+
+    hook : function
+        Response hook, eg. `feedback`
+    '''
+    key = (id(session), hook)
+    with _LOCK:
+        if key not in _HOOKS and hook in session.hooks['response']:
+            key = None
+        elif key not in _HOOKS:
+            session.hooks['response'].append(hook)
+        if key:
+            _HOOKS[key] = _HOOKS.get(key, 0) + 1
+    try:
+        yield session
+    finally:
+        if key:
+            with _LOCK:
+                _HOOKS[key] -= 1
+                if not _HOOKS[key]:
+                    del _HOOKS[key]
+                    session.hooks['response'].remove(hook)
@@ -0,0 +1,950 @@
+'''
+The upload engine: uploading a manifest of files to one or
+more studies, with journalling, synchronization, bundling,
+direct upload and reporting
+'''
+
+import contextlib
+import csv
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+import dataverse_utils.dataverse_utils as dvu
+from dataverse_utils import bundle
+from dataverse_utils import direct
+from dataverse_utils import manifest
+from dataverse_utils import streams
+from dataverse_utils import throttle
+LOGGER = logging.getLogger(__name__)
+
+#Columns for upload reports
+REPORT_FIELDS = ['file', 'pid', 'status', 'fid', 'bytes', 'wall', 'upload', 'transfer',
+                 'server', 'lock_wait', 'restrict', 'requests', 'retries', 'mbps', 'error']
+
+#Default minimum size in bytes for files sent straight to storage by upload_from_tsv
+DIRECT_SIZE = 2**26
+
+def upload_summary(results:list, elapsed:float=None) -> dict:
+    '''
+    Summarizes the statistics of an upload run. Returns a dict with
+    file count, failures, total bytes, summed times per stage in seconds,
+    requests and overall throughput in MB/s.
+
+    Parameters
+    ----------
+    results : list
+        Result dicts from `upload_from_tsv`
+
+    elapsed : float, optional
+        Wall time of the whole run in seconds. Throughput uses this if
+        supplied, otherwise the sum of the per-file wall times.
+    '''
+    out = {'files': 0, 'failed': 0, 'bytes': 0}
+    out.update({_: 0 for _ in ('wall', 'transfer', 'server', 'lock_wait',
+                               'restrict', 'requests', 'retries')})
+    for result in results:
+        stats = result.get('stats')
+        if not stats:
+            continue
+        out['files'] += 1
+        out['failed'] += result['status'] == 'failed'
+        for key in ('bytes', 'wall', 'transfer', 'server', 'lock_wait', 'restrict',
+                    'requests', 'retries'):
+            out[key] += stats.get(key, 0)
+    out['elapsed'] = elapsed if elapsed is not None else out['wall']
+    out['mbps'] = out['bytes'] / out['elapsed'] / 1e6 if out['elapsed'] else 0
+    return out
+
+def write_report(results:list, fname:str, summary:dict=None) -> None:
+    '''
+    Writes per-file upload statistics from `upload_from_tsv` to a report.
+    Files ending in .csv are written as CSV, anything else as
+    JSON lines. The summary, if supplied, is written last; in a CSV
+    it is the row with a status of 'summary'.
+
+    Parameters
+    ----------
+    results : list
+        Result dicts from `upload_from_tsv`
+
+    fname : str
+        Report file name
+
+    summary : dict, optional
+        Run summary, as from `upload_summary`
+    '''
+    rows = []
+    for result in results:
+        if not result.get('stats'):
+            continue
+        row = {_: result.get(_) for _ in ('file', 'pid', 'status', 'fid', 'error')}
+        row.update({k: v for k, v in result['stats'].items() if k in REPORT_FIELDS})
+        rows.append(row)
+    with open(fname, 'w', encoding='utf-8', newline='') as rep:
+        if not fname.lower().endswith('.csv'):
+            for row in rows:
+                rep.write(json.dumps(row) + '\n')
+            if summary:
+                rep.write(json.dumps({'summary': summary}) + '\n')
+            return
+        writer = csv.DictWriter(rep, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+        if summary:
+            total = {k: v for k, v in summary.items() if k in REPORT_FIELDS}
+            total.update({'status': 'summary', 'wall': summary['elapsed']})
+            writer.writerow(total)
+
+def read_report(fname:str) -> dict:
+    '''
+    Returns the summary from an upload report made by `write_report`.
+    If the report has no summary, one is calculated from its rows.
+
+    Parameters
+    ----------
+    fname : str
+        Report file name
+    '''
+    with open(fname, encoding='utf-8', newline='') as rep:
+        if fname.lower().endswith('.csv'):
+            rows = list(csv.DictReader(rep))
+        else:
+            rows = [json.loads(_) for _ in rep if _.strip()]
+    summary = None
+    results = []
+    for row in rows:
+        if 'summary' in row:
+            summary = row['summary']
+        elif row.get('status') == 'summary':
+            summary = {k: float(v) for k, v in row.items()
+                       if k in REPORT_FIELDS[4:-1] and v}
+            summary['elapsed'] = summary.get('wall', 0)
+        else:
+            stats = {k: float(v) for k, v in row.items()
+                     if k in REPORT_FIELDS[4:-1] and v not in (None, '')}
+            results.append({'status': row.get('status'), 'stats': stats})
+    if summary:
+        summary.setdefault('files', len(results))
+        return summary
+    return upload_summary(results)
+
+class UploadJournal:
+    '''
+    A persistent record of manifest uploads, kept in an SQLite database,
+    so that an interrupted `upload_from_tsv` run can be resumed.
+    '''
+    def __init__(self, path:str):
+        '''
+        Open (or create) an upload journal.
+
+        Parameters
+        ----------
+        path : str
+            Location of the SQLite journal file. Normally this is placed
+            next to the manifest, eg: manifest.tsv.journal.sqlite3
+        '''
+        self.path = path
+        self.__lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS uploads '
+                          '(pid TEXT, file TEXT, dirlabel TEXT, '
+                          'state TEXT, fid INTEGER, md5 TEXT, '
+                          'restricted INTEGER, error TEXT, updated TEXT, '
+                          'PRIMARY KEY (pid, file, dirlabel))')
+        self.conn.commit()
+
+    def get(self, pid:str, row:dict) -> dict:
+        '''
+        Returns the journal entry for a manifest row, or None.
+
+        Parameters
+        ----------
+        pid : str
+            Persistent ID of the study
+
+        row : dict
+            Manifest row as produced by `_manifest_rows`
+        '''
+        with self.__lock:
+            cur = self.conn.execute('SELECT state, fid, md5, restricted, error '
+                                    'FROM uploads WHERE pid=? AND file=? AND dirlabel=?',
+                                    (pid, row['fpath'], row.get('dirlabel', '')))
+            found = cur.fetchone()
+        if not found:
+            return None
+        return dict(zip(('state', 'fid', 'md5', 'restricted', 'error'), found))
+
+    def mark(self, pid:str, row:dict, state:str, **kwargs) -> None:
+        '''
+        Record the state of a manifest row.
+
+        Parameters
+        ----------
+        pid : str
+            Persistent ID of the study
+
+        row : dict
+            Manifest row as produced by `_manifest_rows`
+
+        state : str
+            One of 'started', 'uploaded', 'complete' or 'failed'
+
+        **kwargs : dict
+            Other parameters
+
+        Other parameters
+        ----------------
+        fid : int, optional
+            Dataverse file ID
+
+        md5 : str, optional
+            md5 of the uploaded file, as reported by Dataverse
+
+        restricted : bool, optional
+            Restriction applied
+
+        error : str, optional
+            Error message for failed rows
+        '''
+        with self.__lock:
+            self.conn.execute('INSERT OR REPLACE INTO uploads VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (pid, row['fpath'], row.get('dirlabel', ''), state,
+                               kwargs.get('fid'), kwargs.get('md5'),
+                               int(bool(kwargs.get('restricted'))),
+                               kwargs.get('error'),
+                               time.strftime('%Y-%m-%dT%H:%M:%S')))
+            self.conn.commit()
+
+    def close(self) -> None:
+        '''
+        Close the journal database
+        '''
+        self.conn.close()
+
+def _manifest_rows(fil, **kwargs) -> list:
+    '''
+    Reads a tsv manifest and returns a list of upload parameters,
+    one dict per file. Each dict contains the file location
+    under 'fpath' and the remaining keyword arguments for `upload_file`.
+
+    Parameters
+    ----------
+    fil
+        Open file object or io.IOStream()
+
+    **kwargs : dict
+        Other parameters, as in `upload_from_tsv`
+    '''
+    #reader = csv.reader(fil, delimiter='\t', quotechar='"')
+    #new, optional mimetype column allows using GeoJSONS.
+    #Read the headers from the file first before using DictReader
+    headers = fil.readline().strip('\n\r').split('\t')#Goddamn it Windows
+    fil.seek(0)
+    reader = csv.DictReader(fil, fieldnames=headers, quotechar='"', delimiter='\t')
+    #See API call for "Adding File Metadata"
+    rows = []
+    for num, row in enumerate(reader):
+        if num == 0:
+            continue
+        #dirlabel = file_path(row[0], './')
+        if row.get('path'):
+            #Explicit separate path because that way you can organize
+            #on upload
+            dirlabel = row.get('path')
+        else:
+            dirlabel = dvu.file_path(row['file'], kwargs.get('trunc', ''))
+        tags = row['tags'].split(',')
+        tags = [x.strip() for x in tags]
+        descr = row['description']
+        mimetype = row.get('mimetype')
+        params = {'fpath' : row['file'],
+                  'dv' : kwargs.get('dv'),
+                  'tags' : tags,
+                  'descr' : descr,
+                  'dirlabel' : dirlabel,
+                  'apikey' : kwargs.get('apikey'),
+                  'md5' : kwargs.get('md5', ''),
+                  'rest': kwargs.get('rest', False)}
+        if mimetype:
+            params['mimetype'] = mimetype
+        if row.get('pid'):
+            params['study'] = row['pid'].strip()
+        #Per-file checksums from the manifest take precedence
+        for chk in ('md5', 'sha256'):
+            if row.get(chk):
+                params[chk] = row[chk].strip().lower()
+        rows.append(params)
+    return rows
+
+def _file_sizes(rows:list) -> list:
+    '''
+    Returns the size in bytes of each file in a list of manifest rows.
+    Files which can't be read are given a size of 0; the error
+    will surface when they are uploaded.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`
+    '''
+    sizes = []
+    for row in rows:
+        try:
+            sizes.append(os.stat(row['fpath']).st_size)
+        except OSError:
+            sizes.append(0)
+    return sizes
+
+def _upload_row(row, hdl, **kwargs) -> dict:
+    '''
+    Uploads a single manifest row and returns a result dict
+    instead of raising on failure.
+
+    Parameters
+    ----------
+    row : dict
+        Manifest row as produced by `_manifest_rows`
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    **kwargs : dict
+        Other parameters passed on to `upload_file`. If `journal`
+        (an UploadJournal) is included, completed rows are skipped
+        and interrupted rows are resumed. `remote` holds existing
+        study files, as used by `_remote_match`.
+    '''
+    #pylint: disable=too-many-branches
+    params = kwargs.copy()
+    #So that you can pass everything all at once, params
+    #is merged onto kwargs. This is for easier upgradability
+    params.update(row)
+    fpath = params.pop('fpath')
+    journal = params.pop('journal', None)
+    remote = params.pop('remote', None) or {}
+    rest = params.get('rest', False)
+    stats = {'bytes': 0, 'requests': 0}
+    result = {'file': fpath, 'pid': hdl, 'status': 'uploaded',
+              'fid': None, 'error': None, 'stats': stats}
+    try:
+        with dvu._measure(stats, 'wall'):#pylint: disable=protected-access
+            entry = journal.get(hdl, row) if journal else None
+            if entry and entry['state'] == 'complete':
+                result.update({'status': 'skipped', 'fid': entry['fid']})
+                return result
+            if entry and not entry['fid']:
+                #Interrupted mid-upload; the file may have arrived anyway
+                found = dvu._remote_match(row, remote)#pylint: disable=protected-access
+                if found:
+                    entry.update({'fid': found['dataFile']['id'],
+                                  'md5': found['dataFile'].get('md5'),
+                                  'restricted': found.get('restricted', False)})
+                    if params.get('md5') and entry['md5'] != params['md5']:
+                        raise dvu.Md5Error(f'md5sum mismatch on previously uploaded {fpath}')
+            if entry and entry['fid']:
+                result['status'] = 'resumed'
+                data_file = {'id': entry['fid'], 'md5': entry['md5']}
+            else:
+                if journal:
+                    journal.mark(hdl, row, 'started')
+                params['rest'] = False
+                data_file = dvu.upload_file(fpath, hdl, stats=stats, **params)
+                entry = {'restricted': False}
+            if journal:
+                journal.mark(hdl, row, 'uploaded', fid=data_file.get('id'),
+                             md5=data_file.get('md5'), restricted=entry['restricted'])
+            if rest and not entry['restricted']:
+                with dvu._measure(stats, 'restrict'):#pylint: disable=protected-access
+                    dvu.restrict_file(fid=data_file['id'], dv=params['dv'].strip('\\ /'),
+                                      apikey=params.get('apikey'), rest=True, hdl=hdl,
+                                      lock=params.get('lock'), session=params.get('session'))
+            if journal:
+                journal.mark(hdl, row, 'complete', fid=data_file.get('id'),
+                             md5=data_file.get('md5'), restricted=bool(rest))
+            result['fid'] = data_file.get('id')
+    except (dvu.DvGeneralUploadError, dvu.Md5Error, KeyError, OSError,
+            json.decoder.JSONDecodeError,
+            requests.exceptions.RequestException) as err:
+        LOGGER.error('Upload of %s failed: %s', fpath, err)
+        result['status'] = 'failed'
+        result['error'] = str(err)
+        if journal:
+            journal.mark(hdl, row, 'failed', error=str(err))
+    return result
+
+def _sync_classify(rows:list, remote:dict, workers:int=None) -> list:
+    '''
+    Compares manifest rows with the files in a study and returns a list of
+    ('new' | 'changed' | 'unchanged' | 'failed', file metadata or None, error or None)
+    for each row. Changed rows have 'replace' set to the file ID they replace.
+    A row matching a study file which can't be read locally has failed,
+    with the OSError as its error.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`
+
+    remote : dict
+        Study file metadata as produced by `_remote_index`
+
+    workers : int, optional
+        Number of files to hash concurrently
+    '''
+    hashtypes = dvu.CHECKSUM_TYPES
+    matches = [dvu._remote_match(row, remote) for row in rows]#pylint: disable=protected-access
+    wanted = {}
+    for row, match in zip(rows, matches):
+        if match:
+            prot = hashtypes.get(match['dataFile'].get('checksum', {}).get('type'), 'md5')
+            if not row.get(prot):
+                wanted.setdefault(prot, []).append(row['fpath'])
+    digests = {}
+    for prot, files in wanted.items():
+        digests[prot] = streams.digest_files(files, prot, workers, errors=True)
+    out = []
+    for row, match in zip(rows, matches):
+        if not match:
+            out.append(('new', None, None))
+            continue
+        checksum = match['dataFile'].get('checksum',
+                                         {'type': 'MD5', 'value': match['dataFile'].get('md5')})
+        prot = hashtypes.get(checksum.get('type'), 'md5')
+        local = row.get(prot) or digests[prot][row['fpath']]
+        if isinstance(local, OSError):
+            LOGGER.error('Can\'t compare %s with %s: %s', row['fpath'],
+                         match['label'], local)
+            out.append(('failed', match, local))
+        elif local == checksum.get('value'):
+            out.append(('unchanged', match, None))
+        else:
+            row['replace'] = match['dataFile']['id']
+            out.append(('changed', match, None))
+    return out
+
+def upload_from_tsv(fil, hdl=None, **kwargs) -> list:
+    '''
+    Utility for bulk uploading. Assumes fil is formatted
+    as tsv with headers 'file', 'description', 'tags'.
+
+    'tags' field will be split on commas.
+
+    An optional 'pid' column routes each file to its own study, so that one
+    manifest can upload to many studies. Rows with an empty 'pid' go to hdl.
+
+    Returns a list of per-file result dicts in manifest order, with keys
+    'file', 'pid', 'status' ('uploaded', 'resumed', 'skipped', 'unchanged',
+    'replaced', 'removed' or 'failed'), 'fid' and 'error'. Files which were
+    processed also have 'stats', a dict of timings as described in
+    `upload_file`, plus 'wall', the total time spent on the file.
+
+    Parameters
+    ----------
+    fil
+        Open file object or io.IOStream()
+
+    hdl : str, optional
+        Dataverse persistent ID for study (handle or DOI). Required unless
+        every row of the manifest has a 'pid'.
+
+    **kwargs : dict
+        Other parameters
+
+    Other parameters
+    ----------------
+    md5 : str, optional
+        md5sum checked for every file. An 'md5' or 'sha256' column in the
+        tsv (see `make_tsv`) is checked per file instead.
+
+    trunc : str
+        Leftmost portion of Dataverse study file path to remove.
+        eg: trunc ='/home/user/' if the tsv field is
+        '/home/user/Data/ASCII'
+        would set the path for that line of the tsv to 'Data/ASCII'.
+        Defaults to None.
+
+    dv : str, required
+        url to base Dataverse installation
+        eg: 'https://abacus.library.ubc.ca'
+
+    apikey : str, required
+        API key for user
+
+    rest : bool, optional
+        On True, restrict access. Default False
+
+    workers : int, optional
+        Number of files to upload concurrently to each study. Default 1.
+
+    lanes : int, optional
+        Number of studies to upload to concurrently when the manifest
+        has a 'pid' column. Default 4.
+
+    pipeline : bool, optional
+        Send files back-to-back without waiting for the study lock after
+        each one. Files which may trigger tabular ingest (see dataverse_utils.INGEST)
+        are deferred to the end of the batch.
+
+    session : requests.Session, optional
+        Session reused for every request in the manifest. Defaults to the
+        shared session, or a dedicated pooled session if there are more
+        workers than the shared session's pool size, which is closed
+        when the upload finishes. A session which is supplied is left
+        open, without the hooks added for the upload.
+
+    sync : bool, optional
+        Synchronize the study with the manifest. The study's file list is
+        fetched once and local checksums are calculated in parallel. Files
+        with matching checksums are skipped, changed files are replaced
+        using the file replace API and files only present in the study are
+        reported as 'removed' (but not deleted).
+
+    journal : str, bool or UploadJournal, optional
+        Keep a persistent journal of the upload so that a rerun skips
+        completed rows and safely retries partially completed ones.
+        Use a path for the SQLite journal file, or True to place it
+        next to the manifest as [manifest].journal.sqlite3.
+
+    report : str, optional
+        Write per-file statistics and a run summary (see `write_report`)
+        to this file. Use a .csv extension for CSV, otherwise the report
+        is in JSON lines format.
+
+    bundle : int or bool, optional
+        Pack files no larger than this many bytes (True for BUNDLE_SIZE)
+        into zip files which Dataverse unpacks, so that thousands of small
+        files need only a few uploads. Files which Dataverse might ingest
+        or treat specially (see dataverse_utils.NOTAB and INGEST), files with a
+        mimetype in the manifest and replacements are uploaded singly.
+        Each bundle is given the description shared by most of its files;
+        the others, along with any file whose tags or path weren't applied,
+        are corrected with one metadata update per file. Bundled files
+        are verified against their checksums. Their results include
+        'bundle', the name of the zip, and the first file of each bundle
+        has the statistics for the whole bundle.
+
+    bundle_files : int, optional, default=BUNDLE_FILES
+        Maximum number of files in a bundle. Dataverse won't unpack
+        zips with more files than its :ZipUploadFilesLimit setting.
+
+    direct : int or bool, optional
+        Send files of at least this many bytes (True for DIRECT_SIZE)
+        straight to the study's S3 storage using pre-signed URLs, in
+        parallel parts for large files, and register them with the study
+        in bulk. See `dataverse_utils.direct`. The storage must have
+        direct upload enabled. Replacements are uploaded as usual.
+
+    parts : int, optional, default=direct.PARTS
+        Number of parts of a file sent to storage at once
+
+    adaptive : bool, optional
+        Adjust the number of files uploaded at once, up to workers x lanes,
+        to what the server can handle. See `dataverse_utils.throttle.Controller`.
+
+    Notes
+    -----
+    All files are sized before uploading starts. With more than one worker,
+    file transfers run in parallel, largest file first. Waiting
+    for the study lock to clear is serialized between workers, and an
+    upload refused because the study is locked is retried once the lock clears.
+
+    Study locks don't affect other studies, so each study in a routed
+    manifest is uploaded in its own lane and up to `lanes` studies are
+    uploaded at once. If a study can't be reached at all (eg. a bad
+    persistent ID), its files are marked as failed and the other
+    studies continue.
+    '''
+    started = time.perf_counter()
+    rows = _manifest_rows(fil, **kwargs)
+    workers = max(1, int(kwargs.pop('workers', 1) or 1))
+    lanes = max(1, int(kwargs.pop('lanes', 4) or 1))
+    report = kwargs.pop('report', None)
+    studies = _route_rows(rows, hdl)
+    lanes = min(lanes, len(studies)) or 1
+    #Whatever is opened here is closed, and hooks removed, when the run ends
+    with contextlib.ExitStack() as stack:
+        if not kwargs.get('session'):
+            kwargs['session'] = (dvu.get_session() if workers * lanes <= 10
+                                 else stack.enter_context(dvu.make_session(workers * lanes)))
+        stack.enter_context(throttle.hooked(kwargs['session'], dvu._count_request))#pylint: disable=protected-access
+        control = None
+        if kwargs.pop('adaptive', False) and workers * lanes > 1:
+            control = throttle.controller(kwargs['dv'].strip('\\ /'), maximum=workers * lanes)
+            stack.enter_context(throttle.hooked(kwargs['session'], throttle.feedback))
+        journal = kwargs.pop('journal', None)
+        if journal and not isinstance(journal, UploadJournal):
+            journal = stack.enter_context(contextlib.closing(
+                UploadJournal(f'{fil.name}.journal.sqlite3' if journal is True else journal)))
+        results = _run_lanes(rows, studies, lanes, workers=workers, journal=journal,
+                             control=control, **kwargs)
+        LOGGER.info('Connection use: %s', dvu.session_stats(kwargs['session']))
+    summary = upload_summary(results, time.perf_counter() - started)
+    LOGGER.info('Upload summary: %s', summary)
+    if report:
+        write_report(results, report, summary)
+    return results
+
+def _route_rows(rows:list, hdl) -> dict:
+    '''
+    Returns a dict of {study persistent ID: [row numbers]} for
+    `upload_from_tsv`, in manifest order.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`. The 'study' key
+        is removed from each.
+
+    hdl : str
+        Persistent ID for rows without a study of their own
+    '''
+    studies = {}
+    for num, row in enumerate(rows):
+        study = row.pop('study', None) or hdl
+        if not study:
+            raise KeyError(f'No study persistent ID for {row["fpath"]}. '
+                           'Supply hdl or a pid column in the manifest')
+        studies.setdefault(study, []).append(num)
+    return studies
+
+def _run_lanes(rows:list, studies:dict, lanes:int, **kwargs) -> list:
+    '''
+    Uploads each study in its own lane, up to `lanes` at once, for
+    `upload_from_tsv`. Returns a list of result dicts in manifest order,
+    followed by any files which are only in the studies if synchronizing.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`
+
+    studies : dict
+        Row numbers by study, as from `_route_rows`
+
+    lanes : int
+        Number of studies to upload to at once
+
+    **kwargs : dict
+        Parameters for `_upload_study`
+    '''
+    sizes = _file_sizes(rows)
+    lane_order = list(studies)
+    if lanes > 1:
+        #Biggest studies first
+        lane_order.sort(key=lambda x: -sum(sizes[_] for _ in studies[x]))
+    #Locks are per study, so each study gets its own lane
+    with ThreadPoolExecutor(max_workers=lanes) as pool:
+        futures = {pool.submit(_upload_lane, [rows[_] for _ in studies[study]], study,
+                               sizes=[sizes[_] for _ in studies[study]],
+                               **kwargs): study
+                   for study in lane_order}
+        finished = {futures[_]: _.result() for _ in as_completed(futures)}
+    results = [None] * len(rows)
+    for study, nums in studies.items():
+        for num, result in zip(nums, finished[study]):
+            results[num] = result
+    for study, nums in studies.items():
+        results.extend(finished[study][len(nums):])
+    return results
+
+def _upload_lane(rows:list, hdl, **kwargs) -> list:
+    '''
+    Runs `_upload_study`, returning every row as failed
+    if the study can't be reached at all.
+    '''
+    try:
+        return _upload_study(rows, hdl, **kwargs)
+    except (dvu.DvGeneralUploadError, KeyError, OSError,
+            json.decoder.JSONDecodeError,
+            requests.exceptions.RequestException) as err:
+        LOGGER.error('Upload to %s failed: %s', hdl, err)
+        return [{'file': _['fpath'], 'pid': hdl, 'status': 'failed',
+                 'fid': None, 'error': str(err)} for _ in rows]
+
+def _controlled(control, func, *args, **kwargs):
+    '''
+    Run func(*args, **kwargs) in a slot from a throttle.Controller,
+    or straight away if control is None.
+    '''
+    if not control:
+        return func(*args, **kwargs)
+    with control.slot():
+        return func(*args, **kwargs)
+
+def _upload_study(rows:list, hdl, **kwargs) -> list:
+    '''
+    Uploads manifest rows to a single study for `upload_from_tsv`.
+    Returns a list of result dicts, one per row in the same order,
+    followed by any files which are only in the study if synchronizing.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    **kwargs : dict
+        Parameters as in `upload_from_tsv`, with `journal`, if any,
+        as an UploadJournal, and `control`, if any, as the
+        throttle.Controller for the Dataverse installation
+    '''
+    opts = {_: kwargs.pop(_, None) for _ in ('workers', 'control', 'bundle', 'bundle_files',
+                                              'direct', 'journal', 'sizes')}
+    journal = opts['journal']
+    if journal and any((journal.get(hdl, _) or {}).get('state') in ('started', 'failed')
+                       for _ in rows):
+        #One listing of the study to find files from interrupted rows
+        kwargs['remote'] = {(_.get('directoryLabel', '').strip('/'), _['label']): _
+                            for _ in dvu.dataset_files(kwargs['dv'].strip('\\ /'), hdl,
+                                                       kwargs.get('apikey'),
+                                                       kwargs['session'])}
+    results = [None] * len(rows)
+    removed = []
+    if kwargs.get('sync'):
+        remote, removed = _sync_study(rows, hdl, results, workers=opts['workers'], **kwargs)
+        kwargs.setdefault('remote', remote)
+    opts['sizes'] = opts['sizes'] or _file_sizes(rows)
+    plan = _plan_jobs(rows, hdl, [_ for _, done in enumerate(results) if not done],
+                      opts, kwargs.get('pipeline'))
+    for nums, done in _run_jobs(rows, hdl, plan, opts['control'], workers=opts['workers'] or 1,
+                                lock=threading.Lock(), journal=journal, **kwargs):
+        for num, result in zip(nums, done if isinstance(done, list) else [done]):
+            results[num] = result
+            if rows[num].get('replace') and result['status'] == 'uploaded':
+                result['status'] = 'replaced'
+    failed = [_ for _ in results if _['status'] == 'failed']
+    LOGGER.info('%s of %s files uploaded to %s', len(results)-len(failed),
+                len(results), hdl)
+    return results + removed
+
+def _sync_study(rows:list, hdl, results:list, **kwargs) -> tuple:
+    '''
+    Compares manifest rows with the files already in a study for
+    `_upload_study`, filling in the results of rows which are unchanged
+    or can't be compared. Returns a tuple of (study files indexed as by
+    `_remote_index`; result dicts for files only in the study).
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    results : list
+        Result dicts, one per row, None for those not yet done
+
+    **kwargs : dict
+        'dv', 'apikey', 'session' and 'workers'
+    '''
+    listing = dvu.dataset_files(kwargs['dv'].strip('\\ /'), hdl, kwargs.get('apikey'),
+                                kwargs['session'])
+    remote = dvu._remote_index(listing)#pylint: disable=protected-access
+    status = _sync_classify(rows, remote, kwargs.get('workers'))
+    for num, (state, match, error) in enumerate(status):
+        if state == 'unchanged':
+            results[num] = {'file': rows[num]['fpath'], 'pid': hdl, 'status': 'unchanged',
+                            'fid': match['dataFile']['id'], 'error': None}
+        elif state == 'failed':
+            results[num] = {'file': rows[num]['fpath'], 'pid': hdl, 'status': 'failed',
+                            'fid': None, 'error': str(error)}
+    seen = {id(match) for _, match, _ in status if match}
+    return remote, [
+        {'file': '/'.join([_.get('directoryLabel', ''), _['label']]).strip('/'),
+         'pid': hdl, 'status': 'removed', 'fid': _['dataFile']['id'], 'error': None}
+        for _ in listing if id(_) not in seen]
+
+def _plan_jobs(rows:list, hdl, order:list, opts:dict, pipeline:bool=False) -> tuple:
+    '''
+    Decides how the rows still to upload to a study are sent, for
+    `_upload_study`. Returns a tuple of (jobs, large), where jobs is a
+    list of (row numbers, bundle name or None) in upload order and
+    large is a list of row numbers to send directly to storage.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    order : list
+        Row numbers still to upload
+
+    opts : dict
+        'workers', 'bundle', 'bundle_files', 'direct', 'journal'
+        and 'sizes', as in `_upload_study`
+
+    pipeline : bool, optional, default=False
+        Send files which may be ingested last
+    '''
+    journal = opts['journal']
+    sizes = opts['sizes']
+    bundles = []
+    if opts['bundle']:
+        #Journalled rows need the row-by-row resume logic
+        bundles, order = bundle.bundle_rows(rows, order,
+                                            bundle=(bundle.BUNDLE_SIZE if opts['bundle'] is True
+                                                    else opts['bundle']),
+                                            bundle_files=opts['bundle_files'],
+                                            skip={num for num, _ in enumerate(rows)
+                                                  if journal and journal.get(hdl, _)})
+    jobs = [(nums, f'bundle_{count+1:04d}.zip') for count, nums in enumerate(bundles)]
+    large = []
+    if opts['direct'] is not None and opts['direct'] is not False:
+        #Replacements and journalled rows go through the usual route
+        large = [_ for _ in order
+                 if sizes[_] >= (DIRECT_SIZE if opts['direct'] is True else opts['direct'])
+                 and not rows[_].get('replace')
+                 and not (journal and journal.get(hdl, rows[_]))]
+        order = [_ for _ in order if _ not in set(large)]
+    jobs.extend(([num], None) for num in order)
+    if (opts['workers'] or 1) > 1:
+        #Longest first, so that one big file at the end doesn't leave the others idle
+        jobs.sort(key=lambda x: -sum(sizes[_] for _ in x[0]))
+    if pipeline:
+        #Ingest locks the study, so send everything else first
+        jobs.sort(key=lambda x: os.path.splitext(rows[x[0][0]]['fpath'])[1].lower()
+                  in dvu.INGEST)
+    return jobs, large
+
+def _run_jobs(rows:list, hdl, plan:tuple, control, **kwargs) -> list:
+    '''
+    Uploads the jobs planned by `_plan_jobs` for `_upload_study`,
+    `workers` at once. Returns a list of (row numbers, result) as
+    each job finishes, where the result is a result dict or a list of them.
+
+    Parameters
+    ----------
+    rows : list
+        Manifest rows as produced by `_manifest_rows`
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    plan : tuple
+        (jobs, large) from `_plan_jobs`
+
+    control : throttle.Controller
+        Controller for the Dataverse installation, or None
+
+    **kwargs : dict
+        'workers', plus parameters for `_upload_row`
+    '''
+    jobs, large = plan
+    with ThreadPoolExecutor(max_workers=kwargs.pop('workers') + bool(large)) as pool:
+        futures = {}
+        if large:
+            #Storage transfers don't hold the study lock, so they run alongside
+            futures[pool.submit(direct.direct_upload, [rows[_] for _ in large], hdl,
+                                **kwargs)] = large
+        for nums, name in jobs:
+            if name:
+                futures[pool.submit(_controlled, control, bundle.upload_bundle,
+                                    [rows[_] for _ in nums], hdl, name, **kwargs)] = nums
+            else:
+                futures[pool.submit(_controlled, control, _upload_row, rows[nums[0]], hdl,
+                                    **kwargs)] = nums
+        return [(futures[_], _.result()) for _ in as_completed(futures)]
+
+def upload_plan(fil, hdl=None, **kwargs) -> dict:
+    '''
+    Sizes up a manifest without uploading anything. Returns a dict with
+    the number of 'studies', 'files' and 'bytes', 'types' (a dict of
+    {extension: {'files': count, 'bytes': size}}), 'ingest' (files likely
+    to be ingested, each locking its study while it processes), 'notab'
+    (tabular files which will be uploaded without ingest), 'missing'
+    (a list of files which can't be found) and 'eta' (estimated seconds,
+    or None without a previous report).
+
+    Parameters
+    ----------
+    fil
+        Open file object or io.IOStream()
+
+    hdl : str, optional
+        Dataverse persistent ID for study (handle or DOI)
+
+    **kwargs : dict
+        Other parameters, as in `upload_from_tsv`
+
+    Other parameters
+    ----------------
+    history : str, optional
+        A report from an earlier upload (see `write_report`), from which
+        transfer rate and time per file are taken for the estimate
+
+    Notes
+    -----
+    The estimate is the transfer time at the earlier rate, plus the
+    earlier average per-file server, lock and restriction time,
+    divided by the number of workers and lanes. As lock waits don't
+    overlap, it is optimistic for studies with many ingested files.
+    '''
+    rows = _manifest_rows(fil, **kwargs)
+    sizes = _file_sizes(rows)
+    notab = [] if kwargs.get('override') else dvu.NOTAB
+    out = {'studies': len({_.get('study') or hdl for _ in rows}),
+           'files': len(rows), 'bytes': sum(sizes), 'types': {},
+           'ingest': 0, 'notab': 0, 'missing': [], 'eta': None}
+    for row, size in zip(rows, sizes):
+        ext = os.path.splitext(row['fpath'])[1].lower()
+        kind = out['types'].setdefault(ext, {'files': 0, 'bytes': 0})
+        kind['files'] += 1
+        kind['bytes'] += size
+        if ext in dvu.INGEST and ext not in notab:
+            out['ingest'] += 1
+        elif ext in dvu.INGEST:
+            out['notab'] += 1
+        if not os.path.isfile(row['fpath']):
+            out['missing'].append(row['fpath'])
+    if kwargs.get('history') and os.path.exists(kwargs['history']):
+        past = read_report(kwargs['history'])
+        if past.get('files') and past.get('transfer'):
+            out['mbps'] = past['bytes'] / past['transfer'] / 1e6
+            out['overhead'] = sum(past.get(_, 0) for _ in
+                                  ('server', 'lock_wait', 'restrict')) / past['files']
+            parallel = (max(1, int(kwargs.get('workers', 1) or 1)) *
+                        min(max(1, int(kwargs.get('lanes', 4) or 1)), out['studies'] or 1))
+            out['eta'] = ((out['bytes'] / (out['mbps'] * 1e6) +
+                           out['files'] * out['overhead']) / parallel)
+    return out
+
+def sync_dataset(start_dir, hdl, **kwargs) -> list:
+    '''
+    Synchronize a local directory with a Dataverse study, rsync style.
+    A manifest is made of start_dir with `make_tsv` and uploaded
+    with `upload_from_tsv(sync=True)`, so only new and changed files
+    are transferred.
+
+    Returns the list of per-file results from `upload_from_tsv`.
+
+    Parameters
+    ----------
+    start_dir : str
+        Path to the local directory
+
+    hdl : str
+        Dataverse persistent ID for study (handle or DOI)
+
+    **kwargs : dict
+        Other parameters, as in `upload_from_tsv`. `def_tag` sets the tag
+        for new files. `trunc` defaults to start_dir so that study paths
+        are relative to it.
+    '''
+    kwargs.setdefault('trunc', start_dir)
+    kwargs['sync'] = True
+    tsv = manifest.make_tsv(start_dir, def_tag=kwargs.get('def_tag', 'Data'))
+    return upload_from_tsv(io.StringIO(tsv, newline=''), hdl, **kwargs)
@@ -0,0 +1,99 @@
+'''
+Tests for dataverse_utils.archive
+'''
+import hashlib
+import threading
+from unittest import mock
+
+import pytest
+
+from dataverse_utils import archive
+
+def files(names:int=3, versions:int=3)->list:
+    '''
+    File metadata as from StudyMetadata.all_files, for each name in
+    each version, with the content under 'body'
+    '''
+    out = []
+    for ver in range(versions):
+        for num in range(names):
+            body = f'file{num} v{ver}'.encode()
+            out.append({'dataFile_id': ver * 10 + num, 'label': f'f{num}.txt',
+                        'dataFile_filename': f'f{num}.txt',
+                        'versionStatement': f'{ver}.0',
+                        'dataFile_checksum_type': 'MD5',
+                        'dataFile_checksum_value': hashlib.md5(body).hexdigest(),
+                        'body': body})
+    return out
+
+@pytest.fixture(name='bag')
+def fixture_bag(tmp_path):
+    '''
+    Archive of a study with no existing bag, without any requests
+    '''
+    arch = object.__new__(archive.Archive)
+    arch.kwargs = {'all_versions': True, 'target_dir': str(tmp_path),
+                   'digest_type': 'md5', 'workers': 4}
+    arch._Archive__tpid = 'doi-test'#pylint: disable=protected-access
+    arch.bag = None
+    arch.study = mock.Mock(all_files=files())
+    (arch.target_dir / 'data').mkdir(parents=True)
+    return arch
+
+def downloads(bag, wait:int=0)->list:
+    '''
+    Replaces the archive's download_file with one which serves the
+    study's files, and returns the list of file IDs as they are
+    requested. With wait, the first wait downloads must all be in
+    progress at once to get through.
+    '''
+    bodies = {_['dataFile_id']: _['body'] for _ in bag.study.all_files}
+    fetched = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(wait, timeout=10) if wait else None
+    def download_file(fid):
+        with lock:
+            fetched.append(fid)
+            first = len(fetched) <= wait
+        if first:
+            barrier.wait()
+        return mock.Mock(content=bodies[fid])
+    bag.download_file = download_file
+    return fetched
+
+def saved(bag)->dict:
+    '''
+    Contents of the files saved in the bag
+    '''
+    return {_.name: _.read_text(encoding='utf-8')
+            for _ in (bag.target_dir / 'data' / 'files').iterdir()}
+
+def test_process_files_grouped(bag):
+    '''
+    Files with different names are downloaded at once, but versions of
+    the same file one after another, so the latest is kept
+    '''
+    fetched = downloads(bag, wait=3)
+    bag.process_files()
+    assert sorted(fetched) == sorted(_['dataFile_id'] for _ in bag.study.all_files)
+    for num in range(3):
+        assert [_ for _ in fetched if _ % 10 == num] == [num, 10 + num, 20 + num]
+    assert saved(bag) == {f'f{num}.txt': f'file{num} v2' for num in range(3)}
+
+def test_process_files_one_worker(bag):
+    '''
+    With one worker files are downloaded in order
+    '''
+    bag.kwargs['workers'] = 1
+    fetched = downloads(bag)
+    bag.process_files()
+    assert fetched == [_['dataFile_id'] for _ in bag.study.all_files]
+
+def test_process_files_mismatch(bag):
+    '''
+    A damaged download stops the archive, even from another thread
+    '''
+    bag.study.all_files[4]['dataFile_checksum_value'] = '0' * 32
+    downloads(bag)
+    with pytest.raises(archive.DigestMismatchError):
+        bag.process_files()
@@ -0,0 +1,114 @@
+'''
+Tests for dataverse_utils.bundle
+'''
+import hashlib
+import zipfile
+from unittest import mock
+
+import pytest
+
+from dataverse_utils import bundle
+
+URL = 'https://dv.example.org'
+PID = 'doi:10.80240/FK2/TEST'
+
+@pytest.fixture(name='rows')
+def fixture_rows(tmp_path):
+    '''
+    Manifest rows for small files, each containing its own name
+    '''
+    def make(*names, **extra):
+        out = []
+        for name in names:
+            path = tmp_path / name
+            path.write_bytes(name.encode())
+            out.append(dict({'fpath': str(path), 'dirlabel': 'data', 'descr': 'A file',
+                             'tags': ['Data']}, **extra))
+        return out
+    return make
+
+def test_bundle_rows(rows):
+    '''
+    Small files are bundled with others with the same tags. Large
+    files, files Dataverse would process, replacements, hidden files
+    and files on their own are sent singly, in order
+    '''
+    manifest = (rows('a.txt', 'b.txt', 'c.txt', 'd.txt', 'data.csv', '.hidden', 'large.txt')
+                + rows('e.txt', tags=['Code']) + rows('f.txt', replace=9)
+                + rows('g.txt', 'h.txt', tags=['Docs']))
+    order = list(range(len(manifest)))
+    bundles, single = bundle.bundle_rows(manifest, order, bundle=5, bundle_files=2)
+    #large.txt is bigger than 5 bytes
+    assert bundles == [[0, 1], [2, 3], [9, 10]]
+    assert single == [4, 5, 6, 7, 8]
+
+def test_bundle_rows_skip(rows):
+    '''
+    Rows to skip aren't bundled, and unreadable files are sent singly
+    '''
+    manifest = rows('a.txt', 'b.txt', 'c.txt')
+    manifest.append({'fpath': manifest[0]['fpath'] + '.gone', 'tags': ['Data']})
+    bundles, single = bundle.bundle_rows(manifest, [3, 2, 1, 0], bundle=100, skip={1})
+    assert bundles == [[2, 0]]
+    assert single == [3, 1]
+
+def unpacked(uploaded:dict, restricted:bool=False, damaged:str=None):
+    '''
+    Fake upload_file which records the zip's contents in uploaded and
+    returns the files Dataverse would unpack from it, with the md5 of
+    damaged wrong
+    '''
+    def upload_file(zname, hdl, **kwargs):#pylint: disable=unused-argument
+        uploaded['kwargs'] = kwargs
+        out = []
+        with zipfile.ZipFile(zname) as zfile:
+            uploaded['names'] = zfile.namelist()
+            for fid, name in enumerate(uploaded['names'], 1):
+                dirlabel, label = name.rsplit('/', 1)
+                md5 = hashlib.md5(b'' if label == damaged else zfile.read(name)).hexdigest()
+                out.append({'label': label, 'directoryLabel': dirlabel,
+                            'description': kwargs['descr'], 'categories': kwargs['tags'],
+                            'restricted': restricted,
+                            'dataFile': {'id': fid, 'md5': md5}})
+        return out
+    return upload_file
+
+def test_upload_bundle(rows):
+    '''
+    Files are zipped with their paths, sent once and each one checked
+    and restricted afterwards
+    '''
+    manifest = rows('a.txt', 'b.txt') + rows('c.txt', descr='Other')
+    uploaded = {}
+    dvu = bundle.dvu
+    with mock.patch.object(dvu, 'upload_file', side_effect=unpacked(uploaded)), \
+         mock.patch.object(dvu, 'update_file_metadata') as update, \
+         mock.patch.object(dvu, 'restrict_file') as restrict:
+        results = bundle.upload_bundle(manifest, PID, 'bundle.zip', dv=URL, apikey='key',
+                                       rest=True)
+    assert uploaded['names'] == ['data/a.txt', 'data/b.txt', 'data/c.txt']
+    assert uploaded['kwargs']['expand']
+    assert uploaded['kwargs']['descr'] == 'A file'
+    assert not uploaded['kwargs']['rest']
+    assert [_['status'] for _ in results] == ['uploaded'] * 3
+    assert [_['fid'] for _ in results] == [1, 2, 3]
+    #Only the file with a different description needs correcting
+    update.assert_called_once()
+    assert update.call_args.args[1] == 3
+    assert sorted(_.kwargs['fid'] for _ in restrict.call_args_list) == [1, 2, 3]
+
+def test_upload_bundle_mismatch(rows):
+    '''
+    A file which doesn't match after unpacking fails on its own
+    '''
+    manifest = rows('a.txt', 'b.txt')
+    dvu = bundle.dvu
+    with mock.patch.object(dvu, 'upload_file',
+                           side_effect=unpacked({}, restricted=True, damaged='b.txt')), \
+         mock.patch.object(dvu, 'restrict_file') as restrict:
+        results = bundle.upload_bundle(manifest, PID, 'bundle.zip', dv=URL, apikey='key',
+                                       rest=True)
+    assert [_['status'] for _ in results] == ['uploaded', 'failed']
+    assert 'mismatch' in results[1]['error']
+    #Dataverse already restricted them
+    restrict.assert_not_called()
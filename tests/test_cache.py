@@ -0,0 +1,149 @@
+'''
+Tests for dataverse_utils.cache
+'''
+import os
+import sqlite3
+from unittest import mock
+
+import pytest
+import requests
+
+from dataverse_utils import cache
+from dataverse_utils import throttle
+
+URL = 'https://cache.example.org/api/datasets/1'
+
+class Server:
+    '''
+    Stand-in for requests.adapters.HTTPAdapter.send, which answers
+    every request with the current body, or 304 if it matches the ETag
+    '''
+    #pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.body = b'{"status": "OK"}'
+        self.etag = '"1"'
+        self.requests = []
+
+    def __call__(self, adapter, request, stream=False, **kwargs):#pylint: disable=unused-argument
+        self.requests.append(request)
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        response.headers['ETag'] = self.etag
+        if request.headers.get('If-None-Match') == self.etag:
+            response.status_code = 304
+            return response
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = self.body#pylint: disable=protected-access
+        return response
+
+@pytest.fixture(name='server')
+def fixture_server():
+    '''
+    Fake server behind the cache
+    '''
+    fake = Server()
+    with mock.patch.object(requests.adapters.HTTPAdapter, 'send', autospec=True,
+                           side_effect=fake):
+        yield fake
+
+def session(path, **kwargs)->requests.Session:
+    '''
+    Caching session with a cache file in path
+    '''
+    return cache.cached_session(path / 'cache.sqlite', **kwargs)
+
+def test_hit(server, tmp_path):
+    '''
+    A fresh response is answered from the cache without a request
+    '''
+    with session(tmp_path) as sess:
+        first = sess.get(URL)
+        second = sess.get(URL)
+        assert not getattr(first, 'from_cache', False)
+        assert second.from_cache
+        assert second.json() == {'status': 'OK'}
+        assert len(server.requests) == 1
+        assert sess.get_adapter(URL).counters['hits'] == 1
+        #Without a session to read it, the content is still all there
+        direct = sess.get_adapter(URL).send(sess.prepare_request(requests.Request('GET', URL)))
+        assert b''.join(direct.iter_content(4)) == server.body
+
+def test_hit_refunds_rate_limit(server, tmp_path):#pylint: disable=unused-argument
+    '''
+    A response from the cache doesn't count towards the rate limit
+    '''
+    bucket = throttle.bucket(URL)
+    with session(tmp_path) as sess:
+        sess.get(URL)
+        before = bucket.counters['requests']
+        bucket.acquire()
+        sess.get(URL)
+        assert bucket.counters['requests'] == before
+
+def test_revalidate(server, tmp_path):
+    '''
+    An expired response is checked with its ETag and reused on a 304
+    '''
+    with session(tmp_path, ttl=0) as sess:
+        sess.get(URL)
+        again = sess.get(URL)
+        assert server.requests[-1].headers['If-None-Match'] == '"1"'
+        assert again.status_code == 200
+        assert again.content == server.body
+        assert sess.get_adapter(URL).counters['revalidated'] == 1
+
+def test_expired_changed(server, tmp_path):
+    '''
+    An expired response which has changed is downloaded and stored again
+    '''
+    with session(tmp_path, ttl=0) as sess:
+        sess.get(URL)
+        server.body = b'{"status": "changed"}'
+        server.etag = '"2"'
+        assert sess.get(URL).json() == {'status': 'changed'}
+    with session(tmp_path) as sess:
+        assert sess.get(URL).json() == {'status': 'changed'}
+        assert len(server.requests) == 2
+
+def test_eviction(server, tmp_path):
+    '''
+    The least recently used responses are removed when the cache is full
+    '''
+    server.body = os.urandom(1000)
+    with session(tmp_path, max_size=2500) as sess:
+        for num in (1, 2):
+            sess.get(f'{URL}?n={num}')
+        #Used again, so 2 is now the oldest
+        sess.get(f'{URL}?n=1')
+        sess.get(f'{URL}?n=3')
+        assert sess.get_adapter(URL).counters['evicted'] == 1
+        count = len(server.requests)
+        assert sess.get(f'{URL}?n=1').from_cache
+        assert sess.get(f'{URL}?n=3').from_cache
+        assert not getattr(sess.get(f'{URL}?n=2'), 'from_cache', False)
+        assert len(server.requests) == count + 1
+
+def test_keyed_by_api_key(server, tmp_path):
+    '''
+    A response is only reused for the same API key, which isn't stored
+    '''
+    with session(tmp_path) as sess:
+        sess.get(URL, headers={'X-Dataverse-key': 'secret-one'})
+        assert sess.get(URL, headers={'X-Dataverse-key': 'secret-one'}).from_cache
+        assert not getattr(sess.get(URL, headers={'X-Dataverse-key': 'secret-two'}),
+                           'from_cache', False)
+        assert not getattr(sess.get(URL), 'from_cache', False)
+        assert len(server.requests) == 3
+    with sqlite3.connect(tmp_path / 'cache.sqlite') as db:
+        rows = db.execute('SELECT * FROM responses').fetchall()
+    assert len(rows) == 3
+    assert 'secret' not in repr(rows)
+
+def test_default_retry(tmp_path):
+    '''
+    The cache retries failed requests like the rest of the package
+    '''
+    with session(tmp_path) as sess:
+        assert sess.get_adapter(URL).max_retries is throttle.RETRY
@@ -0,0 +1,222 @@
+'''
+Tests for dataverse_utils.collections
+'''
+import collections
+import threading
+from unittest import mock
+
+import pytest
+
+from dataverse_utils import collections as dvc
+
+URL = 'https://dv.example.org'
+
+#alias: (id, title, child collections, studies)
+TREE = {'top': (1, 'Top', ['alpha', 'beta'], ['doi:10.5072/ROOT']),
+        'alpha': (2, 'Alpha', ['gamma'], ['doi:10.5072/A1', 'doi:10.5072/A2']),
+        'beta': (3, 'Beta', [], ['doi:10.5072/B1']),
+        'gamma': (4, 'Gamma', [], ['doi:10.5072/C1'])}
+PIDS = [pid for _ in TREE.values() for pid in _[3]]
+
+def response(data)->mock.Mock:
+    '''
+    Fake requests.Response
+    '''
+    resp = mock.Mock(status_code=200)
+    resp.json.return_value = data
+    return resp
+
+def version(title:str)->dict:
+    '''
+    Study version metadata with a title
+    '''
+    return {'versionNumber': 1, 'versionMinorNumber': 0, 'versionState': 'RELEASED',
+            'metadataBlocks': {'citation': {'fields': [
+                {'typeName': 'title', 'multiple': False,
+                 'typeClass': 'primitive', 'value': title}]}},
+            'files': []}
+
+def study(pid:str)->dict:
+    '''
+    Study metadata as from the dataset API
+    '''
+    protocol, rest = pid.split(':', 1)
+    authority, identifier = rest.split('/', 1)
+    return {'status': 'OK',
+            'data': {'id': 100 + PIDS.index(pid), 'protocol': protocol,
+                     'authority': authority, 'identifier': identifier,
+                     'latestVersion': version(f'Study {identifier}')}}
+
+class Server:
+    '''
+    Stand-in for session.get on a Dataverse installation holding TREE.
+    The search index doesn't know about gamma. Requests for paths in
+    together wait until all of them are in progress.
+    '''
+    #pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.ids = {v[0]: k for k, v in TREE.items()}
+        self.requests = collections.Counter()
+        self.together = {}
+
+    def __contents(self, alias:str)->list:
+        '''
+        Contents of a collection
+        '''
+        out = [{'type': 'dataverse', 'id': TREE[_][0], 'title': TREE[_][1]}
+               for _ in TREE[alias][2]]
+        for pid in TREE[alias][3]:
+            protocol, rest = pid.split(':', 1)
+            authority, identifier = rest.split('/', 1)
+            out.append({'type': 'dataset', 'protocol': protocol,
+                        'authority': authority, 'identifier': identifier})
+        return out
+
+    def __search(self, params:dict)->dict:
+        '''
+        Search results
+        '''
+        items = []
+        for alias, (_, title, kids, pids) in TREE.items():
+            if params['type'] == 'dataverse':
+                items.extend({'entity_id': TREE[_][0], 'identifier': _,
+                              'name': TREE[_][1], 'parentDataverseIdentifier': alias}
+                             for _ in kids if _ != 'gamma')
+                continue
+            for pid in pids:
+                item = {'global_id': pid, 'entity_id': study(pid)['data']['id'],
+                        'name_of_dataverse': title, 'identifier_of_dataverse': alias,
+                        'versionState': 'RELEASED', 'majorVersion': 1, 'minorVersion': 0,
+                        'updatedAt': '2024-01-01T00:00:00Z'}
+                if params['metadata_fields'] and pid != 'doi:10.5072/B1':
+                    item['metadataBlocks'] = version(f'Search {pid}')['metadataBlocks']
+                items.append(item)
+        start = params['start']
+        return {'status': 'OK',
+                'data': {'items': items[start:start + params['per_page']],
+                         'total_count': len(items)}}
+
+    def __call__(self, url:str, params:dict=None, **kwargs):#pylint: disable=unused-argument
+        path = url.split('/api/', 1)[1]
+        self.requests[path] += 1
+        if path in self.together:
+            self.together[path].wait()
+        parts = path.split('/')
+        if path == 'search':
+            return response(self.__search(params))
+        if path == 'datasets/:persistentId':
+            return response(study(params['persistentId']))
+        alias = self.ids.get(int(parts[1])) if parts[1].isdigit() else parts[1]
+        if parts[-1] == 'contents':
+            return response({'status': 'OK', 'data': self.__contents(alias)})
+        return response({'status': 'OK', 'data': {'name': TREE[alias][1], 'alias': alias}})
+
+@pytest.fixture(name='server')
+def fixture_server():
+    '''
+    Fake Dataverse installation
+    '''
+    return Server()
+
+def crawler(server, **kwargs)->dvc.DvCollection:
+    '''
+    DvCollection for the top of TREE on the fake installation
+    '''
+    session = mock.Mock()
+    session.get.side_effect = server
+    return dvc.DvCollection(URL, 'top', session=session, **kwargs)
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_get_collections(server, workers):
+    '''
+    The tree is listed depth-first, however many requests are made at once
+    '''
+    assert crawler(server, workers=workers).get_collections() == [
+        ('Top', 'top'), ('Alpha', 'alpha'), ('Beta', 'beta'), ('Gamma', 'gamma')]
+
+def test_get_collections_parallel(server):
+    '''
+    Collections at the same level are listed at once
+    '''
+    barrier = threading.Barrier(2, timeout=10)
+    server.together = {'dataverses/alpha/contents': barrier,
+                       'dataverses/beta/contents': barrier}
+    assert len(crawler(server, workers=2).get_collections()) == 4
+
+def test_get_studies_requests(server):
+    '''
+    A crawl asks for each collection's contents once, finds short
+    names with one search and only looks up collections it can't find
+    '''
+    coll = crawler(server, workers=2)
+    studies = coll.get_studies()
+    assert [_['pid'] for _ in studies] == ['doi:10.5072/ROOT', 'doi:10.5072/A1',
+                                           'doi:10.5072/A2', 'doi:10.5072/B1',
+                                           'doi:10.5072/C1']
+    assert studies[1]['collection_short_name'] == 'alpha'
+    assert studies[4]['collection_name'] == 'Gamma'
+    assert server.requests == {'dataverses/top': 1, 'search': 1,
+                               'dataverses/top/contents': 1, 'dataverses/alpha/contents': 1,
+                               'dataverses/beta/contents': 1, 'dataverses/gamma/contents': 1,
+                               'dataverses/4': 1, 'datasets/:persistentId': 5}
+
+def test_study_versions_lazy(server):
+    '''
+    A study made from its metadata only asks for its versions when
+    they are used, and only once
+    '''
+    session = mock.Mock()
+    pid = 'doi:10.5072/A1'
+    older = dict(version('Older'), versionMinorNumber=None, versionNumber=None,
+                 versionState='DEACCESSIONED')
+    session.get.return_value = response({'status': 'OK',
+                                         'data': [study(pid)['data']['latestVersion'], older]})
+    stud = dvc.StudyMetadata(study_meta=study(pid), url=URL, session=session)
+    assert stud['title'] == 'Study A1'
+    assert stud['pid'] == pid
+    session.get.assert_not_called()
+    assert stud.versions == ['1.0', 'DEACCESSIONED']
+    assert stud.all_files == []
+    session.get.assert_called_once()
+    assert session.get.call_args.args[0] == f'{URL}/api/datasets/:persistentId/versions'
+    #Crawled studies are the same
+    assert crawler(server).get_study_info(pid)['title'] == 'Study A1'
+    assert server.requests['datasets/:persistentId'] == 1
+
+def test_study_versions_supplied():
+    '''
+    Versions supplied with the metadata aren't requested
+    '''
+    session = mock.Mock()
+    pid = 'doi:10.5072/A1'
+    stud = dvc.StudyMetadata(study_meta=study(pid), url=URL, session=session,
+                             all_versions={'status': 'OK',
+                                           'data': [study(pid)['data']['latestVersion']]})
+    assert stud.versions == ['1.0']
+    stud.all_versions = {'status': 'OK', 'data': [version('New'),
+                                                  dict(version('Old'), versionMinorNumber=1)]}
+    assert stud.index == {'1.0': 0, '1.1': 1}
+    session.get.assert_not_called()
+
+def test_search_studies(server):
+    '''
+    Studies come from the search index, page by page, and only those
+    without metadata there are fetched individually
+    '''
+    studies = crawler(server, workers=2).search_studies(per_page=2)
+    assert [_['pid'] for _ in studies] == PIDS
+    assert [_['title'] for _ in studies] == ['Search doi:10.5072/ROOT',
+                                             'Search doi:10.5072/A1', 'Search doi:10.5072/A2',
+                                             'Study B1', 'Search doi:10.5072/C1']
+    assert studies[3]['collection_short_name'] == 'beta'
+    assert server.requests['search'] == 3
+    assert server.requests['datasets/:persistentId'] == 1
+    assert 'dataverses/top/contents' not in server.requests
+
+def test_search_studies_complete(server):
+    '''
+    With complete, the search only finds the studies
+    '''
+    studies = crawler(server).search_studies(complete=True)
+    assert [_['title'] for _ in studies] == [f"Study {_.rsplit('/', 1)[1]}" for _ in PIDS]
+    assert server.requests['datasets/:persistentId'] == len(PIDS)
@@ -0,0 +1,137 @@
+'''
+Tests for dataverse_utils.dataverse_utils
+'''
+import hashlib
+import importlib
+import io
+from unittest import mock
+
+import pytest
+import requests
+
+#The package's dataverse_utils attribute is the package itself
+du = importlib.import_module('dataverse_utils.dataverse_utils')
+
+URL = 'https://dv.example.org'
+PID = 'doi:10.80240/FK2/TEST'
+
+def response(status:int=200, text:str='', data=None)->mock.Mock:
+    '''
+    Fake requests.Response
+    '''
+    resp = mock.Mock(status_code=status, text=text)
+    resp.json.return_value = {'status': 'OK', 'data': data}
+    resp.raise_for_status.side_effect = (requests.exceptions.HTTPError(status)
+                                         if status >= 400 else None)
+    return resp
+
+@pytest.mark.parametrize('status, text, locked', [
+    (423, '', True),
+    (403, '{"status":"ERROR","message":"Dataset cannot be edited due to dataset lock."}', True),
+    (400, 'Dataset cannot be edited due to In Review Lock', True),
+    (409, 'Dataset cannot be edited due to dataset LOCK.', True),
+    (400, 'Failed to add file: the file is locked down', False),
+    (403, 'Unlock the blocked user first', False),
+    (409, 'Conflict', False),
+    (500, 'Dataset cannot be edited due to dataset lock.', False),
+    (200, 'lock', False),
+])
+def test_is_lock_refusal(status, text, locked):
+    '''
+    Only 423s and refusals which mention a dataset lock are lock refusals
+    '''
+    assert du._is_lock_refusal(response(status, text)) is locked #pylint: disable=protected-access
+
+def test_restrict_file_lock_retries():
+    '''
+    Restriction refused because of a lock is retried, then given up
+    '''
+    session = mock.Mock()
+    session.put.return_value = response(423)
+    with mock.patch.object(du, 'wait_for_unlock') as wait:
+        with pytest.raises(du.DvGeneralUploadError):
+            du.restrict_file(fid=1, dv=URL, apikey='key', hdl=PID,
+                             retries=2, session=session)
+    assert session.put.call_count == 3
+    assert wait.call_count == 2
+
+def test_restrict_file_lock_clears():
+    '''
+    Restriction succeeds once the lock clears
+    '''
+    session = mock.Mock()
+    session.put.side_effect = [response(423), response(200)]
+    with mock.patch.object(du, 'wait_for_unlock') as wait:
+        du.restrict_file(fid=1, dv=URL, apikey='key', hdl=PID, session=session)
+    assert session.put.call_count == 2
+    assert wait.call_count == 1
+
+def receiver(reported:bytes=b'', status:int=200):
+    '''
+    Fake session.post for uploads, which reads the whole body and
+    replies with the md5 of the reported content. The bodies received
+    are kept in its sent list.
+    '''
+    def post(url, data=None, **kwargs):#pylint: disable=unused-argument
+        body = b''.join(data) if not hasattr(data, 'read') else data.read()
+        post.sent.append(body)
+        return response(status, data={'files': [{'dataFile': {
+                            'id': 5, 'md5': hashlib.md5(reported).hexdigest()}}]})
+    post.sent = []
+    return post
+
+def test_upload_file_verified(tmp_path):
+    '''
+    The checksum calculated while sending is compared with Dataverse's
+    '''
+    path = tmp_path / 'data.txt'
+    path.write_bytes(b'some data')
+    session = mock.Mock(hooks={'response': []})
+    session.post.side_effect = receiver(reported=b'some data')
+    with mock.patch.object(du, 'file_digest') as digest:
+        assert du.upload_file(str(path), PID, dv=URL, apikey='key', session=session,
+                              pipeline=True)['id'] == 5
+    #The file is only read to send it
+    digest.assert_not_called()
+    assert b'some data' in session.post.side_effect.sent[0]
+
+def test_upload_file_mismatch(tmp_path):
+    '''
+    A file which arrives different from what was sent is an error
+    '''
+    path = tmp_path / 'data.txt'
+    path.write_bytes(b'some data')
+    session = mock.Mock(hooks={'response': []})
+    session.post.side_effect = receiver(reported=b'other data')
+    with pytest.raises(du.Md5Error):
+        du.upload_file(str(path), PID, dv=URL, apikey='key', session=session, pipeline=True)
+
+def test_upload_file_iterator():
+    '''
+    An iterator is sent without knowing its length, after any study
+    lock, and its checksum is still verified
+    '''
+    chunks = [b'first ', b'second ', b'third']
+    session = mock.Mock(hooks={'response': []})
+    session.post.side_effect = receiver(reported=b''.join(chunks))
+    with mock.patch.object(du, 'wait_for_unlock') as wait:
+        with pytest.raises(KeyError, match='label'):
+            du.upload_file(iter(chunks), PID, dv=URL, apikey='key', session=session)
+        stats = {}
+        assert du.upload_file(iter(chunks), PID, dv=URL, apikey='key', session=session,
+                              label='data.txt', pipeline=True, stats=stats)['id'] == 5
+    wait.assert_called_once()
+    assert b'first second third' in session.post.side_effect.sent[0]
+    assert stats['bytes'] == len(b''.join(chunks))
+
+def test_upload_file_stream_locked():
+    '''
+    A stream refused because of a lock can't be sent again
+    '''
+    session = mock.Mock(hooks={'response': []})
+    session.post.side_effect = receiver(status=423)
+    with mock.patch.object(du, 'wait_for_unlock'):
+        with pytest.raises(du.DvGeneralUploadError, match='locked'):
+            du.upload_file(io.BytesIO(b'data'), PID, dv=URL, apikey='key', session=session,
+                           label='data.txt', size=4)
+    assert session.post.call_count == 1
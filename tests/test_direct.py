@@ -0,0 +1,191 @@
+'''
+Tests for dataverse_utils.direct
+'''
+import hashlib
+import threading
+from unittest import mock
+
+import pytest
+
+from dataverse_utils import direct
+
+URL = 'https://dv.example.org'
+PID = 'doi:10.80240/FK2/TEST'
+DATA = bytes(range(100))
+
+def response(status:int=200, text:str='', data=None, headers:dict=None)->mock.Mock:
+    '''
+    Fake requests.Response
+    '''
+    resp = mock.Mock(status_code=status, text=text, reason='', headers=headers or {})
+    resp.json.return_value = {'status': 'OK', 'data': data}
+    return resp
+
+def storage(*replies):
+    '''
+    Fake session.put for storage, which reads each part and replies
+    in turn with a status code, an ETag, or for None, the part's md5
+    '''
+    replies = list(replies)
+    def put(url, data=None, **kwargs):#pylint: disable=unused-argument
+        body = data.read() if hasattr(data, 'read') else data
+        reply = replies.pop(0) if replies else None
+        if isinstance(reply, int):
+            return response(reply)
+        return response(headers={'ETag': f'"{reply or hashlib.md5(body).hexdigest()}"'})
+    return put
+
+@pytest.fixture(name='fpath')
+def fixture_fpath(tmp_path):
+    '''
+    A file of 100 bytes
+    '''
+    path = tmp_path / 'data.bin'
+    path.write_bytes(DATA)
+    return str(path)
+
+@pytest.fixture(name='session')
+def fixture_session():
+    '''
+    Fake requests session
+    '''
+    return mock.Mock(hooks={'response': []})
+
+def test_put_part(fpath, session):
+    '''
+    A part is sent once if the storage gets it intact
+    '''
+    session.put.side_effect = storage(None)
+    etag, md5, attempts = direct._put_part('https://s3/1', fpath, 10, 20,#pylint: disable=protected-access
+                                           session=session)
+    assert md5 == hashlib.md5(DATA[10:30]).hexdigest()
+    assert etag == f'"{md5}"'
+    assert attempts == 1
+
+def test_put_part_etag_mismatch(fpath, session):
+    '''
+    A part whose ETag isn't its md5 is sent again
+    '''
+    session.put.side_effect = storage('0' * 32, None)
+    etag, md5, attempts = direct._put_part('https://s3/1', fpath, 0, 40,#pylint: disable=protected-access
+                                           session=session, backoff=0)
+    assert etag.strip('"') == md5 == hashlib.md5(DATA[:40]).hexdigest()
+    assert attempts == 2
+
+def test_put_part_gives_up(fpath, session):
+    '''
+    A part which keeps arriving damaged fails after the retries
+    '''
+    session.put.side_effect = storage(*['0' * 32] * 3)
+    with pytest.raises(direct.dvu.DvGeneralUploadError, match='ETag'):
+        direct._put_part('https://s3/1', fpath, 0, 40, session=session,#pylint: disable=protected-access
+                         retries=2, backoff=0)
+    assert session.put.call_count == 3
+
+def test_put_part_server_error(fpath, session):
+    '''
+    Server errors are retried, but refusals aren't
+    '''
+    session.put.side_effect = storage(503, None)
+    assert direct._put_part('https://s3/1', fpath, 0, 40,#pylint: disable=protected-access
+                            session=session, backoff=0)[2] == 2
+    session.put.side_effect = storage(403)
+    with pytest.raises(direct.dvu.DvGeneralUploadError, match='refused'):
+        direct._put_part('https://s3/1', fpath, 0, 40, session=session)#pylint: disable=protected-access
+
+def test_put_part_encrypted(fpath, session):
+    '''
+    An ETag which isn't an md5 can't be checked, so is accepted
+    '''
+    session.put.side_effect = storage('abc123-1')
+    assert direct._put_part('https://s3/1', fpath, 0, 40,#pylint: disable=protected-access
+                            session=session)[0] == '"abc123-1"'
+
+def multipart(session, parts:dict):
+    '''
+    Sets up a fake session for a multipart upload in parts of
+    40 bytes, with storage replies for each part as in `storage`.
+    Returns the URLs of the parts.
+    '''
+    urls = {str(_): f'https://s3/part{_}' for _ in (1, 2, 3)}
+    session.get.return_value = response(data={'urls': urls, 'partSize': 40,
+                                              'complete': '/api/complete',
+                                              'abort': '/api/abort',
+                                              'storageIdentifier': 's3://bucket:123'})
+    replies = {url: storage(*parts.get(num, [None])) for num, url in urls.items()}
+    #All three parts must be in flight at once to get through
+    barrier = threading.Barrier(3, timeout=10)
+    def put(url, **kwargs):
+        if url in replies:
+            barrier.wait()
+            return replies[url](url, **kwargs)
+        return response()
+    session.put.side_effect = put
+    return urls
+
+def test_put_file_parts(fpath, session):
+    '''
+    Parts are sent in parallel and the upload completed with their ETags
+    '''
+    urls = multipart(session, {})
+    stats = {}
+    entry = direct.put_file(fpath, PID, dv=URL, apikey='key', session=session,
+                            parts=3, stats=stats, label='data.bin')
+    assert entry['storageIdentifier'] == 's3://bucket:123'
+    assert entry['checksum'] == {'@type': 'MD5', '@value': hashlib.md5(DATA).hexdigest()}
+    complete = session.put.call_args_list[-1]
+    assert complete.args[0] == f'{URL}/api/complete'
+    assert complete.kwargs['json'] == {
+        num: f'"{hashlib.md5(DATA[(int(num)-1)*40:int(num)*40]).hexdigest()}"'
+        for num in urls}
+    assert stats['bytes'] == len(DATA)
+    assert stats['retries'] == 0
+    session.delete.assert_not_called()
+
+def test_put_file_abort(fpath, session):
+    '''
+    A multipart upload is aborted if a part can't be sent
+    '''
+    multipart(session, {'2': [403]})
+    with pytest.raises(direct.dvu.DvGeneralUploadError):
+        direct.put_file(fpath, PID, dv=URL, apikey='key', session=session, parts=3)
+    session.delete.assert_called_once()
+    assert session.delete.call_args.args[0] == f'{URL}/api/abort'
+    assert f'{URL}/api/complete' not in [_.args[0] for _ in session.put.call_args_list]
+
+def test_put_file_md5(fpath, session):
+    '''
+    A file sent in one piece is checked against a supplied md5
+    '''
+    session.get.return_value = response(data={'url': 'https://s3/one',
+                                              'storageIdentifier': 's3://bucket:1'})
+    session.put.side_effect = storage(None)
+    with pytest.raises(direct.dvu.Md5Error):
+        direct.put_file(fpath, PID, dv=URL, apikey='key', session=session, md5='0' * 32)
+    assert session.put.call_args.kwargs['headers'] == {'x-amz-tagging': 'dv-state=temp'}
+
+def test_add_files_lock(session):
+    '''
+    Registration refused because the study is locked is retried once it clears
+    '''
+    added = [{'storageIdentifier': 's3://bucket:1', 'fileDetails': {'id': 1}}]
+    session.post.side_effect = [
+        response(423),
+        response(403, '{"message":"Dataset cannot be edited due to dataset lock."}'),
+        response(data={'Files': added})]
+    with mock.patch.object(direct.dvu, 'wait_for_unlock') as wait:
+        assert direct.add_files([{'storageIdentifier': 's3://bucket:1'}], PID,
+                                dv=URL, apikey='key', session=session) == added
+    assert wait.call_count == 2
+    assert session.post.call_count == 3
+
+def test_add_files_still_locked(session):
+    '''
+    Registration gives up if the study stays locked
+    '''
+    session.post.return_value = response(423)
+    with mock.patch.object(direct.dvu, 'wait_for_unlock') as wait:
+        with pytest.raises(direct.dvu.DvGeneralUploadError, match='still locked'):
+            direct.add_files([], PID, dv=URL, apikey='key', session=session, retries=1)
+    assert session.post.call_count == 2
+    assert wait.call_count == 1
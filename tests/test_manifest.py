@@ -0,0 +1,76 @@
+'''
+Tests for dataverse_utils.manifest
+'''
+import hashlib
+import io
+import os
+
+import pytest
+
+from dataverse_utils import manifest
+
+FILES = ['a.txt', 'a-b.txt', 'a/x.txt', 'a/b.c', 'a/b/c.txt', 'a/b-c/d.txt',
+         'a0/1.txt', 'b/.hidden', '.dot/e.txt', 'z.txt']
+
+@pytest.fixture(name='tree')
+def fixture_tree(tmp_path):
+    '''
+    Directory of files whose names sort differently
+    as paths than as directory listings
+    '''
+    for name in FILES:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name, encoding='utf-8')
+    return tmp_path
+
+def test_walk_files_sorted(tree):
+    '''
+    Paths come out as if the whole list had been sorted
+    '''
+    #The order of sorting every path found by os.walk, as before walk_files
+    expected = sorted(f'{x[0]}{os.sep}{y}' for x in os.walk(tree)
+                      for y in x[2] if not y.startswith('.'))
+    assert list(manifest.walk_files(tree)) == expected
+
+def test_walk_files_prune(tree):
+    '''
+    Hidden directories are skipped with prune
+    '''
+    found = [os.path.relpath(_, tree) for _ in manifest.walk_files(tree, prune=True)]
+    assert os.path.join('.dot', 'e.txt') not in found
+    assert len(found) == len(FILES) - 2
+
+def test_walk_files_hidden(tree):
+    '''
+    Everything is found with hidden
+    '''
+    found = [os.path.relpath(_, tree) for _ in manifest.walk_files(tree, hidden=True)]
+    assert sorted(found) == sorted(os.path.normpath(_) for _ in FILES)
+
+def test_walk_files_not_recursive(tree):
+    '''
+    Only the top directory is listed without recursive
+    '''
+    assert ([os.path.basename(_) for _ in manifest.walk_files(tree, recursive=False)] ==
+            ['a-b.txt', 'a.txt', 'z.txt'])
+
+def test_write_tsv_checksum(tree):
+    '''
+    Checksums of a streamed list of files are written
+    '''
+    outf = io.StringIO(newline='')
+    count = manifest.write_tsv(outf, str(tree), in_list=iter([str(tree / 'a.txt')]),
+                               checksum='md5')
+    assert count == 1
+    assert outf.getvalue().splitlines()[1].endswith(hashlib.md5(b'a.txt').hexdigest())
+
+def test_write_tsv_missing_file(tree):
+    '''
+    A missing file raises an OSError naming it
+    '''
+    #A streamed list is hashed in a process pool
+    with pytest.raises(OSError, match='nope.txt'):
+        manifest.write_tsv(io.StringIO(newline=''), str(tree),
+                           in_list=iter([str(tree / 'a.txt'), str(tree / 'nope.txt')]),
+                           checksum='md5')
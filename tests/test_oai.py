@@ -0,0 +1,107 @@
+'''
+Tests for dataverse_utils.oai
+'''
+import io
+import json
+from unittest import mock
+
+import pytest
+
+from dataverse_utils import oai
+
+URL = 'https://dv.example.org'
+
+def record(pid:str, meta:dict=None, deleted:bool=False)->str:
+    '''
+    An OAI record with dataverse_json metadata, or with none if deleted
+    '''
+    status = ' status="deleted"' if deleted else ''
+    body = ('' if deleted else
+            f'<metadata>{json.dumps(meta or {"datasetVersion": {"id": pid}})}</metadata>')
+    return (f'<record><header{status}><identifier>{pid}</identifier>'
+            f'<datestamp>2024-01-01</datestamp><setSpec>root</setSpec></header>'
+            f'{body}</record>')
+
+def page(records:list, token:str=None, date:str='2024-06-01T00:00:00Z',
+         verb:str='ListRecords')->mock.MagicMock:
+    '''
+    Fake streamed response with one page of records
+    '''
+    resume = f'<resumptionToken>{token}</resumptionToken>' if token else ''
+    xml = (f'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+           f'<responseDate>{date}</responseDate>'
+           f'<{verb}>{"".join(records)}{resume}</{verb}></OAI-PMH>')
+    resp = mock.MagicMock()
+    resp.raw = io.BytesIO(xml.encode())
+    resp.__enter__.return_value = resp
+    return resp
+
+@pytest.fixture(name='session')
+def fixture_session():
+    '''
+    Fake requests session
+    '''
+    return mock.Mock()
+
+@pytest.fixture(autouse=True, name='study')
+def fixture_study():
+    '''
+    StudyMetadata replaced with the study metadata it's given
+    '''
+    with mock.patch.object(oai.dvc, 'StudyMetadata',
+                           side_effect=lambda **kwargs: kwargs['study_meta']) as study:
+        yield study
+
+def harvest(session, **kwargs)->list:
+    '''
+    Identifiers of the studies from a harvest, with None for deletions
+    '''
+    return [(head['identifier'], study and study['data']['latestVersion']['id'])
+            for head, study in oai.Harvester(URL, session=session, **kwargs).records()]
+
+def test_resumption_token(session):
+    '''
+    Pages are followed by resumption token until there is none
+    '''
+    session.get.side_effect = [page([record('doi:1'), record('doi:2')], token='abc'),
+                               page([record('doi:3', deleted=True)])]
+    assert harvest(session) == [('doi:1', 'doi:1'), ('doi:2', 'doi:2'), ('doi:3', None)]
+    first, second = [_.kwargs['params'] for _ in session.get.call_args_list]
+    assert first == {'verb': 'ListRecords', 'metadataPrefix': 'dataverse_json'}
+    assert second == {'verb': 'ListRecords', 'resumptionToken': 'abc'}
+
+def test_bad_record_skipped(session, tmp_path):
+    '''
+    A record which can't be read is skipped without ending the harvest,
+    and listed in the state file
+    '''
+    state = tmp_path / 'state.json'
+    session.get.side_effect = [page([record('doi:1', meta={'no': 'version'}),
+                                     record('doi:2')])]
+    assert harvest(session, state=str(state)) == [('doi:2', 'doi:2')]
+    saved = json.loads(state.read_text(encoding='utf-8'))
+    assert list(saved.values()) == [{'from': '2024-06-01T00:00:00Z', 'records': 1,
+                                     'deleted': 0, 'failed': ['doi:1'], 'pages': 1}]
+
+def test_resume_from_state(session, tmp_path):
+    '''
+    A harvest asks for changes since the previous one, then retries
+    the records it couldn't read
+    '''
+    state = tmp_path / 'state.json'
+    key = f'{URL}/oai dataverse_json'
+    state.write_text(json.dumps({key: {'from': '2024-05-01T00:00:00Z',
+                                       'failed': ['doi:1', 'doi:9']}}), encoding='utf-8')
+    session.get.side_effect = [page([record('doi:2'), record('doi:9')],
+                                    date='2024-06-01T00:00:00Z'),
+                               page([record('doi:1')], verb='GetRecord')]
+    assert harvest(session, state=str(state)) == [('doi:2', 'doi:2'), ('doi:9', 'doi:9'),
+                                                  ('doi:1', 'doi:1')]
+    listed, retried = [_.kwargs['params'] for _ in session.get.call_args_list]
+    assert listed['from'] == '2024-05-01T00:00:00Z'
+    assert retried == {'verb': 'GetRecord', 'identifier': 'doi:1',
+                       'metadataPrefix': 'dataverse_json'}
+    saved = json.loads(state.read_text(encoding='utf-8'))[key]
+    assert saved['from'] == '2024-06-01T00:00:00Z'
+    assert saved['failed'] == []
+    assert saved['records'] == 3
@@ -0,0 +1,71 @@
+'''
+Tests for dataverse_utils.streams
+'''
+import hashlib
+import io
+
+from dataverse_utils import streams
+
+DATA = bytes(range(256)) * 10
+
+def test_hashing_reader(tmp_path):
+    '''
+    Bytes are hashed as they are read, and the length comes from the file
+    '''
+    path = tmp_path / 'data.bin'
+    path.write_bytes(DATA)
+    with open(path, 'rb') as fobj:
+        fobj.seek(100)
+        reader = streams.HashingReader(fobj, ['md5', 'sha256'])
+        assert reader.len == len(DATA) - 100
+        assert reader.read(1000) == DATA[100:1100]
+        assert reader.len == len(DATA) - 1100
+        reader.read()
+    assert reader.len == 0
+    assert reader.count == len(DATA) - 100
+    assert reader.hexdigest() == hashlib.md5(DATA[100:]).hexdigest()
+    assert reader.hexdigest('sha256') == hashlib.sha256(DATA[100:]).hexdigest()
+
+def test_hashing_reader_stream():
+    '''
+    The length of a stream is unknown unless it is supplied
+    '''
+    assert streams.HashingReader(io.BytesIO(DATA)).len is None
+    reader = streams.HashingReader(io.BytesIO(DATA), size=len(DATA))
+    assert reader.len == len(DATA)
+    while reader.read(100):
+        pass
+    assert reader.len == 0
+    assert reader.hexdigest() == hashlib.md5(DATA).hexdigest()
+
+def test_iter_stream():
+    '''
+    An iterator of chunks reads like a file
+    '''
+    stream = streams._IterStream(iter([b'abc', b'', b'defgh', b'ij']))#pylint: disable=protected-access
+    assert stream.read(2) == b'ab'
+    assert stream.read(4) == b'cdef'
+    assert stream.read() == b'ghij'
+    assert stream.read(10) == b''
+
+def test_multipart_stream():
+    '''
+    A multipart body is generated from a stream, and the callback
+    runs once it has all been sent
+    '''
+    done = []
+    body, content_type = streams._multipart_stream(#pylint: disable=protected-access
+                            {'file': ('data.bin', io.BytesIO(DATA), 'application/octet-stream'),
+                             'jsonData': '{"label": "data.bin"}'},
+                            lambda: done.append(True), blocksize=1000)
+    boundary = content_type.split('boundary=')[1]
+    chunks = list(body)
+    assert done == [True]
+    #Read in blocks, not all at once
+    assert DATA[:1000] in chunks
+    data = b''.join(chunks)
+    assert data.endswith(f'--{boundary}--\r\n'.encode())
+    parts = data.split(f'--{boundary}'.encode())[1:-1]
+    assert b'filename="data.bin"' in parts[0]
+    assert parts[0].split(b'\r\n\r\n', 1)[1] == DATA + b'\r\n'
+    assert parts[1].endswith(b'\r\n\r\n{"label": "data.bin"}\r\n')
@@ -0,0 +1,192 @@
+'''
+Tests for dataverse_utils.throttle
+'''
+from unittest import mock
+
+import pytest
+
+from dataverse_utils import collections as dvc
+from dataverse_utils import throttle
+
+class Clock:
+    '''
+    Stand-in for the time module, which only moves when slept
+    '''
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def monotonic(self)->float:
+        '''
+        Current time
+        '''
+        return self.now
+
+    def sleep(self, seconds:float):
+        '''
+        Move the time on
+        '''
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture(name='clock')
+def fixture_clock():
+    '''
+    Fake clock for the throttle module
+    '''
+    fake = Clock()
+    with mock.patch.object(throttle, 'time', fake):
+        yield fake
+
+def test_acquire_unlimited(clock):
+    '''
+    Without a rate, requests never wait
+    '''
+    bucket = throttle.TokenBucket('example.org')
+    for _ in range(5):
+        assert bucket.acquire() == 0
+    assert not clock.slept
+    assert bucket.counters['requests'] == 5
+
+@pytest.mark.usefixtures('clock')
+def test_acquire_rate():
+    '''
+    After the burst, requests are spaced out at the rate
+    '''
+    bucket = throttle.TokenBucket('example.org', rate=2, burst=2)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert bucket.counters['waits'] == 2
+    assert bucket.counters['waited'] == pytest.approx(1)
+
+def test_acquire_refills(clock):
+    '''
+    Quiet time refills the bucket, but only up to the burst
+    '''
+    bucket = throttle.TokenBucket('example.org', rate=1, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    clock.now += 10
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0, pytest.approx(1)]
+
+def test_shared_bucket(clock):
+    '''
+    Every rate limiter for a host draws from the same bucket
+    '''
+    first = throttle.bucket('https://shared.example.org/api', rate=1)
+    assert throttle.bucket('shared.example.org', rate=2) is first
+    assert first.rate == 1
+    limiters = [dvc.RateLimiter(url='https://shared.example.org', rate_limit_on=True,
+                                rate_limit_min=1, rate_limit_max=1) for _ in range(3)]
+    for limiter in limiters:
+        limiter.rate_limit()
+    assert sum(clock.slept) == pytest.approx(2)
+
+@pytest.mark.usefixtures('clock')
+def test_pause():
+    '''
+    A Retry-After pause holds even requests which aren't rate limited
+    '''
+    bucket = throttle.TokenBucket('example.org')
+    bucket.pause(5)
+    assert bucket.acquire(limited=False) == pytest.approx(5)
+    assert bucket.acquire() == 0
+    assert bucket.counters['retry_after'] == 1
+    assert bucket.counters['retry_after_wait'] == 5
+
+@pytest.mark.usefixtures('clock')
+def test_pause_spends_burst():
+    '''
+    There is no burst straight after a pause
+    '''
+    bucket = throttle.TokenBucket('example.org', rate=1, burst=5)
+    bucket.pause(2)
+    assert bucket.acquire() == pytest.approx(3)
+    assert bucket.acquire() == pytest.approx(1)
+
+@pytest.mark.usefixtures('clock')
+def test_pause_keeps_longest():
+    '''
+    A shorter pause doesn't cut a longer one short
+    '''
+    bucket = throttle.TokenBucket('example.org')
+    bucket.pause(10)
+    bucket.pause(1)
+    assert bucket.acquire() == pytest.approx(10)
+
+def test_configure_keeps_slowest_rate():
+    '''
+    The slowest rate asked for applies
+    '''
+    bucket = throttle.TokenBucket('example.org', rate=5)
+    bucket.configure(rate=10)
+    assert bucket.rate == 5
+    bucket.configure(rate=1)
+    assert bucket.rate == 1
+
+def test_record_error_cuts():
+    '''
+    Server errors halve the limit, once for a batch of failures
+    '''
+    control = throttle.Controller('example.org', maximum=16, start=8)
+    control.record(status=503)
+    assert control.limit == 4
+    control.record(error=True)
+    assert control.limit == 4
+    assert control.counters['errors'] == 2
+    assert control.counters['decreases'] == 1
+
+def test_record_error_minimum():
+    '''
+    The limit doesn't go below the minimum
+    '''
+    control = throttle.Controller('example.org', maximum=16, start=2, minimum=2)
+    control.record(status=429)
+    assert control.limit == 2
+
+def test_record_ignores_client_errors():
+    '''
+    Client errors say nothing about the server's load
+    '''
+    control = throttle.Controller('example.org', start=4)
+    control.record(0.1, status=404)
+    assert control.limit == 4
+    assert control.counters['errors'] == 0
+
+def test_record_increases_when_busy():
+    '''
+    Healthy responses raise the limit by one a window, up to the maximum,
+    while the limit is in use
+    '''
+    control = throttle.Controller('example.org', maximum=3, window=5)
+    with control.slot():
+        for _ in range(5):
+            control.record(0.1, 200)
+        assert control.limit == 2
+        for _ in range(10):
+            control.record(0.1, 200)
+    assert control.limit == 3
+    assert control.counters['increases'] == 2
+
+def test_record_idle_unchanged():
+    '''
+    The limit isn't raised if it isn't being used
+    '''
+    control = throttle.Controller('example.org', maximum=8, start=4, window=5)
+    for _ in range(5):
+        control.record(0.1, 200)
+    assert control.limit == 4
+
+def test_record_latency_cuts():
+    '''
+    Responses much slower than the best seen cut the limit
+    '''
+    control = throttle.Controller('example.org', start=8, window=5, latency=2)
+    for _ in range(5):
+        control.record(0.1, 200)
+    for _ in range(5):
+        control.record(1.0, 200)
+    assert control.limit == 4
+    assert control.counters['decreases'] == 1
@@ -0,0 +1,103 @@
+'''
+Tests for dataverse_utils.upload
+'''
+import hashlib
+import importlib
+import io
+from unittest import mock
+
+import requests
+
+from dataverse_utils import upload
+
+#The package's dataverse_utils attribute is the package itself
+du = importlib.import_module('dataverse_utils.dataverse_utils')
+
+URL = 'https://dv.example.org'
+PID = 'doi:10.80240/FK2/TEST'
+
+def reply(data=None)->mock.Mock:
+    '''
+    Fake successful requests.Response
+    '''
+    return mock.Mock(status_code=200, text='',
+                     **{'json.return_value': {'status': 'OK', 'data': data}})
+
+def remote(label:str, fid:int, content:bytes=b'', dirlabel:str='')->dict:
+    '''
+    Study file metadata as from dataset_files
+    '''
+    out = {'label': label, 'restricted': False,
+           'dataFile': {'id': fid, 'md5': hashlib.md5(content).hexdigest(),
+                        'checksum': {'type': 'MD5',
+                                     'value': hashlib.md5(content).hexdigest()}}}
+    if dirlabel:
+        out['directoryLabel'] = dirlabel
+    return out
+
+def test_journal_resume(tmp_path):
+    '''
+    Finished files are skipped, an interrupted upload which reached the
+    study is picked up from its listing, and the rest are sent
+    '''
+    for name in ('done.txt', 'interrupted.txt', 'todo.txt'):
+        (tmp_path / name).write_bytes(name.encode('utf-8'))
+    manifest = io.StringIO('file\tdescription\ttags\n' +
+                           ''.join(f'{tmp_path / _}\t{_}\tData\n'
+                                   for _ in ('done.txt', 'interrupted.txt', 'todo.txt')))
+    dirlabel = du.file_path(str(tmp_path / 'done.txt'), '')
+    journal = upload.UploadJournal(str(tmp_path / 'journal.sqlite3'))
+    rows = upload._manifest_rows(manifest)#pylint: disable=protected-access
+    manifest.seek(0)
+    journal.mark(PID, rows[0], 'complete', fid=1, restricted=True)
+    #Upload started, but the run stopped before Dataverse replied
+    journal.mark(PID, rows[1], 'started')
+
+    session = requests.Session()
+    listing = [remote('done.txt', 1, b'done.txt', dirlabel),
+               remote('interrupted.txt', 2, b'interrupted.txt', dirlabel)]
+    with mock.patch.object(session, 'get', return_value=reply(listing)) as get, \
+         mock.patch.object(session, 'put', return_value=reply()) as put, \
+         mock.patch.object(du, 'upload_file', return_value={'id': 3, 'md5': 'abc'}) as send:
+        results = upload.upload_from_tsv(manifest, hdl=PID, dv=URL, apikey='key', rest=True,
+                                         journal=journal, session=session, lanes=1)
+
+    assert [_['status'] for _ in results] == ['skipped', 'resumed', 'uploaded']
+    assert [_['fid'] for _ in results] == [1, 2, 3]
+    #One listing to find the interrupted file, which isn't sent again
+    assert get.call_count == 1
+    assert send.call_count == 1
+    assert send.call_args.args[0] == str(tmp_path / 'todo.txt')
+    assert sorted(_.args[0] for _ in put.call_args_list) == [f'{URL}/api/files/2/restrict',
+                                                            f'{URL}/api/files/3/restrict']
+    assert [journal.get(PID, _)['state'] for _ in rows] == ['complete'] * 3
+    assert journal.get(PID, rows[1])['fid'] == 2
+    journal.close()
+
+def test_sync_classify(tmp_path):
+    '''
+    Local files are matched to study files by path and compared by checksum
+    '''
+    for name, content in (('same.txt', b'same'), ('edited.txt', b'new content'),
+                          ('added.txt', b'added')):
+        (tmp_path / name).write_bytes(content)
+    rows = [{'fpath': str(tmp_path / _), 'dirlabel': 'data'}
+            for _ in ('same.txt', 'edited.txt', 'added.txt', 'gone.txt')]
+    index = du._remote_index([remote('same.txt', 1, b'same', 'data'),#pylint: disable=protected-access
+                              remote('edited.txt', 2, b'old content', 'data'),
+                              remote('gone.txt', 3, b'gone', 'data')])
+    status = upload._sync_classify(rows, index, workers=1)#pylint: disable=protected-access
+    assert [_[0] for _ in status] == ['unchanged', 'changed', 'new', 'failed']
+    assert [_[1]['dataFile']['id'] if _[1] else None for _ in status] == [1, 2, None, 3]
+    assert rows[1]['replace'] == 2
+    assert 'replace' not in rows[0]
+    assert isinstance(status[3][2], OSError)
+
+def test_sync_classify_supplied_digest(tmp_path):
+    '''
+    A checksum already in the manifest is used without reading the file
+    '''
+    rows = [{'fpath': str(tmp_path / 'absent.txt'), 'dirlabel': '',
+             'md5': hashlib.md5(b'x').hexdigest()}]
+    index = du._remote_index([remote('absent.txt', 1, b'x')])#pylint: disable=protected-access
+    assert upload._sync_classify(rows, index)[0][0] == 'unchanged'#pylint: disable=protected-access